@@ -0,0 +1,399 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+# Offline benchmark suite: operations of osm_query, srtm_query, overpass_loader, and
+# wikipedia_query run against a local stub server (see stub_server) with synthetic
+# relations of each size (number of ways) and synthetic SRTM tiles. Each operation runs
+# in a new interpreter (with an empty entity cache), and wall time, number of requests,
+# increase of peak RSS (by the operation, not its setup), and throughput are reported and
+# compared with a stored baseline.
+#
+# Usage: python benchmarks/bench.py [--sizes 10,1000,100000] [--operations get_elevation,...]
+#                                   [--baseline baseline.json] [--save-baseline baseline.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib2
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PY_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+
+sys.path.insert(0, PY_DIRECTORY)
+
+from fixtures import Fixtures, write_srtm_tiles
+from stub_server import StubServer, MEDIAWIKI_PATH, OVERPASS_PATH, STATISTICS_PATH
+
+# Sizes (number of ways) of synthetic relations
+BENCH_SIZES = (10, 1000, 100000)
+
+# Relative increase of wall time and peak RSS reported as regression
+BENCH_TOLERANCE = 0.25
+
+# Wall times below BENCH_MIN_TIME seconds, and increases of peak RSS below BENCH_MIN_RSS MB,
+# are not compared (too noisy)
+BENCH_MIN_TIME = 0.05
+BENCH_MIN_RSS = 1.0
+
+# Max size of operations (osmapi parses responses with minidom, which needs several GB of
+# memory for the full relation of 100k ways)
+BENCH_MAX_SIZE = {'get_relation_full': 10000}
+
+
+class Environment(object):
+    """
+    Environment of an operation in a benchmark process: stub services, empty entity cache
+    and node store, synthetic SRTM tiles, and a database in a temporary directory.
+    """
+
+    def __init__(self, url, directory, sizes, size):
+        import osm_query
+        import wikipedia_query
+
+        from node_store import NodeStore, set_node_store
+        from osm_cache import EntityCache, set_entity_cache
+        from srtm_query import HgtTileStore
+
+        self.url = url
+        self.directory = directory
+        self.size = size
+
+        self.fixtures = Fixtures(sizes)
+        self.relation = self.fixtures.relation(size)
+
+        set_entity_cache(EntityCache(os.path.join(directory, 'cache_%d.sqlite' % os.getpid())))
+        set_node_store(NodeStore())
+
+        osm_query.set_osm_api(url)
+        osm_query.set_overpass_api(url + OVERPASS_PATH)
+
+        wikipedia_query.set_wikipedia_api(url + MEDIAWIKI_PATH)
+        wikipedia_query.set_wikipedia_rate_limit(1e6)
+
+        self.tile_store = HgtTileStore(os.path.join(directory, 'srtm'), download=False)
+
+    def database(self):
+        import sqlite3
+
+        file_name = os.path.join(self.directory, 'relations_%d.sqlite' % os.getpid())
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+        return sqlite3.connect(file_name)
+
+    def cache_relation(self):
+        """
+        Put relation, ways, and nodes in entity cache (without requests).
+
+        @return: Relation dictionary.
+        """
+
+        from osm_cache import get_entity_cache
+
+        relation, ways, nodes = self.relation.relation_dict()
+
+        cache = get_entity_cache()
+        cache.put_many('node', nodes)
+        cache.put_many('way', ways)
+        cache.put('relation', relation['id'], relation)
+
+        return relation
+
+    def requests(self):
+        return json.load(urllib2.urlopen(self.url + STATISTICS_PATH))['total_requests']
+
+
+# Operations: functions of environment returning the function to time, and the number of
+# items processed (ways, nodes, track points, or pages), after setup (not timed)
+
+def bench_get_relation_full(env):
+    from osm_query import get_relation_full
+
+    return lambda: get_relation_full(env.relation.relation_id), env.size
+
+
+def bench_get_ways_by_ids(env):
+    from osm_query import get_ways_by_ids
+
+    way_ids = env.relation.way_ids()
+
+    return lambda: get_ways_by_ids(way_ids), len(way_ids)
+
+
+def bench_get_node_coordinates(env):
+    from osm_query import get_node_coordinates
+
+    node_ids = env.relation.node_ids()
+
+    return lambda: get_node_coordinates(node_ids), len(node_ids)
+
+
+def bench_create_track_points(env):
+    from osm_query import create_track_points
+
+    relation = env.cache_relation()
+
+    def run():
+        track_points = create_track_points(relation, env.relation.start_node)
+        assert track_points == env.relation.track_points()
+
+    return run, env.relation.n_nodes
+
+
+def bench_get_elevation(env):
+    from osm_query import get_node_coordinates
+    from srtm_query import get_elevation
+
+    env.cache_relation()
+    track_points = env.relation.track_points()
+    get_node_coordinates(track_points)
+
+    return lambda: get_elevation(track_points, env.tile_store), len(track_points)
+
+
+def bench_save_relation_to_db(env):
+    from osm_query import save_relation_to_db
+
+    relation = env.cache_relation()
+    engine = env.database()
+
+    return lambda: save_relation_to_db(engine, relation), env.size
+
+
+def bench_load_relation_from_db(env):
+    from osm_query import save_relation_to_db, load_relation_from_db
+
+    relation = env.cache_relation()
+    engine = env.database()
+    save_relation_to_db(engine, relation)
+
+    return lambda: load_relation_from_db(engine, relation['id']), env.size
+
+
+def bench_save_track_points_to_db(env):
+    from osm_query import save_track_points_to_db
+
+    engine = env.database()
+    track_points = env.relation.track_points()
+
+    return lambda: save_track_points_to_db(engine, env.relation.relation_id, track_points), len(track_points)
+
+
+def bench_load_track_points_from_db(env):
+    from osm_query import save_track_points_to_db, load_track_points_from_db
+
+    engine = env.database()
+    track_points = env.relation.track_points()
+    save_track_points_to_db(engine, env.relation.relation_id, track_points)
+
+    return lambda: load_track_points_from_db(engine, env.relation.relation_id), len(track_points)
+
+
+def bench_load_bbox(env):
+    from overpass_loader import load_bbox
+
+    engine = env.database()
+
+    return lambda: load_bbox(engine, *env.relation.bbox(), tile_size=1.0), env.size
+
+
+def bench_get_wikipedia_pages_by_list(env):
+    from wikipedia_query import get_wikipedia_pages_by_list
+
+    page_ids = range(1, env.size + 1)
+
+    def run():
+        pages = get_wikipedia_pages_by_list(page_ids)
+        assert len(pages) == len(page_ids)
+
+    return run, len(page_ids)
+
+
+OPERATIONS = [
+    ('get_relation_full', bench_get_relation_full),
+    ('get_ways_by_ids', bench_get_ways_by_ids),
+    ('get_node_coordinates', bench_get_node_coordinates),
+    ('create_track_points', bench_create_track_points),
+    ('get_elevation', bench_get_elevation),
+    ('save_relation_to_db', bench_save_relation_to_db),
+    ('load_relation_from_db', bench_load_relation_from_db),
+    ('save_track_points_to_db', bench_save_track_points_to_db),
+    ('load_track_points_from_db', bench_load_track_points_from_db),
+    ('load_bbox', bench_load_bbox),
+    ('get_wikipedia_pages_by_list', bench_get_wikipedia_pages_by_list),
+]
+
+
+def run_operation(name, url, directory, sizes, size):
+    """
+    Run operation (in this process) and measure it.
+
+    @param name: Name of operation.
+    @param url: Url of stub server.
+    @param directory: Temporary directory (SRTM tiles and databases).
+    @param sizes: List of sizes of fixtures.
+    @param size: Size of relation.
+    @return: Dictionary with wall time (seconds), number of requests, increase of peak RSS
+             during run (MB), number of items, and throughput (items per second).
+    """
+
+    env = Environment(url, directory, sizes, size)
+
+    run, n_items = dict(OPERATIONS)[name](env)
+
+    # ru_maxrss is in kilobytes on Linux (peak of process, so setup is measured separately)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    n_requests = env.requests()
+    start = time.time()
+    run()
+    wall = time.time() - start
+    n_requests = env.requests() - n_requests
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 - rss
+
+    return {'wall': wall, 'requests': n_requests, 'rss': rss, 'items': n_items,
+            'throughput': n_items / wall if wall > 0 else None}
+
+
+def run_benchmarks(operations, sizes, directory):
+    """
+    Run operations for each size, each in a new interpreter.
+
+    @param operations: List of names of operations.
+    @param sizes: List of sizes.
+    @param directory: Temporary directory.
+    @return: Dictionary of results for keys 'operation@size' (None for failed operations).
+    """
+
+    fixtures = Fixtures(sizes)
+    write_srtm_tiles(os.path.join(directory, 'srtm'), fixtures)
+
+    server = StubServer(fixtures)
+    url = server.start()
+
+    results = {}
+    for name in operations:
+        for size in sizes:
+            if size > BENCH_MAX_SIZE.get(name, size):
+                continue
+
+            key = '%s@%d' % (name, size)
+
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--run', name, '--url', url, '--directory', directory,
+                 '--sizes', ','.join(map(str, sizes)), '--size', str(size)],
+                cwd=PY_DIRECTORY, stdout=subprocess.PIPE
+            )
+            output, _ = process.communicate()
+
+            results[key] = json.loads(output.strip().splitlines()[-1]) if process.returncode == 0 else None
+            print_result(key, results[key])
+
+    server.shutdown()
+
+    return results
+
+
+def print_result(key, result):
+    if result is None:
+        print('%-40s failed' % key)
+        return
+
+    line = '%-40s %9.3f s %7d req %8.1f MB %12.0f items/s' % (
+        key, result['wall'], result['requests'], result['rss'], result['throughput'] or 0.0
+    )
+
+    print(line)
+    sys.stdout.flush()
+
+
+def compare_with_baseline(results, baseline, tolerance=BENCH_TOLERANCE):
+    """
+    Compare results with baseline.
+
+    @param results: Dictionary of results.
+    @param baseline: Dictionary of baseline results.
+    @param tolerance: Relative increase of wall time and peak RSS reported as regression.
+    @return: List of regressions (key and description).
+    """
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+
+        if result is None:
+            regressions.append((key, 'failed'))
+            continue
+
+        if result['wall'] > max(base['wall'], BENCH_MIN_TIME) * (1.0 + tolerance):
+            regressions.append((key, 'wall time %.3f s (baseline %.3f s)' % (result['wall'], base['wall'])))
+        if result['requests'] > base['requests']:
+            regressions.append((key, '%d requests (baseline %d)' % (result['requests'], base['requests'])))
+        if result['rss'] > max(base['rss'], BENCH_MIN_RSS) * (1.0 + tolerance):
+            regressions.append((key, 'peak RSS increase %.1f MB (baseline %.1f MB)' % (result['rss'], base['rss'])))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark suite')
+    parser.add_argument('--sizes', default=','.join(map(str, BENCH_SIZES)), help='sizes (number of ways)')
+    parser.add_argument('--operations', default=None, help='names of operations (all if not given)')
+    parser.add_argument('--baseline', default=None, help='compare with baseline file')
+    parser.add_argument('--save-baseline', default=None, help='save results as baseline file')
+    parser.add_argument('--tolerance', type=float, default=BENCH_TOLERANCE, help='relative tolerance')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--url', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--directory', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    # Benchmark process of one operation
+    if args.run:
+        print(json.dumps(run_operation(args.run, args.url, args.directory, sizes, args.size)))
+        return
+
+    operations = args.operations.split(',') if args.operations else [name for name, _ in OPERATIONS]
+
+    directory = tempfile.mkdtemp(prefix='hikepy_bench_')
+    try:
+        results = run_benchmarks(operations, sizes, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+
+        for key, description in regressions:
+            print('REGRESSION %-40s %s' % (key, description))
+
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
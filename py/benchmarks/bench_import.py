@@ -0,0 +1,105 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+# Import time benchmark: time to import modules in a new interpreter (interpreter startup
+# excluded), and heavy dependencies that must not be imported. Exits with status 1 if a
+# module exceeds its budget or imports a heavy dependency.
+#
+# Usage: python benchmarks/bench_import.py [--repeat 5]
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Directory of modules
+PY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import time budget (seconds) of modules
+IMPORT_BUDGET = {
+    'osm_query': 0.5,
+    'wikipedia_query': 0.5,
+    'gpx_trail': 0.3,
+}
+
+# Heavy dependencies that are imported on first use only (see lazy_import). numpy is not
+# among them: it is imported eagerly by design (used at import time by node_store and
+# trail_db), and counts towards the budgets
+LAZY_MODULES = ['pandas', 'osmapi', 'overpass', 'LatLon', 'sgcpy', 'pattern', 'requests']
+
+IMPORT_SCRIPT = '''
+import sys, time, json
+t = time.time()
+import %s
+print(json.dumps({'time': time.time() - t, 'modules': sorted(sys.modules)}))
+'''
+
+
+def time_import(module_name, repeat=5):
+    """
+    Time import of module in new interpreters.
+
+    @param module_name: Name of module.
+    @param repeat: Number of interpreters (min time is returned).
+    @return: Import time in seconds, and list of imported modules.
+    """
+
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % module_name], cwd=PY_DIRECTORY)
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['time'])
+
+    return min(times), result['modules']
+
+
+def run(repeat=5, budget=None):
+    """
+    Run import benchmark.
+
+    @param repeat: Number of interpreters for each module.
+    @param budget: Dictionary of import time budgets for module names (IMPORT_BUDGET if None).
+    @return: List of results (module, time, budget, eagerly imported lazy modules), and
+             True if all modules are within budget.
+    """
+
+    budget = budget or IMPORT_BUDGET
+
+    results, passed = [], True
+    for module_name in sorted(budget):
+        import_time, modules = time_import(module_name, repeat)
+        eager = [name for name in LAZY_MODULES if name in modules]
+
+        results.append((module_name, import_time, budget[module_name], eager))
+        passed = passed and import_time <= budget[module_name] and not eager
+
+    return results, passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='number of interpreters for each module')
+    args = parser.parse_args()
+
+    results, passed = run(args.repeat)
+
+    for module_name, import_time, budget, eager in results:
+        print('%-20s %6.3f s (budget %.3f s)%s' % (
+            module_name, import_time, budget, ' imports ' + ', '.join(eager) if eager else ''
+        ))
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import os
+import json
+import glob
+import hashlib
+import numpy as np
+
+from xml.sax.saxutils import quoteattr
+
+# Recorded responses (JSON files) replayed by the stub server before synthetic responses
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Number of nodes of each synthetic way (consecutive ways share end nodes), and every
+# FIXTURE_REVERSED_WAY:th way is stored reversed (so chaining must reverse it)
+FIXTURE_NODES_PER_WAY = 5
+FIXTURE_REVERSED_WAY = 3
+
+# Synthetic relations are laid out along rows (west to east, alternating) in their own
+# SRTM tile (latitude FIXTURE_TILE_LATITUDE, longitude FIXTURE_TILE_LONGITUDE + index)
+FIXTURE_TILE_LATITUDE = 59
+FIXTURE_TILE_LONGITUDE = 18
+FIXTURE_STEP = 0.0002
+FIXTURE_ROW_SPACING = 0.001
+
+# Side of synthetic SRTM tiles (SRTM3)
+FIXTURE_SRTM_SIDE = 1201
+
+OSM_ATTRIBUTES = 'version="1" changeset="1" user="hikepy" uid="1" visible="true" timestamp="2015-01-01T00:00:00Z"'
+
+
+class SyntheticRelation(object):
+    """
+    Synthetic hiking route relation of size ways (chained, all ids and coordinates are
+    computed from index and size, so nothing is stored).
+
+    >>> relation = SyntheticRelation(0, 10)
+    >>> relation.way_nodes(relation.way_base + 2)
+    [1000000012, 1000000011, 1000000010, 1000000009, 1000000008]
+    """
+
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+
+        self.relation_id = 1000 + index
+        self.node_base = (index + 1) * 10 ** 9
+        self.way_base = (index + 1) * 10 ** 8
+
+        self.n_nodes = size * (FIXTURE_NODES_PER_WAY - 1) + 1
+
+        self.tile_latitude = FIXTURE_TILE_LATITUDE
+        self.tile_longitude = FIXTURE_TILE_LONGITUDE + index
+
+    @property
+    def start_node(self):
+        return self.node_base
+
+    def node_ids(self):
+        return range(self.node_base, self.node_base + self.n_nodes)
+
+    def way_ids(self):
+        return range(self.way_base, self.way_base + self.size)
+
+    def track_points(self):
+        """
+        Track points of relation chained from start node.
+
+        @return: List of node ids.
+        """
+
+        return self.node_ids()
+
+    def bbox(self):
+        """
+        Bounding box of tile of relation.
+
+        @return: (min_longitude, min_latitude, max_longitude, max_latitude).
+        """
+
+        return (float(self.tile_longitude), float(self.tile_latitude),
+                float(self.tile_longitude + 1), float(self.tile_latitude + 1))
+
+    def has_node(self, node_id):
+        return self.node_base <= node_id < self.node_base + self.n_nodes
+
+    def has_way(self, way_id):
+        return self.way_base <= way_id < self.way_base + self.size
+
+    def coordinates(self, node_ids):
+        """
+        Coordinates of nodes.
+
+        @param node_ids: Array of node ids.
+        @return: Arrays of latitudes and longitudes.
+        """
+
+        i = np.asarray(node_ids, dtype=np.int64) - self.node_base
+
+        per_row = int(round(1.0 / FIXTURE_STEP)) - 1
+        row, column = i // per_row, i % per_row
+        column = np.where(row % 2 == 0, column, per_row - 1 - column)
+
+        lat = self.tile_latitude + 0.0005 + row * FIXTURE_ROW_SPACING + 0.0001 * np.sin(column * 0.1)
+        lon = self.tile_longitude + 0.0001 + column * FIXTURE_STEP
+
+        return lat, lon
+
+    def way_nodes(self, way_id):
+        """
+        Nodes of way.
+
+        @param way_id: Way id.
+        @return: List of node ids.
+        """
+
+        j = way_id - self.way_base
+        first = self.node_base + j * (FIXTURE_NODES_PER_WAY - 1)
+
+        nodes = range(first, first + FIXTURE_NODES_PER_WAY)
+
+        return nodes[::-1] if j % FIXTURE_REVERSED_WAY == FIXTURE_REVERSED_WAY - 1 else nodes
+
+    def relation_dict(self):
+        """
+        Relation, ways, and nodes as dictionaries (as from osmapi).
+
+        @return: Relation dictionary, and dictionaries of way and node dictionaries for ids.
+        """
+
+        relation = {'id': self.relation_id, 'version': 1,
+                    'tag': {'type': 'route', 'route': 'hiking', 'name': 'Synthetic trail %d' % self.size},
+                    'member': [{'type': 'way', 'ref': way_id, 'role': ''} for way_id in self.way_ids()]}
+
+        ways = dict((way_id, {'id': way_id, 'version': 1, 'nd': self.way_nodes(way_id), 'tag': {'highway': 'path'}})
+                    for way_id in self.way_ids())
+
+        node_ids = self.node_ids()
+        lat, lon = self.coordinates(node_ids)
+        nodes = dict((node_id, {'id': node_id, 'version': 1, 'lat': y, 'lon': x, 'tag': {}})
+                     for node_id, y, x in zip(node_ids, lat.tolist(), lon.tolist()))
+
+        return relation, ways, nodes
+
+    def node_xml(self, node_ids):
+        lat, lon = self.coordinates(node_ids)
+
+        return ''.join('<node id="%d" lat="%.7f" lon="%.7f" %s/>' % (node_id, y, x, OSM_ATTRIBUTES)
+                       for node_id, y, x in zip(node_ids, lat.tolist(), lon.tolist()))
+
+    def way_xml(self, way_ids):
+        return ''.join('<way id="%d" %s>' % (way_id, OSM_ATTRIBUTES) +
+                       ''.join('<nd ref="%d"/>' % node_id for node_id in self.way_nodes(way_id)) +
+                       '<tag k="highway" v="path"/></way>'
+                       for way_id in way_ids)
+
+    def relation_xml(self):
+        return '<relation id="%d" %s>' % (self.relation_id, OSM_ATTRIBUTES) + \
+               ''.join('<member type="way" ref="%d" role=""/>' % way_id for way_id in self.way_ids()) + \
+               '<tag k="type" v="route"/><tag k="route" v="hiking"/>' + \
+               '<tag k="name" v=%s/></relation>' % quoteattr('Synthetic trail %d' % self.size)
+
+    def full_xml(self):
+        return self.node_xml(self.node_ids()) + self.way_xml(self.way_ids()) + self.relation_xml()
+
+
+class SyntheticPages(object):
+    """
+    Synthetic Wikipedia pages (page ids 1 to size, along the first synthetic relation).
+    """
+
+    def __init__(self, size, relation):
+        self.size = size
+        self.relation = relation
+
+        step = max(relation.n_nodes // max(size, 1), 1)
+        self.lat, self.lon = relation.coordinates(
+            relation.node_base + (np.arange(size) * step) % relation.n_nodes
+        )
+
+    def has_page(self, page_id):
+        return 1 <= page_id <= self.size
+
+    def title(self, page_id):
+        return u'Page %d' % page_id
+
+    def page_id(self, title):
+        try:
+            page_id = int(title.rsplit(' ', 1)[-1])
+        except ValueError:
+            return None
+        return page_id if self.has_page(page_id) else None
+
+    def page(self, page_id, prop):
+        """
+        Page of query response.
+
+        @param page_id: Page id.
+        @param prop: Set of requested properties.
+        @return: Page dictionary.
+        """
+
+        page = {'pageid': page_id, 'ns': 0, 'title': self.title(page_id), 'lastrevid': 10 * page_id}
+
+        if 'info' in prop:
+            page['fullurl'] = 'http://localhost/wiki/Page_%d' % page_id
+        if 'coordinates' in prop:
+            page['coordinates'] = [{'lat': self.lat[page_id - 1], 'lon': self.lon[page_id - 1], 'primary': ''}]
+        if 'categories' in prop:
+            page['categories'] = [{'ns': 14, 'title': u'Kategori:Synthetic %d' % (page_id % 10)}]
+        if 'images' in prop:
+            page['images'] = [{'ns': 6, 'title': u'Fil:Page %d.jpg' % page_id}]
+        if 'extracts' in prop:
+            page['extract'] = u'<p>Synthetic page %d.</p>' % page_id
+
+        return page
+
+
+class Fixtures(object):
+    """
+    Synthetic relations (one for each size) and Wikipedia pages (as many as the largest size).
+
+    >>> fixtures = Fixtures([10, 1000])
+    >>> fixtures.relation(1000).relation_id
+    1001
+    """
+
+    def __init__(self, sizes):
+        self.relations = [SyntheticRelation(index, size) for index, size in enumerate(sizes)]
+        self.pages = SyntheticPages(max(sizes), self.relations[0])
+
+    def relation(self, size):
+        for relation in self.relations:
+            if relation.size == size:
+                return relation
+        raise KeyError('No synthetic relation of size %d' % size)
+
+    def relation_of_node(self, node_id):
+        for relation in self.relations:
+            if relation.has_node(node_id):
+                return relation
+
+    def relation_of_way(self, way_id):
+        for relation in self.relations:
+            if relation.has_way(way_id):
+                return relation
+
+    def relation_by_id(self, relation_id):
+        for relation in self.relations:
+            if relation.relation_id == relation_id:
+                return relation
+
+
+def write_srtm_tiles(directory, fixtures, side=FIXTURE_SRTM_SIDE):
+    """
+    Write synthetic SRTM height files (smooth hills) for tiles of relations.
+
+    @param directory: Directory of height files.
+    @param fixtures: Fixtures.
+    @param side: Number of rows and columns of tiles.
+    @return: List of file names.
+    """
+
+    from srtm_query import get_hgt_file_name
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    y, x = np.mgrid[0:side, 0:side] / float(side - 1)
+    heights = (100.0 + 60.0 * np.sin(12.0 * x) * np.cos(9.0 * y) + 20.0 * np.sin(40.0 * (x + y))).astype('>i2')
+
+    file_names = []
+    for relation in fixtures.relations:
+        file_name = os.path.join(directory, get_hgt_file_name(relation.tile_latitude, relation.tile_longitude))
+        if not os.path.exists(file_name):
+            heights.tofile(file_name)
+        file_names.append(file_name)
+
+    return file_names
+
+
+def request_key(method, path, body=''):
+    """
+    Key of recorded response (hash of method, path, and sorted form parameters of body).
+
+    @param method: HTTP method.
+    @param path: Path with query string.
+    @param body: Request body (form encoded), or ''.
+    @return: Key.
+    """
+
+    from urlparse import parse_qsl
+
+    params = sorted((key, value) for key, value in parse_qsl(body, keep_blank_values=True) if key != 'format')
+
+    return hashlib.sha1(json.dumps([method, path, params])).hexdigest()
+
+
+def load_recorded_responses(directory=FIXTURE_DIRECTORY):
+    """
+    Load recorded responses (JSON files with method, path, body, status, content_type,
+    and response).
+
+    @param directory: Directory of recorded responses.
+    @return: Dictionary of (status, content type, response) for request keys.
+    """
+
+    responses = {}
+    for file_name in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        with open(file_name) as f:
+            d = json.load(f)
+        responses[request_key(d['method'], d['path'], d.get('body', ''))] = (
+            d.get('status', 200), d.get('content_type', 'text/xml'), d['response'].encode('utf-8')
+        )
+
+    return responses
+
+
+def record_response(url, path, body=None, directory=FIXTURE_DIRECTORY):
+    """
+    Record response of a live service (e.g. OSM API, Overpass API, or MediaWiki API) as a
+    fixture replayed by the stub server.
+
+    @param url: Base url of service (e.g. 'https://www.openstreetmap.org').
+    @param path: Path with query string (e.g. '/api/0.6/relation/660162/full').
+    @param body: Form encoded body of POST request, or None (GET request).
+    @param directory: Directory of recorded responses.
+    @return: File name of fixture.
+
+    >>> record_response('https://www.openstreetmap.org', '/api/0.6/relation/660162/full')
+    """
+
+    import requests
+
+    method = 'GET' if body is None else 'POST'
+    response = requests.request(method, url + path, data=body,
+                                headers={'Content-Type': 'application/x-www-form-urlencoded'} if body else {})
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    key = request_key(method, path, body or '')
+    file_name = os.path.join(directory, key + '.json')
+    with open(file_name, 'w') as f:
+        json.dump({'method': method, 'path': path, 'body': body or '', 'status': response.status_code,
+                   'content_type': response.headers.get('Content-Type', 'text/xml'),
+                   'response': response.content.decode('utf-8')}, f, indent=1)
+
+    return file_name
@@ -0,0 +1,235 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import re
+import json
+import threading
+
+from collections import defaultdict
+from urlparse import urlparse, parse_qs, parse_qsl
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from fixtures import request_key, load_recorded_responses
+
+# Paths of stub services
+OSM_API_PATH = '/api/0.6/'
+OVERPASS_PATH = '/api/interpreter'
+MEDIAWIKI_PATH = '/w/api.php'
+
+# Path of request counters (not counted)
+STATISTICS_PATH = '/_statistics'
+
+OSM_ELEMENT_PATH = re.compile(r'^/api/0\.6/(node|way|relation)/(\d+)(/full)?$')
+OSM_ELEMENTS_PATH = re.compile(r'^/api/0\.6/(nodes|ways)$')
+OVERPASS_BBOX = re.compile(r'\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\)')
+
+
+def osm_document(body):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="hikepy stub">' + body + '</osm>'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of stub OSM API, Overpass API, and MediaWiki API (responses from
+    recorded fixtures, or synthetic responses from fixtures of server).
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, content_type, body, service=None):
+        if service is not None:
+            self.server.count(service, len(body))
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def recorded(self, method, body=''):
+        response = self.server.recorded.get(request_key(method, self.path, body))
+        if response is None:
+            return False
+
+        status, content_type, data = response
+        self.send_body(status, content_type, data, urlparse(self.path).path.split('/')[1])
+
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == STATISTICS_PATH:
+            return self.send_body(200, 'application/json', json.dumps(self.server.statistics()))
+
+        if self.recorded('GET'):
+            return
+
+        fixtures = self.server.fixtures
+
+        match = OSM_ELEMENT_PATH.match(url.path)
+        if match:
+            kind, element_id, full = match.group(1), int(match.group(2)), match.group(3)
+
+            if kind == 'node':
+                relation = fixtures.relation_of_node(element_id)
+                body = relation.node_xml([element_id]) if relation else None
+            elif kind == 'way':
+                relation = fixtures.relation_of_way(element_id)
+                body = relation.way_xml([element_id]) if relation else None
+            else:
+                relation = fixtures.relation_by_id(element_id)
+                body = (relation.full_xml() if full else relation.relation_xml()) if relation else None
+
+            if body is None:
+                return self.send_body(404, 'text/plain', 'Not found', 'osm')
+            return self.send_body(200, 'text/xml; charset=utf-8', osm_document(body), 'osm')
+
+        match = OSM_ELEMENTS_PATH.match(url.path)
+        if match:
+            kind = match.group(1)
+            ids = [int(value) for value in parse_qs(url.query)[kind][0].split(',')]
+
+            body = []
+            for element_id in ids:
+                relation = fixtures.relation_of_node(element_id) if kind == 'nodes' else \
+                    fixtures.relation_of_way(element_id)
+                if relation is None:
+                    return self.send_body(404, 'text/plain', 'Not found', 'osm')
+                body.append(relation.node_xml([element_id]) if kind == 'nodes' else relation.way_xml([element_id]))
+
+            return self.send_body(200, 'text/xml; charset=utf-8', osm_document(''.join(body)), 'osm')
+
+        self.send_body(404, 'text/plain', 'Not found')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+
+        if self.recorded('POST', body):
+            return
+
+        path = urlparse(self.path).path
+        if path == OVERPASS_PATH:
+            return self.overpass(dict(parse_qsl(body, keep_blank_values=True)))
+        if path == MEDIAWIKI_PATH:
+            return self.mediawiki(dict(parse_qsl(body, keep_blank_values=True)))
+
+        self.send_body(404, 'text/plain', 'Not found')
+
+    def overpass(self, params):
+        """
+        Overpass route query: relations (with ways and nodes) within bounding box of query.
+        """
+
+        south, west, north, east = map(float, OVERPASS_BBOX.search(params['data']).groups())
+
+        body = []
+        for relation in self.server.fixtures.relations:
+            min_longitude, min_latitude, max_longitude, max_latitude = relation.bbox()
+            if min_longitude < east and west < max_longitude and min_latitude < north and south < max_latitude:
+                body.append(relation.full_xml())
+
+        self.send_body(200, 'text/xml; charset=utf-8', osm_document(''.join(body)), 'overpass')
+
+    def mediawiki(self, params):
+        """
+        MediaWiki queries: pages by page ids or titles, image info, and geosearch.
+        """
+
+        pages = self.server.fixtures.pages
+        prop = set(params.get('prop', '').split('|'))
+
+        query = {}
+        if 'pageids' in params or 'titles' in params:
+            if 'pageids' in params:
+                page_ids = [int(value) for value in params['pageids'].split('|')]
+            else:
+                page_ids = [pages.page_id(title.decode('utf-8')) for title in params['titles'].split('|')]
+
+            query['pages'] = {}
+            for i, page_id in enumerate(page_ids):
+                if page_id is None or not pages.has_page(page_id):
+                    query['pages'][str(-1 - i)] = {'ns': 0, 'missing': ''}
+                elif 'imageinfo' in prop:
+                    query['pages'][str(page_id)] = {
+                        'ns': 6, 'title': pages.title(page_id),
+                        'imageinfo': [{'url': 'http://localhost/images/%d.jpg' % page_id, 'size': 1000,
+                                       'sha1': '0' * 40}]
+                    }
+                else:
+                    query['pages'][str(page_id)] = pages.page(page_id, prop)
+
+        elif params.get('list') == 'geosearch':
+            query['geosearch'] = []
+
+        self.send_body(200, 'application/json; charset=utf-8', json.dumps({'batchcomplete': '', 'query': query}),
+                       'mediawiki')
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Stub HTTP server of OSM API, Overpass API, and MediaWiki API, serving recorded fixtures
+    and synthetic fixtures (see fixtures), and counting requests and bytes of each service.
+
+    >>> server = StubServer(Fixtures([10, 1000]))
+    >>> url = server.start()
+    >>> osm_api = set_osm_api(url)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fixtures, recorded=None, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+
+        self.fixtures = fixtures
+        self.recorded = load_recorded_responses() if recorded is None else recorded
+
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def start(self):
+        """
+        Serve requests in a background thread.
+
+        @return: Base url of server.
+        """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self.url
+
+    def count(self, service, n_bytes):
+        with self.lock:
+            self.requests[service] += 1
+            self.bytes[service] += n_bytes
+
+    def statistics(self):
+        """
+        Get request counters.
+
+        @return: Dictionary with number of requests and bytes for each service, and in total.
+        """
+
+        with self.lock:
+            return {'requests': dict(self.requests), 'bytes': dict(self.bytes),
+                    'total_requests': sum(self.requests.values()), 'total_bytes': sum(self.bytes.values())}
@@ -0,0 +1,92 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import numpy as np
+
+# Mean radius of the earth (meters)
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat_1, lon_1, lat_2, lon_2):
+    """
+    Great circle distance between coordinates (vectorized).
+
+    Reference: https://en.wikipedia.org/wiki/Haversine_formula
+
+    @param lat_1: Latitude(s) of first point(s), decimal degrees format.
+    @param lon_1: Longitude(s) of first point(s), decimal degrees format.
+    @param lat_2: Latitude(s) of second point(s), decimal degrees format.
+    @param lon_2: Longitude(s) of second point(s), decimal degrees format.
+    @return: Distance(s) in meters.
+
+    >>> round(haversine(59.33, 17.95, 59.34, 17.95), 1)
+    1112.0
+    """
+
+    lat_1, lon_1, lat_2, lon_2 = map(np.radians, (lat_1, lon_1, lat_2, lon_2))
+
+    a = np.sin((lat_2 - lat_1) / 2.0) ** 2 + \
+        np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2.0) ** 2
+
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def cumulative_distance(lat, lon):
+    """
+    Cumulative distance along polyline.
+
+    @param lat: Array of latitudes, decimal degrees format.
+    @param lon: Array of longitudes, decimal degrees format.
+    @return: Array of distances in meters from first point (same length as lat).
+
+    >>> cumulative_distance(np.array([59.33, 59.34, 59.35]), np.array([17.95, 17.95, 17.95])).round(1)
+    array([   0. , 1112. , 2223.9])
+    """
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    distance = np.zeros(lat.shape, dtype=np.float64)
+    if lat.size > 1:
+        np.cumsum(haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]), out=distance[1:])
+
+    return distance
+
+
+def project(lat, lon, lat_0=None, lon_0=None):
+    """
+    Project coordinates onto plane (equirectangular projection around origin), accurate
+    for distances of tens of kilometers, e.g. for simplification of tracks.
+
+    @param lat: Array of latitudes, decimal degrees format.
+    @param lon: Array of longitudes, decimal degrees format.
+    @param lat_0: Latitude of origin (mean latitude if None).
+    @param lon_0: Longitude of origin (mean longitude if None).
+    @return: Arrays of x (east) and y (north) in meters.
+
+    >>> x, y = project(np.array([59.33, 59.34]), np.array([17.95, 17.96]), 59.33, 17.95)
+    >>> x.round(1), y.round(1)
+    (array([  0. , 567.2]), array([   0., 1112.]))
+    """
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    if lat_0 is None:
+        lat_0 = lat.mean() if lat.size else 0.0
+    if lon_0 is None:
+        lon_0 = lon.mean() if lon.size else 0.0
+
+    x = EARTH_RADIUS * np.radians(lon - lon_0) * np.cos(np.radians(lat_0))
+    y = EARTH_RADIUS * np.radians(lat - lat_0)
+
+    return x, y
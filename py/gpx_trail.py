@@ -0,0 +1,319 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import os
+import re
+import numpy as np
+
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+# Schema validation requires lxml (optional)
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Note: osm_query imports this module within functions, so import osm_query within functions only
+
+GPX_NAMESPACE = 'http://www.topografix.com/GPX/1/1'
+GPX_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas', 'gpx.xsd')
+GPX_CREATOR = 'hikepy'
+
+# Number of track points formatted and written at once
+GPX_WRITE_BATCH = 10000
+
+
+def create_gpx_file_name(dir_name, relation_id, name, ext='gpx'):
+    """
+    Create file name of relation (e.g. of GPX file or Excel workbook).
+
+    @param dir_name: Name of directory.
+    @param relation_id: Id of relation.
+    @param name: Name of relation.
+    @param ext: File name extension.
+    @return: File name.
+
+    >>> create_gpx_file_name('/tmp', 660162, u'Sormlandsleden etapp 1')
+    u'/tmp/660162_Sormlandsleden_etapp_1.gpx'
+    """
+
+    name = re.sub(r'[^\w\-]+', '_', name, flags=re.UNICODE).strip('_')
+
+    return os.path.join(dir_name, '%d_%s.%s' % (relation_id, name, ext))
+
+
+def format_track_points(lat, lon, elevation):
+    """
+    Format track points as GPX trkpt elements.
+
+    @param lat: Array of latitudes.
+    @param lon: Array of longitudes.
+    @param elevation: Array of elevations (NaN where missing).
+    @return: String with one trkpt element on each line.
+
+    >>> format_track_points(np.array([59.5]), np.array([18.25]), np.array([12.0]))
+    '<trkpt lat="59.5000000" lon="18.2500000"><ele>12.0</ele></trkpt>\\n'
+    """
+
+    known = ~np.isnan(elevation)
+
+    return ''.join(
+        '<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele></trkpt>\n' % (y, x, z) if k else
+        '<trkpt lat="%.7f" lon="%.7f"/>\n' % (y, x)
+        for y, x, z, k in zip(lat.tolist(), lon.tolist(), elevation.tolist(), known.tolist())
+    )
+
+
+class GpxWriter(object):
+    """
+    Incremental GPX writer (tracks are written as they are added, without building a
+    document tree).
+
+    >>> with GpxWriter(open('/tmp/track.gpx', 'wb')) as writer:
+    ...     writer.start_track('Sormlandsleden')
+    ...     writer.write_segment([59.0, 59.1], [18.0, 18.1], [10.0, np.nan])
+    ...     writer.end_track()
+    """
+
+    def __init__(self, file_object, creator=GPX_CREATOR):
+        self.file_object = file_object
+        self.in_track = False
+
+        self.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<gpx version="1.1" creator=' + quoteattr(creator) + ' xmlns="' + GPX_NAMESPACE + '">\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.file_object.write(text)
+
+    def start_track(self, name=None):
+        """
+        Start track (trk element).
+
+        @param name: Name of track.
+        """
+
+        if self.in_track:
+            self.end_track()
+
+        self.write('<trk>\n' + ('<name>' + escape(name) + '</name>\n' if name else ''))
+        self.in_track = True
+
+    def write_segment(self, lat, lon, elevation=None):
+        """
+        Write track segment (trkseg element) of track points.
+
+        @param lat: Array of latitudes.
+        @param lon: Array of longitudes.
+        @param elevation: Array of elevations (NaN where missing), or None.
+        """
+
+        if not self.in_track:
+            self.start_track()
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        elevation = np.full(lat.size, np.nan) if elevation is None else np.asarray(elevation, dtype=np.float64)
+
+        self.write('<trkseg>\n')
+        for i in range(0, lat.size, GPX_WRITE_BATCH):
+            batch = slice(i, i + GPX_WRITE_BATCH)
+            self.write(format_track_points(lat[batch], lon[batch], elevation[batch]))
+        self.write('</trkseg>\n')
+
+    def end_track(self):
+        """
+        End track.
+        """
+
+        if self.in_track:
+            self.write('</trk>\n')
+            self.in_track = False
+
+    def close(self):
+        """
+        End GPX document and close file.
+        """
+
+        self.end_track()
+        self.write('</gpx>\n')
+        self.file_object.close()
+
+
+def write_gpx(file_name, track_points, lat, lon, elevation=None, name=None, validate=False):
+    """
+    Write track to GPX file (one track with one segment).
+
+    @param file_name: Name of GPX file.
+    @param track_points: List of OSM node ids of track.
+    @param lat: Array of latitudes of track points.
+    @param lon: Array of longitudes of track points.
+    @param elevation: Array of elevations of track points (NaN where missing), dictionary
+                      of elevations for node ids (e.g. from get_elevation), or None.
+    @param name: Name of track.
+    @param validate: Validate GPX file against schema (requires lxml).
+    @return: File name.
+
+    >>> write_gpx('/tmp/track.gpx', [1, 2], [59.0, 59.1], [18.0, 18.1], {1: 10.0, 2: None})
+    '/tmp/track.gpx'
+    """
+
+    if isinstance(elevation, dict):
+        elevation = np.array([elevation.get(nd) for nd in track_points], dtype=np.float64)
+
+    with GpxWriter(open(file_name, 'wb')) as writer:
+        writer.start_track(name)
+        writer.write_segment(lat, lon, elevation)
+
+    if validate:
+        validate_gpx(file_name)
+
+    return file_name
+
+
+def write_relation_to_gpx(dir_name, relation, track_points, elevation=None, tolerance=None, validate=False):
+    """
+    Write track of relation to GPX file (file name from create_gpx_file_name).
+
+    @param dir_name: Name of directory.
+    @param relation: Relation dictionary.
+    @param track_points: List of OSM node ids of track.
+    @param elevation: Dictionary of elevations for node ids (no elevations if None).
+    @param tolerance: Simplify track with tolerance in meters, keeping way points of
+                      relation (see simplify), or None.
+    @param validate: Validate GPX file against schema (requires lxml).
+    @return: File name.
+
+    >>> relation = get_relation_by_id(660162)
+    >>> file_name = write_relation_to_gpx('/tmp', relation, track_points, get_elevation(track_points), 5.0)
+    """
+
+    from osm_query import get_node_coordinates
+    from simplify import simplify_relation_track
+
+    if tolerance is not None:
+        track_points = simplify_relation_track(relation, track_points, tolerance)
+
+    name = relation['tag'].get('name', str(relation['id']))
+    lat, lon = get_node_coordinates(track_points)
+
+    return write_gpx(
+        create_gpx_file_name(dir_name, relation['id'], name), track_points, lat, lon, elevation, name, validate
+    )
+
+
+def gpx_tags(name):
+    """
+    Get tags of GPX element, with and without GPX namespace.
+
+    @param name: Name of element.
+    @return: Set of tags.
+    """
+
+    return {name, '{' + GPX_NAMESPACE + '}' + name}
+
+
+def iter_gpx_points(source):
+    """
+    Stream-parse track points of GPX file in constant memory.
+
+    @param source: File name or file object.
+    @return: Iterator of (track, segment, lat, lon, elevation) for each track point, where
+             track and segment are counted from 0 and elevation is NaN where missing.
+
+    >>> from StringIO import StringIO
+    >>> source = StringIO('<gpx><trk><trkseg><trkpt lat="59.5" lon="18.25"><ele>12</ele></trkpt></trkseg></trk></gpx>')
+    >>> list(iter_gpx_points(source))
+    [(0, 0, 59.5, 18.25, 12.0)]
+    """
+
+    trk, trkseg, trkpt, ele = gpx_tags('trk'), gpx_tags('trkseg'), gpx_tags('trkpt'), gpx_tags('ele')
+
+    track, segment = -1, -1
+    parent = None
+
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        tag = elem.tag
+
+        if event == 'start':
+            if tag in trkseg:
+                segment += 1
+                parent = elem
+            elif tag in trk:
+                track += 1
+                segment = -1
+            continue
+
+        if tag in trkpt:
+            # Elevation is the first child of trkpt (if any, see gpx.xsd)
+            elevation = float(elem[0].text) if len(elem) and elem[0].tag in ele and elem[0].text else np.nan
+
+            yield track, segment, float(elem.get('lat')), float(elem.get('lon')), elevation
+
+            # Remove parsed track point from its segment (memory does not grow with segment)
+            if parent is not None:
+                parent.remove(elem)
+        elif tag in trkseg or tag in trk:
+            elem.clear()
+
+
+def read_gpx(source):
+    """
+    Read track points of GPX file into arrays.
+
+    @param source: File name or file object.
+    @return: Arrays of track indexes, segment indexes, latitudes, longitudes, and
+             elevations (NaN where missing).
+
+    >>> track, segment, lat, lon, elevation = read_gpx('/tmp/track.gpx')
+    """
+
+    dtype = [('track', np.int32), ('segment', np.int32),
+             ('lat', np.float64), ('lon', np.float64), ('elevation', np.float64)]
+
+    points = np.fromiter(iter_gpx_points(source), dtype=dtype)
+
+    return points['track'], points['segment'], points['lat'], points['lon'], points['elevation']
+
+
+def validate_gpx(file_name, schema=GPX_SCHEMA):
+    """
+    Validate GPX file against schema (requires lxml).
+
+    @param file_name: Name of GPX file.
+    @param schema: Name of schema file (XSD).
+    @return: True if valid (ValueError is raised if invalid).
+
+    >>> validate_gpx('/tmp/track.gpx')
+    True
+    """
+
+    if etree is None:
+        raise ImportError('lxml is required to validate GPX files')
+
+    xml_schema = etree.XMLSchema(etree.parse(schema))
+    if not xml_schema.validate(etree.parse(file_name)):
+        raise ValueError('Invalid GPX file %s: %s' % (file_name, xml_schema.error_log.last_error))
+
+    return True
@@ -0,0 +1,300 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import os
+import hashlib
+import urllib
+
+from urlparse import urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from lazy_import import lazy_import
+
+requests = lazy_import('requests')
+
+# Thumbnails require PIL (optional)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Number of threads downloading files (and size of connection pool of session)
+DOWNLOAD_MAX_WORKERS = 8
+
+# Size of chunks streamed to file (bytes), and timeout (seconds) of connections and reads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+DOWNLOAD_USER_AGENT = 'hikepy/0.1.0 (https://github.com/carljohanrehn/hikepy)'
+
+# Number of hexadecimal digits of url hash in file names (see target_file_names)
+DOWNLOAD_HASH_LENGTH = 8
+
+# Max size (pixels) of thumbnails, and directory of thumbnails (relative to folder of images)
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_DIRECTORY = 'thumbnails'
+
+
+def create_session(max_workers=DOWNLOAD_MAX_WORKERS):
+    """
+    Create HTTP session with a connection pool for each host (connections are reused
+    by requests and shared by threads).
+
+    @param max_workers: Number of threads using session.
+    @return: requests Session.
+    """
+
+    session = requests.Session()
+    session.headers['User-Agent'] = DOWNLOAD_USER_AGENT
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def url_file_name(url):
+    """
+    Get file name of url (last part of path, unquoted).
+
+    @param url: Url.
+    @return: File name.
+
+    >>> url_file_name('http://upload.wikimedia.org/wikipedia/commons/9/9b/Aromatic_dec_2013b.jpg')
+    'Aromatic_dec_2013b.jpg'
+    """
+
+    return urllib.unquote(os.path.basename(urlparse(url).path))
+
+
+def file_sha1(file_name):
+    """
+    Get SHA-1 hash of file (read in chunks).
+
+    @param file_name: File name.
+    @return: Hexadecimal SHA-1 hash.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def is_downloaded(file_name, size=None, sha1=None):
+    """
+    Check if file exists with expected size and hash (an existing file is accepted if
+    size and hash are unknown).
+
+    @param file_name: File name.
+    @param size: Size of file in bytes, or None.
+    @param sha1: Hexadecimal SHA-1 hash of file, or None.
+    @return: True if file is downloaded.
+    """
+
+    if not os.path.isfile(file_name):
+        return False
+
+    if size is not None and os.path.getsize(file_name) != size:
+        return False
+
+    return sha1 is None or file_sha1(file_name) == sha1
+
+
+def download_file(session, url, file_name, size=None, sha1=None):
+    """
+    Download file, streaming original bytes to a temporary file which is renamed when
+    complete (so interrupted downloads never leave partial files). Files that are already
+    downloaded are skipped.
+
+    @param session: requests Session.
+    @param url: Url of file.
+    @param file_name: File name.
+    @param size: Expected size of file in bytes, or None.
+    @param sha1: Expected hexadecimal SHA-1 hash of file, or None.
+    @return: True if file was downloaded, False if skipped (IOError is raised if size or
+             hash of downloaded file is wrong).
+    """
+
+    if is_downloaded(file_name, size, sha1):
+        return False
+
+    temp_file_name = file_name + '.part'
+
+    response = session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        response.raise_for_status()
+
+        hash_sha1 = hashlib.sha1()
+        n_bytes = 0
+        with open(temp_file_name, 'wb') as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                hash_sha1.update(chunk)
+                n_bytes += len(chunk)
+
+        if (size is not None and n_bytes != size) or (sha1 is not None and hash_sha1.hexdigest() != sha1):
+            raise IOError('Incomplete or corrupt download of %s' % url)
+
+        os.rename(temp_file_name, file_name)
+    finally:
+        response.close()
+
+        # Temporary file is left only if download failed
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+
+    return True
+
+
+def target_file_names(files, folder=''):
+    """
+    Get file names of files in download folder. Files without file name are named by the
+    last part of the url and a short hash of the url, so files of different urls never
+    share a name, also in later calls (existing files are skipped if size and hash are
+    unknown). Files with the same url share the file name. A given file name used by an
+    earlier file with another url is replaced the same way.
+
+    @param files: List of dictionaries with url, and optionally file name.
+    @param folder: Download folder.
+    @return: List of file names (one for each file).
+
+    >>> target_file_names([{'url': 'http://a/1/x.jpg'}, {'url': 'http://a/2/x.jpg'}, {'url': 'http://a/1/x.jpg'}])
+    ['x_0fd54709.jpg', 'x_c264865f.jpg', 'x_0fd54709.jpg']
+    """
+
+    urls = {}
+
+    file_names = []
+    for d in files:
+        url = d['url']
+        file_name = d.get('file_name') and os.path.join(folder, d['file_name'])
+
+        if not file_name or urls.get(file_name, url) != url:
+            root, ext = os.path.splitext(d.get('file_name') or url_file_name(url))
+            url_hash = hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+            file_name = os.path.join(folder, '%s_%s%s' % (root, url_hash[:DOWNLOAD_HASH_LENGTH], ext))
+
+        urls[file_name] = url
+        file_names.append(file_name)
+
+    return file_names
+
+
+def download_files(files, folder='', max_workers=DOWNLOAD_MAX_WORKERS, session=None):
+    """
+    Download files concurrently (thread pool sharing one session). Files with the same url
+    are downloaded once, and file names are made unique (see target_file_names).
+
+    @param files: List of dictionaries with url, and optionally file name, size, and sha1
+                  (e.g. image info from the MediaWiki API). The file name is the last part
+                  of the url and a hash of the url if not given.
+    @param folder: Download folder (created if missing).
+    @param max_workers: Number of threads downloading files.
+    @param session: requests Session (created if None).
+    @return: List of downloaded or skipped file names, and dictionary of errors for
+             failed urls.
+
+    >>> files = [{'url': 'http://upload.wikimedia.org/wikipedia/commons/9/9b/Aromatic_dec_2013b.jpg'}]
+    >>> file_names, failed = download_files(files, 'images')
+    """
+
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    session = session or create_session(max_workers)
+
+    def download(d, file_name):
+        download_file(session, d['url'], file_name, d.get('size'), d.get('sha1'))
+        return file_name
+
+    file_names, failed = [], {}
+
+    targets = zip(files, target_file_names(files, folder))
+
+    with ThreadPoolExecutor(max(min(max_workers, len(files)), 1)) as executor:
+        futures = {}
+        for d, file_name in targets:
+            if file_name not in futures:
+                futures[file_name] = executor.submit(download, d, file_name)
+
+        for d, file_name in targets:
+            try:
+                file_names.append(futures[file_name].result())
+            except (requests.RequestException, IOError, OSError) as e:
+                failed[d['url']] = e
+
+    return file_names, failed
+
+
+def create_thumbnail(file_name, thumbnail_name, size=THUMBNAIL_SIZE):
+    """
+    Create thumbnail of image (same format as image, aspect ratio is kept).
+
+    @param file_name: File name of image.
+    @param thumbnail_name: File name of thumbnail.
+    @param size: Max width and height of thumbnail (pixels).
+    @return: File name of thumbnail, or None if the image cannot be read by PIL (e.g. SVG).
+    """
+
+    try:
+        image = Image.open(file_name)
+        image.thumbnail(size, Image.ANTIALIAS)
+        image.save(thumbnail_name, format=image.format)
+    except IOError:
+        return None
+
+    return thumbnail_name
+
+
+def create_thumbnails(file_names, size=THUMBNAIL_SIZE, directory=None, processes=None):
+    """
+    Create thumbnails of images (process pool, since decoding and resizing is CPU bound).
+    Existing thumbnails are not created again.
+
+    @param file_names: List of file names of images.
+    @param size: Max width and height of thumbnails (pixels).
+    @param directory: Directory of thumbnails (THUMBNAIL_DIRECTORY next to each image if None).
+    @param processes: Number of processes (number of cores if None).
+    @return: List of file names of thumbnails (None for images that are not thumbnailed).
+
+    >>> file_names, failed = download_files(files, 'images')
+    >>> thumbnail_names = create_thumbnails(file_names)
+    """
+
+    if Image is None:
+        raise ImportError('PIL is required to create thumbnails')
+
+    thumbnail_names = []
+    for file_name in file_names:
+        thumbnail_directory = directory or os.path.join(os.path.dirname(file_name), THUMBNAIL_DIRECTORY)
+        if not os.path.isdir(thumbnail_directory):
+            os.makedirs(thumbnail_directory)
+        thumbnail_names.append(os.path.join(thumbnail_directory, os.path.basename(file_name)))
+
+    results = dict((thumbnail_name, thumbnail_name) for thumbnail_name in thumbnail_names
+                   if os.path.isfile(thumbnail_name))
+
+    missing = [(file_name, thumbnail_name) for file_name, thumbnail_name in zip(file_names, thumbnail_names)
+               if thumbnail_name not in results]
+
+    if missing:
+        with ProcessPoolExecutor(processes) as executor:
+            futures = [(thumbnail_name, executor.submit(create_thumbnail, file_name, thumbnail_name, size))
+                       for file_name, thumbnail_name in missing]
+            for thumbnail_name, future in futures:
+                results[thumbnail_name] = future.result()
+
+    return [results[thumbnail_name] for thumbnail_name in thumbnail_names]
@@ -0,0 +1,151 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from node_store import NodeStore
+from osm_query import get_relation_full, get_relation_members, chain_ways, \
+    is_relation_in_db, save_relation_to_db, save_track_points_to_db
+from srtm_query import get_elevations, save_elevation_to_db
+from throttle import RateLimiter
+from track_metrics import track_metrics, save_track_metrics_to_db
+from trail_db import ensure_tables
+
+# Number of threads fetching relations, and max number of OSM API requests per second
+INGEST_MAX_WORKERS = 8
+INGEST_REQUESTS_PER_SECOND = 2.0
+
+
+def fetch_relation(relation_id, rate_limiter):
+    """
+    Read relation with ways and node coordinates from OSM API (rate limited).
+
+    @param relation_id: Id of relation.
+    @param rate_limiter: RateLimiter shared by fetching threads.
+    @return: Relation dictionary, dictionary of way dictionaries for way ids,
+             and NodeStore with coordinates of nodes.
+    """
+
+    rate_limiter.wait()
+
+    relation, ways, nodes = get_relation_full(relation_id)
+
+    if relation is None:
+        raise KeyError('Relation %s not found' % relation_id)
+
+    return relation, ways, NodeStore(
+        list(nodes), [node['lat'] for node in nodes.values()], [node['lon'] for node in nodes.values()]
+    )
+
+
+def process_relation(relation, ways, coordinates, start_node=None):
+    """
+    Create track points of relation, their elevations, and metrics of track (no requests
+    to OSM API).
+
+    @param relation: Relation dictionary.
+    @param ways: Dictionary of way dictionaries for way ids.
+    @param coordinates: NodeStore with coordinates of nodes.
+    @param start_node: Start node of track (begin node of first way if None).
+    @return: List of track points, dictionary of elevations for track points, and
+             TrackMetrics (None if relation has no ways).
+    """
+
+    df, l_nodes = get_relation_members(relation, d_ways=ways)
+
+    if not l_nodes:
+        return [], {}, None
+
+    if start_node is None:
+        start_node = l_nodes[0][0]
+
+    track_points = chain_ways(map(int, df.way), l_nodes, start_node).track_points
+
+    lat, lon = coordinates.lookup(track_points)
+    elevations = get_elevations(lat, lon, interpolate=True)
+
+    elevation = {nd: (None if np.isnan(value) else value) for nd, value in zip(track_points, elevations.tolist())}
+
+    return track_points, elevation, track_metrics(track_points, lat, lon, elevations)
+
+
+def ingest_relations(engine, relation_ids, start_nodes=None, max_workers=INGEST_MAX_WORKERS,
+                     requests_per_second=INGEST_REQUESTS_PER_SECOND, processes=None, incremental=False):
+    """
+    Ingest relations: read relations (thread pool, rate limited), create track points,
+    elevations, and metrics (process pool), and save them with relations to database
+    (single writer, this thread). The stages overlap, so relations are written as soon
+    as they are processed.
+
+    @param engine: Database engine.
+    @param relation_ids: List of relation ids.
+    @param start_nodes: Dictionary of start nodes for relation ids (default is begin node of first way).
+    @param max_workers: Number of threads reading from OSM API.
+    @param requests_per_second: Max number of requests per second to OSM API.
+    @param processes: Number of processes (number of cores if None).
+    @param incremental: Only process and write relations with new OSM versions (versions are
+                        compared with the relation and ways read, without further requests).
+    @return: List of ingested relation ids (unchanged relations are left out if incremental),
+             and dictionary of errors for failed relation ids.
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> ingested, failed = ingest_relations(engine, [660162, 4570739], {4570739: 1458482713})
+    """
+
+    ensure_tables(engine)
+
+    start_nodes = start_nodes or {}
+    rate_limiter = RateLimiter(requests_per_second)
+
+    ingested, failed = [], {}
+
+    with ThreadPoolExecutor(max_workers) as fetch_pool, ProcessPoolExecutor(processes) as process_pool:
+
+        tasks = {}
+        for relation_id in relation_ids:
+            tasks[fetch_pool.submit(fetch_relation, relation_id, rate_limiter)] = ('fetch', relation_id, None)
+
+        pending = set(tasks)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, relation_id, fetched = tasks.pop(future)
+
+                try:
+                    result = future.result()
+
+                    if stage == 'fetch':
+                        relation, ways, coordinates = result
+                        if incremental and is_relation_in_db(engine, relation, ways):
+                            continue
+                        future = process_pool.submit(
+                            process_relation, relation, ways, coordinates, start_nodes.get(relation_id)
+                        )
+                        tasks[future] = ('process', relation_id, (relation, ways))
+                        pending.add(future)
+                    else:
+                        relation, ways = fetched
+                        track_points, elevation, metrics = result
+                        save_relation_to_db(engine, relation, d_ways=ways)
+                        save_track_points_to_db(engine, relation_id, track_points)
+                        save_elevation_to_db(engine, relation_id, elevation)
+                        if metrics is not None:
+                            save_track_metrics_to_db(engine, relation_id, metrics)
+                        ingested.append(relation_id)
+
+                except Exception as e:
+                    failed[relation_id] = e
+
+    return ingested, failed
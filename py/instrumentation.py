@@ -0,0 +1,383 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import os
+import json
+import time
+import bisect
+import threading
+
+from collections import defaultdict
+from functools import wraps
+
+# Instrumentation is off unless environment variable HIKEPY_INSTRUMENTATION is set (e.g. to 1),
+# or enable_instrumentation is called. When off, instrumented functions cost one flag test.
+instrumentation_enabled = os.environ.get('HIKEPY_INSTRUMENTATION', '0') not in ('', '0')
+
+# Upper bounds (seconds) of buckets of latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix of metric names (Prometheus text format)
+METRIC_PREFIX = 'hikepy_'
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets (and number of calls, errors, and total time).
+
+    >>> histogram = Histogram()
+    >>> histogram.observe(0.02)
+    >>> histogram.count, histogram.cumulative()[-1]
+    (1, 1)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def cumulative(self):
+        """
+        Get cumulative bucket counts (last bucket is +Inf, i.e. number of calls).
+
+        @return: List of counts.
+        """
+
+        counts, n = [], 0
+        for value in self.counts:
+            n += value
+            counts.append(n)
+
+        return counts
+
+
+class Metrics(object):
+    """
+    Metrics of this process: latency histograms of functions, requests and bytes received
+    of services, cache lookups (hits, misses, ...), and retries of services.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(Histogram)
+            self.requests = defaultdict(lambda: [0, 0])
+            self.caches = defaultdict(lambda: defaultdict(int))
+            self.retries = defaultdict(int)
+
+    def observe_call(self, name, seconds, error=False):
+        with self.lock:
+            self.calls[name].observe(seconds, error)
+
+    def count_request(self, service, n_bytes):
+        with self.lock:
+            counters = self.requests[service]
+            counters[0] += 1
+            counters[1] += n_bytes
+
+    def count_cache(self, cache, result, n):
+        with self.lock:
+            self.caches[cache][result] += n
+
+    def count_retry(self, service, n):
+        with self.lock:
+            self.retries[service] += n
+
+
+metrics = Metrics()
+
+# Functions cached with lru_cache (hits and misses are read from cache_info in snapshots)
+lru_cached_functions = {}
+
+
+def enable_instrumentation(enabled=True):
+    """
+    Turn instrumentation on (or off). Metrics collected so far are kept.
+
+    @param enabled: Instrumentation is on if True.
+
+    >>> enable_instrumentation()
+    >>> relation, ways, nodes = get_relation_full(660162)
+    >>> print(to_prometheus())
+    """
+
+    global instrumentation_enabled
+
+    instrumentation_enabled = enabled
+
+
+def reset_instrumentation():
+    """
+    Remove all collected metrics.
+    """
+
+    metrics.reset()
+
+
+def instrumented(name):
+    """
+    Decorator recording latency (and errors) of calls of function in a histogram.
+
+    @param name: Name of function in metrics, e.g. 'osm_query.get_way_by_id'.
+    @return: Decorator.
+
+    >>> @instrumented('osm_query.get_node_by_id')
+    ... def get_node_by_id(node_id):
+    ...     return osm_api.NodeGet(node_id)
+    """
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrumentation_enabled:
+                return function(*args, **kwargs)
+
+            start = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except:
+                metrics.observe_call(name, time.time() - start, True)
+                raise
+            metrics.observe_call(name, time.time() - start)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def count_request(service, n_bytes=0):
+    """
+    Count request sent to service, and bytes received.
+
+    @param service: Name of service, e.g. 'osm', 'overpass', or 'wikipedia'.
+    @param n_bytes: Size of response body (bytes).
+    """
+
+    if instrumentation_enabled:
+        metrics.count_request(service, n_bytes)
+
+
+def count_response(service, response, stream=False):
+    """
+    Count request sent to service, and bytes received (requests hook).
+
+    @param service: Name of service.
+    @param response: requests Response.
+    @param stream: Response is streamed (bytes are counted only if Content-Length is known,
+                   since reading the body here would consume the stream).
+    @return: None (response is not replaced).
+    """
+
+    if instrumentation_enabled:
+        n_bytes = response.headers.get('Content-Length')
+        if n_bytes is not None:
+            n_bytes = int(n_bytes)
+        else:
+            n_bytes = 0 if stream else len(response.content)
+        metrics.count_request(service, n_bytes)
+
+
+def instrument_session(session, service):
+    """
+    Count requests and bytes received by requests session.
+
+    @param session: requests Session.
+    @param service: Name of service.
+    @return: Session.
+
+    >>> session = instrument_session(osm_api._session, 'osm')
+    """
+
+    session.hooks['response'].append(
+        lambda response, *args, **kwargs: count_response(service, response, kwargs.get('stream', False))
+    )
+
+    return session
+
+
+def count_cache(cache, result, n=1):
+    """
+    Count cache lookups.
+
+    @param cache: Name of cache, e.g. 'way' or 'srtm_tiles'.
+    @param result: Result of lookups, e.g. 'hit' or 'miss'.
+    @param n: Number of lookups.
+    """
+
+    if instrumentation_enabled and n:
+        metrics.count_cache(cache, result, n)
+
+
+def count_retry(service, n=1):
+    """
+    Count retried requests of service.
+
+    @param service: Name of service.
+    @param n: Number of retries.
+    """
+
+    if instrumentation_enabled:
+        metrics.count_retry(service, n)
+
+
+def watch_lru_cache(name, function):
+    """
+    Include hits and misses of function cached with lru_cache in snapshots (read from
+    cache_info, so watching costs nothing per call).
+
+    @param name: Name of cache.
+    @param function: Function decorated with lru_cache.
+    @return: Function.
+    """
+
+    lru_cached_functions[name] = function
+
+    return function
+
+
+def hit_ratio(results):
+    """
+    Get ratio of cache lookups that are hits. Other results than hits and misses (e.g.
+    revalidations of stale entries) are not counted.
+
+    >>> hit_ratio({'hit': 3, 'miss': 1, 'revalidated': 4})
+    0.75
+    """
+
+    n_lookups = results.get('hit', 0) + results.get('miss', 0)
+
+    return float(results.get('hit', 0)) / n_lookups if n_lookups else 0.0
+
+
+def snapshot():
+    """
+    Get snapshot of metrics.
+
+    @return: Dictionary with calls (count, errors, total and mean seconds, and cumulative
+             bucket counts of each function), requests (requests and bytes of each service),
+             caches (lookups and hit ratio of each cache), and retries (of each service).
+
+    >>> snapshot()['calls']['osm_query.get_relation_full']['count']
+    1
+    """
+
+    with metrics.lock:
+        calls = dict(
+            (name, {'count': histogram.count,
+                    'errors': histogram.errors,
+                    'seconds': histogram.sum,
+                    'mean_seconds': histogram.sum / histogram.count if histogram.count else 0.0,
+                    'buckets': zip(list(histogram.buckets) + ['+Inf'], histogram.cumulative())})
+            for name, histogram in metrics.calls.items()
+        )
+        requests = dict((service, {'requests': n_requests, 'bytes': n_bytes})
+                        for service, (n_requests, n_bytes) in metrics.requests.items())
+        caches = dict((cache, dict(results)) for cache, results in metrics.caches.items())
+        retries = dict(metrics.retries)
+
+    for name, function in lru_cached_functions.items():
+        info = function.cache_info()
+        if info.hits or info.misses:
+            caches['lru:' + name] = {'hit': info.hits, 'miss': info.misses}
+
+    for results in caches.values():
+        results['hit_ratio'] = hit_ratio(results)
+
+    return {'enabled': instrumentation_enabled, 'time': time.time(),
+            'calls': calls, 'requests': requests, 'caches': caches, 'retries': retries}
+
+
+def to_json(indent=None):
+    """
+    Export snapshot of metrics as JSON.
+
+    @param indent: Indent of JSON (compact if None).
+    @return: JSON string.
+    """
+
+    return json.dumps(snapshot(), indent=indent, sort_keys=True)
+
+
+def format_labels(**labels):
+    """
+    Format labels of metric (Prometheus text format).
+
+    >>> format_labels(function='osm_query.get_way_by_id', le='0.1')
+    '{function="osm_query.get_way_by_id",le="0.1"}'
+    """
+
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def to_prometheus():
+    """
+    Export snapshot of metrics in Prometheus text format.
+
+    @return: String.
+    """
+
+    metric = snapshot()
+
+    lines = []
+
+    def add(name, kind, help_text, samples):
+        lines.append('# HELP %s%s %s' % (METRIC_PREFIX, name, help_text))
+        lines.append('# TYPE %s%s %s' % (METRIC_PREFIX, name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s%s %s' % (METRIC_PREFIX, name, suffix, format_labels(**labels), repr(value)))
+
+    samples = []
+    for function, call in sorted(metric['calls'].items()):
+        for upper_bound, n in call['buckets']:
+            samples.append(('_bucket', {'function': function, 'le': upper_bound}, n))
+        samples.append(('_sum', {'function': function}, call['seconds']))
+        samples.append(('_count', {'function': function}, call['count']))
+    add('call_duration_seconds', 'histogram', 'Latency of calls.', samples)
+
+    add('call_errors_total', 'counter', 'Calls raising exceptions.',
+        [('', {'function': function}, call['errors']) for function, call in sorted(metric['calls'].items())])
+
+    add('requests_total', 'counter', 'Requests sent to services.',
+        [('', {'service': service}, counters['requests'])
+         for service, counters in sorted(metric['requests'].items())])
+
+    add('response_bytes_total', 'counter', 'Bytes received from services.',
+        [('', {'service': service}, counters['bytes']) for service, counters in sorted(metric['requests'].items())])
+
+    add('cache_lookups_total', 'counter', 'Cache lookups by result.',
+        [('', {'cache': cache, 'result': result}, n) for cache, results in sorted(metric['caches'].items())
+         for result, n in sorted(results.items()) if result != 'hit_ratio'])
+
+    add('cache_hit_ratio', 'gauge', 'Ratio of cache lookups that are hits (of hits and misses).',
+        [('', {'cache': cache}, results['hit_ratio']) for cache, results in sorted(metric['caches'].items())])
+
+    add('retries_total', 'counter', 'Retried requests.',
+        [('', {'service': service}, n) for service, n in sorted(metric['retries'].items())])
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,89 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import importlib
+import threading
+
+
+class LazyObject(object):
+    """
+    Proxy of an object created on first use (first attribute access), e.g. an API client
+    that should not be created when a module is imported.
+
+    >>> osm_api = LazyObject(lambda: osmapi.OsmApi(api=OSM_API_URL))
+    >>> node = osm_api.NodeGet(652065750)  # OsmApi is created here
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_object', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _resolve(self):
+        """
+        Get object (created by factory on first call).
+
+        @return: Object.
+        """
+
+        obj = object.__getattribute__(self, '_object')
+        if obj is None:
+            with object.__getattribute__(self, '_lock'):
+                obj = object.__getattribute__(self, '_object')
+                if obj is None:
+                    obj = object.__getattribute__(self, '_factory')()
+                    object.__setattr__(self, '_object', obj)
+
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        obj = object.__getattribute__(self, '_object')
+        return '<lazy %r>' % obj if obj is not None else '<lazy object (not created)>'
+
+
+class LazyModule(LazyObject):
+    """
+    Proxy of a module imported on first use (first attribute access), so that modules
+    with heavy dependencies can be imported quickly.
+
+    >>> pd = LazyModule('pandas')
+    >>> df = pd.DataFrame([1, 2, 3])  # pandas is imported here
+    """
+
+    def __init__(self, name):
+        LazyObject.__init__(self, lambda: importlib.import_module(name))
+        object.__setattr__(self, '__name__', name)
+
+    def __repr__(self):
+        return '<lazy module %r>' % object.__getattribute__(self, '__name__')
+
+
+def lazy_import(name):
+    """
+    Import module on first use.
+
+    @param name: Name of module (e.g. 'pandas' or 'pattern.web').
+    @return: LazyModule.
+
+    >>> pd = lazy_import('pandas')
+    """
+
+    return LazyModule(name)
@@ -0,0 +1,265 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import threading
+import numpy as np
+
+
+def node_dtype(coordinate_dtype=np.float64):
+    """
+    Get record type of node store (OSM node id, latitude, and longitude).
+
+    @param coordinate_dtype: Type of coordinates (float32 saves memory, but is only accurate
+                             to about a meter).
+    @return: Numpy dtype.
+    """
+
+    return np.dtype([('id', np.int64), ('lat', coordinate_dtype), ('lon', coordinate_dtype)])
+
+
+def search_nodes(data, ids):
+    """
+    Get positions of nodes in array of node records (binary search).
+
+    @param data: Array of node records sorted by id.
+    @param ids: Array of OSM node ids.
+    @return: Array of positions, and boolean array (True for nodes in data).
+    """
+
+    ids = np.asarray(ids, dtype=np.int64)
+    if not data.size:
+        return np.zeros(ids.size, dtype=np.intp), np.zeros(ids.size, dtype=bool)
+
+    position = np.minimum(np.searchsorted(data['id'], ids), data.size - 1)
+
+    return position, data['id'][position] == ids
+
+
+def merge_nodes(older, newer):
+    """
+    Merge arrays of node records sorted by id (coordinates of newer are kept for duplicate ids).
+
+    @param older: Array of node records sorted by id.
+    @param newer: Array of node records sorted by id.
+    @return: Array of node records sorted by id.
+    """
+
+    # Newer coordinates first, so that np.unique keeps them for duplicate ids
+    data = np.concatenate([newer, older])
+    _, index = np.unique(data['id'], return_index=True)
+
+    return data[index]
+
+
+class NodeStore(object):
+    """
+    Coordinates of OSM nodes in an array of records sorted by node id (batch lookups by
+    binary search). The array can be saved to file and memory-mapped.
+
+    Added nodes are kept in memory apart from the (memory-mapped) base array: batches are
+    appended to a pending list, and merged into sorted runs on lookup. A run is merged with
+    the previous run while it is at least half its size, so each node is merged a logarithmic
+    number of times and lookups search few runs (newest first, then the base array).
+
+    >>> node_store = NodeStore([3, 1], [59.2, 59.0], [18.2, 18.0])
+    >>> lat, lon = node_store.lookup([1, 2, 3])
+    >>> lat
+    array([59. ,  nan, 59.2])
+    """
+
+    def __init__(self, ids=(), lat=(), lon=(), coordinate_dtype=np.float64):
+        self.lock = threading.Lock()
+        self.data = np.zeros(0, dtype=node_dtype(coordinate_dtype))
+        self.runs = []
+        self.pending = []
+
+        self.add(ids, lat, lon)
+
+    def __len__(self):
+        added = self.compact()
+
+        return self.data.size + int(np.count_nonzero(~search_nodes(self.data, added['id'])[1]))
+
+    def __getstate__(self):
+        return {'data': self.merged()}
+
+    def __setstate__(self, state):
+        self.lock = threading.Lock()
+        self.data = state['data']
+        self.runs = []
+        self.pending = []
+
+    @classmethod
+    def load(cls, file_name, mmap=True):
+        """
+        Load node store from file.
+
+        @param file_name: File name (.npy).
+        @param mmap: Memory-map file (read-only, added nodes are kept in memory).
+        @return: NodeStore.
+        """
+
+        node_store = cls()
+        node_store.data = np.load(file_name, mmap_mode='r' if mmap else None)
+
+        return node_store
+
+    def save(self, file_name):
+        """
+        Save node store to file (base array merged with added nodes).
+
+        @param file_name: File name (.npy).
+        """
+
+        np.save(file_name, self.merged())
+
+    def add(self, ids, lat, lon):
+        """
+        Add (or update) coordinates of nodes.
+
+        @param ids: Array of OSM node ids.
+        @param lat: Array of latitudes.
+        @param lon: Array of longitudes.
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+        if not ids.size:
+            return
+
+        added = np.zeros(ids.size, dtype=self.data.dtype)
+        added['id'], added['lat'], added['lon'] = ids, lat, lon
+
+        with self.lock:
+            self.pending.append(added)
+
+    def merge_pending(self):
+        # Called with lock held. Newest batch (and last of duplicate ids in a batch) first,
+        # so that np.unique keeps their coordinates
+        if not self.pending:
+            return
+
+        data = np.concatenate([batch[::-1] for batch in reversed(self.pending)])
+        _, index = np.unique(data['id'], return_index=True)
+        run = data[index]
+        self.pending = []
+
+        while self.runs and 2 * run.size >= self.runs[-1].size:
+            run = merge_nodes(self.runs.pop(), run)
+        self.runs.append(run)
+
+    def arrays(self):
+        """
+        Merge pending batches into sorted runs.
+
+        @return: List of arrays of node records sorted by id (newest first, base array last).
+        """
+
+        with self.lock:
+            self.merge_pending()
+
+            return self.runs[::-1] + [self.data]
+
+    def compact(self):
+        """
+        Merge added nodes into one sorted run.
+
+        @return: Array of added node records sorted by id.
+        """
+
+        with self.lock:
+            self.merge_pending()
+
+            added = np.zeros(0, dtype=self.data.dtype)
+            for run in self.runs:
+                added = merge_nodes(added, run)
+            self.runs = [added] if added.size else []
+
+        return added
+
+    def merged(self):
+        """
+        Get base array merged with added nodes.
+
+        @return: Array of node records sorted by id.
+        """
+
+        added = self.compact()
+
+        return merge_nodes(np.asarray(self.data), added) if added.size else np.asarray(self.data)
+
+    def contains(self, ids):
+        """
+        Check if nodes are in node store.
+
+        @param ids: Array of OSM node ids.
+        @return: Boolean array (True for nodes in node store).
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+
+        found = np.zeros(ids.size, dtype=bool)
+        for data in self.arrays():
+            found |= search_nodes(data, ids)[1]
+
+        return found
+
+    def lookup(self, ids):
+        """
+        Get coordinates of nodes (NaN for nodes not in node store).
+
+        @param ids: Array of OSM node ids.
+        @return: Arrays of latitudes and longitudes.
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+
+        lat = np.full(ids.size, np.nan)
+        lon = np.full(ids.size, np.nan)
+        missing = np.ones(ids.size, dtype=bool)
+        for data in self.arrays():
+            position, found = search_nodes(data, ids)
+            found &= missing
+            lat[found] = data['lat'][position[found]]
+            lon[found] = data['lon'][position[found]]
+            missing &= ~found
+
+        return lat, lon
+
+
+node_store = NodeStore()
+
+
+def get_node_store():
+    """
+    Get default node store.
+
+    @return: NodeStore.
+    """
+
+    return node_store
+
+
+def set_node_store(store):
+    """
+    Set default node store, e.g. a memory-mapped node store saved after an import.
+
+    @param store: NodeStore.
+    @return: NodeStore.
+
+    >>> node_store = set_node_store(NodeStore.load('nodes.npy'))
+    """
+
+    global node_store
+
+    node_store = store
+
+    return node_store
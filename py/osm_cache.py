@@ -0,0 +1,374 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import os
+import time
+import sqlite3
+import threading
+import cPickle as pickle
+
+from contextlib import contextmanager
+from functools import wraps
+
+from instrumentation import count_cache
+
+# Cache file (can be set with environment variable HIKEPY_OSM_CACHE)
+OSM_CACHE_FILE = os.environ.get(
+    'HIKEPY_OSM_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hikepy', 'osm_cache.sqlite')
+)
+
+# Entries written with another cache version are treated as missing
+OSM_CACHE_VERSION = 1
+
+# Time to live (seconds) and max number of entries (a count, not bytes: a large entry, e.g. a
+# Wikipedia response, counts as one entry like a node)
+OSM_CACHE_TTL = 7 * 24 * 3600
+OSM_CACHE_MAX_ENTRIES = 1000000
+
+# Check size of cache every OSM_CACHE_EVICT_INTERVAL writes, and evict down to OSM_CACHE_EVICT_RATIO
+OSM_CACHE_EVICT_INTERVAL = 1000
+OSM_CACHE_EVICT_RATIO = 0.9
+
+# Access times of cache hits are kept in memory, and written in one transaction when
+# OSM_CACHE_ACCESS_FLUSH_SIZE are pending or OSM_CACHE_ACCESS_FLUSH_INTERVAL seconds have passed
+# (and before eviction), so reads do not take the write lock of the cache file
+OSM_CACHE_ACCESS_FLUSH_SIZE = 10000
+OSM_CACHE_ACCESS_FLUSH_INTERVAL = 60.0
+
+# Max number of variables in each SQL statement
+SQLITE_MAX_VARIABLES = 900
+
+
+@contextmanager
+def transaction(connection):
+    """
+    Run statements in one (immediate) transaction on connection in autocommit mode.
+
+    @param connection: SQLite connection (isolation_level=None).
+    """
+
+    connection.execute('begin immediate')
+    try:
+        yield connection
+    except:
+        connection.execute('rollback')
+        raise
+    connection.execute('commit')
+
+
+class EntityCache(object):
+    """
+    Persistent (SQLite) cache of OSM entities keyed by type (kind) and id.
+
+    The cache file can be shared by threads and worker processes (WAL mode, one connection
+    per thread and process). Entries expire after ttl seconds or when the cache version
+    changes, and the least recently used entries are evicted when the cache grows
+    beyond max_entries, whatever their size (access times are written in batches, see
+    flush). Pinned entries (e.g. imported from an OSM extract) never expire and are not
+    evicted.
+
+    >>> cache = EntityCache('/tmp/osm_cache.sqlite')
+    >>> cache.put('node', 652065750, {'id': 652065750, 'lat': 59.2766213, 'lon': 18.1870509})
+    >>> cache.get('node', 652065750)['lat']
+    59.2766213
+    >>> cache.statistics()['hits']
+    1
+    """
+
+    def __init__(self, file_name=OSM_CACHE_FILE, ttl=OSM_CACHE_TTL, max_entries=OSM_CACHE_MAX_ENTRIES,
+                 version=OSM_CACHE_VERSION):
+        self.file_name = file_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = version
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        self.accessed = {}
+        self.flushed = time.time()
+
+        directory = os.path.dirname(file_name)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        self.create_table()
+
+    def connection(self):
+        """
+        Get connection of current thread (and process).
+
+        @return: SQLite connection.
+        """
+
+        pid = os.getpid()
+
+        if getattr(self.local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.file_name, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection, self.local.pid = connection, pid
+
+        return self.local.connection
+
+    def create_table(self):
+        connection = self.connection()
+        connection.execute(
+            'create table if not exists entities ('
+            'kind text not null, key text not null, version integer not null, '
+            'expires real, accessed real not null, value blob not null, '
+            'primary key (kind, key))'
+        )
+        connection.execute('create index if not exists entities_accessed on entities (accessed)')
+
+    def get(self, kind, key, default=None):
+        """
+        Get entity from cache.
+
+        @param kind: Type of entity (e.g. 'node', 'way', or 'relation').
+        @param key: Id of entity.
+        @param default: Value returned if entity is not in cache.
+        @return: Entity (or default).
+        """
+
+        return self.get_many(kind, [key]).get(key, default)
+
+    def get_many(self, kind, keys):
+        """
+        Get entities from cache.
+
+        @param kind: Type of entity.
+        @param keys: List of ids.
+        @return: Dictionary of entities for ids found in cache.
+        """
+
+        keys = list(keys)
+        d_keys = dict((str(key), key) for key in keys)
+
+        now = time.time()
+        connection = self.connection()
+
+        values = {}
+        str_keys = list(d_keys)
+        for i in range(0, len(str_keys), SQLITE_MAX_VARIABLES):
+            chunk = str_keys[i:i + SQLITE_MAX_VARIABLES]
+            rows = connection.execute(
+                'select key, value from entities where kind = ? and version = ? '
+                'and (expires is null or expires > ?) and key in (' + ','.join('?' * len(chunk)) + ')',
+                [kind, self.version, now] + chunk
+            ).fetchall()
+            for key, value in rows:
+                values[d_keys[key]] = pickle.loads(str(value))
+
+        # Hits and misses are counted once for each unique key
+        with self.lock:
+            self.hits += len(values)
+            self.misses += len(d_keys) - len(values)
+
+            for key in values:
+                self.accessed[(kind, str(key))] = now
+            flush = len(self.accessed) >= OSM_CACHE_ACCESS_FLUSH_SIZE or \
+                now - self.flushed >= OSM_CACHE_ACCESS_FLUSH_INTERVAL
+
+        if flush:
+            self.flush()
+
+        count_cache(kind, 'hit', len(values))
+        count_cache(kind, 'miss', len(d_keys) - len(values))
+
+        return values
+
+    def flush(self):
+        """
+        Write pending access times of cache hits (in one transaction).
+        """
+
+        with self.lock:
+            accessed, self.accessed = self.accessed, {}
+            self.flushed = time.time()
+
+        if accessed:
+            with transaction(self.connection()) as connection:
+                connection.executemany(
+                    'update entities set accessed = ? where kind = ? and key = ? and accessed < ?',
+                    [(access_time, kind, key, access_time) for (kind, key), access_time in accessed.items()]
+                )
+
+    def put(self, kind, key, value, ttl=None, pinned=False):
+        """
+        Put entity in cache.
+
+        @param kind: Type of entity.
+        @param key: Id of entity.
+        @param value: Entity.
+        @param ttl: Time to live in seconds (cache ttl if None).
+        @param pinned: Entity never expires and is not evicted.
+        """
+
+        self.put_many(kind, {key: value}, ttl, pinned)
+
+    def put_many(self, kind, values, ttl=None, pinned=False):
+        """
+        Put entities in cache (in one transaction).
+
+        @param kind: Type of entity.
+        @param values: Dictionary of entities for ids.
+        @param ttl: Time to live in seconds (cache ttl if None).
+        @param pinned: Entities never expire and are not evicted.
+        """
+
+        if not values:
+            return
+
+        now = time.time()
+        expires = None if pinned else now + (self.ttl if ttl is None else ttl)
+
+        rows = [(kind, str(key), self.version, expires, now,
+                 sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+                for key, value in values.items()]
+
+        with transaction(self.connection()) as connection:
+            connection.executemany('insert or replace into entities values (?, ?, ?, ?, ?, ?)', rows)
+
+        with self.lock:
+            writes = self.writes
+            self.writes += len(rows)
+
+        if writes // OSM_CACHE_EVICT_INTERVAL != self.writes // OSM_CACHE_EVICT_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries, and least recently used entries if cache is full
+        (pinned entries are not counted).
+        """
+
+        self.flush()
+
+        with transaction(self.connection()) as connection:
+            n_expired = connection.execute(
+                'delete from entities where expires <= ? or version != ?', (time.time(), self.version)
+            ).rowcount
+
+            n_entries = connection.execute(
+                'select count(*) from entities where expires is not null'
+            ).fetchone()[0]
+            n_evict = n_entries - int(self.max_entries * OSM_CACHE_EVICT_RATIO) if n_entries > self.max_entries else 0
+            if n_evict > 0:
+                connection.execute(
+                    'delete from entities where rowid in '
+                    '(select rowid from entities where expires is not null order by accessed limit ?)', (n_evict,)
+                )
+
+        with self.lock:
+            self.evictions += n_expired + max(n_evict, 0)
+
+    def clear(self):
+        """
+        Remove all entries, and reset statistics.
+        """
+
+        self.connection().execute('delete from entities')
+
+        with self.lock:
+            self.accessed = {}
+            self.hits = 0
+            self.misses = 0
+
+    def statistics(self):
+        """
+        Get cache statistics (of this process).
+
+        @return: Dictionary with hits, misses, hit rate, writes, evictions, and number of entries.
+        """
+
+        n_lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / n_lookups if n_lookups else 0.0,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'entries': self.connection().execute('select count(*) from entities').fetchone()[0]}
+
+
+entity_cache = None
+
+
+def get_entity_cache():
+    """
+    Get the default entity cache (created on first use).
+
+    @return: EntityCache object.
+    """
+
+    global entity_cache
+
+    if entity_cache is None:
+        entity_cache = EntityCache()
+
+    return entity_cache
+
+
+def set_entity_cache(cache):
+    """
+    Set the default entity cache, e.g. EntityCache('/tmp/test_cache.sqlite').
+
+    @param cache: EntityCache object.
+    @return: EntityCache object.
+    """
+
+    global entity_cache
+
+    entity_cache = cache
+
+    return entity_cache
+
+
+def cached_entity(kind):
+    """
+    Decorator caching results of a function of one key (e.g. an OSM id) in the entity cache.
+
+    @param kind: Type of entity.
+    @return: Decorator.
+
+    >>> @cached_entity('node')
+    ... def get_node_by_id(node_id):
+    ...     return osm_api.NodeGet(node_id)
+    """
+
+    missing = object()
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(key):
+            cache = get_entity_cache()
+
+            value = cache.get(kind, key, missing)
+            if value is missing:
+                value = function(key)
+                cache.put(kind, key, value)
+
+            return value
+
+        return wrapper
+
+    return decorator
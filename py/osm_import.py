@@ -0,0 +1,242 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import bz2
+import gzip
+import warnings
+
+from node_store import get_node_store
+from osm_cache import get_entity_cache
+from osm_query import save_relation_to_db, is_offline, set_offline
+from osm_xml import iter_osm_elements
+
+# Reading .osm.pbf extracts requires pyosmium (pip install osmium)
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+# Values of route tag of imported relations
+OSM_IMPORT_ROUTES = ('hiking', 'foot')
+
+# Number of entities written to entity cache at once
+OSM_IMPORT_BATCH = 10000
+
+# Member types of pyosmium relations
+OSMIUM_MEMBER_TYPES = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+
+def open_extract(file_name):
+    """
+    Open OSM XML extract (optionally compressed with bzip2 or gzip).
+
+    @param file_name: File name of extract (.osm, .osm.bz2, or .osm.gz).
+    @return: File object.
+    """
+
+    if file_name.endswith('.bz2'):
+        return bz2.BZ2File(file_name)
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name)
+
+    return open(file_name, 'rb')
+
+
+def osmium_to_dict(element_type, obj):
+    """
+    Convert pyosmium object into dictionary (as in dictionaries from osmapi).
+
+    @param element_type: Type of element ('node', 'way', or 'relation').
+    @param obj: pyosmium object (only valid within handler callback).
+    @return: Dictionary of element.
+    """
+
+    data = {'id': obj.id,
+            'tag': dict((tag.k, tag.v) for tag in obj.tags),
+            'version': obj.version,
+            'changeset': obj.changeset,
+            'uid': obj.uid,
+            'user': obj.user,
+            'visible': obj.visible,
+            'timestamp': obj.timestamp.replace(tzinfo=None)}
+
+    if element_type == 'node':
+        data['lat'] = obj.location.lat
+        data['lon'] = obj.location.lon
+    elif element_type == 'way':
+        data['nd'] = [nd.ref for nd in obj.nodes]
+    else:
+        data['member'] = [{'type': OSMIUM_MEMBER_TYPES[member.type], 'ref': member.ref, 'role': member.role}
+                          for member in obj.members]
+
+    return data
+
+
+def scan_pbf(file_name, element_type, callback, ids=None):
+    """
+    Stream-parse elements of one type from OSM PBF extract (requires pyosmium).
+
+    @param file_name: File name of extract (.osm.pbf).
+    @param element_type: Type of elements ('node', 'way', or 'relation').
+    @param callback: Function called with dictionary of each element.
+    @param ids: Set of ids of elements (all elements if None).
+    """
+
+    if osmium is None:
+        raise ImportError('pyosmium is required to read ' + file_name)
+
+    def element(obj):
+        if ids is None or obj.id in ids:
+            callback(osmium_to_dict(element_type, obj))
+
+    handler = osmium.SimpleHandler()
+    setattr(handler, element_type, element)
+    handler.apply_file(file_name, locations=False)
+
+
+def scan_extract(file_name, element_type, callback, ids=None):
+    """
+    Stream-parse elements of one type from OSM extract (XML or PBF) in constant memory.
+
+    @param file_name: File name of extract (.osm, .osm.bz2, .osm.gz, or .osm.pbf).
+    @param element_type: Type of elements ('node', 'way', or 'relation').
+    @param callback: Function called with dictionary of each element.
+    @param ids: Set of ids of elements (all elements if None).
+    """
+
+    if file_name.endswith('.pbf'):
+        return scan_pbf(file_name, element_type, callback, ids)
+
+    with open_extract(file_name) as source:
+        for _, data in iter_osm_elements(source, types=(element_type,)):
+            if ids is None or data['id'] in ids:
+                callback(data)
+
+
+def is_route(relation, routes=OSM_IMPORT_ROUTES):
+    """
+    Check if relation is a route relation.
+
+    @param relation: Relation dictionary.
+    @param routes: Values of route tag.
+    @return: True if route relation.
+
+    >>> is_route({'id': 1, 'tag': {'type': 'route', 'route': 'hiking'}})
+    True
+    """
+
+    tag = relation['tag']
+
+    return tag.get('type') == 'route' and tag.get('route') in routes
+
+
+def cache_members(file_name, element_type, ids):
+    """
+    Write elements with ids from OSM extract to entity cache (pinned, in batches), and
+    coordinates of nodes to node store.
+
+    @param file_name: File name of extract.
+    @param element_type: Type of elements ('node' or 'way').
+    @param ids: Set of ids of elements.
+    @return: Set of node ids of cached ways (empty for nodes), and set of ids missing in extract.
+    """
+
+    cache = get_entity_cache()
+    node_store = get_node_store()
+
+    node_ids = set()
+    missing = set(ids)
+    batch = {}
+
+    def flush():
+        cache.put_many(element_type, batch, pinned=True)
+        if element_type == 'node':
+            node_store.add(list(batch), [node['lat'] for node in batch.values()],
+                           [node['lon'] for node in batch.values()])
+        batch.clear()
+
+    def cache_member(data):
+        batch[data['id']] = data
+        missing.discard(data['id'])
+        if element_type == 'way':
+            node_ids.update(data['nd'])
+
+        if len(batch) >= OSM_IMPORT_BATCH:
+            flush()
+
+    scan_extract(file_name, element_type, cache_member, ids)
+    flush()
+
+    return node_ids, missing
+
+
+def import_extract(engine, file_name, routes=OSM_IMPORT_ROUTES):
+    """
+    Import route relations, with their ways and nodes, from OSM extract into entity cache
+    and database (e.g. for offline use, see osm_query.set_offline).
+
+    The extract is stream-parsed three times (relations, ways, and nodes), and only route
+    relations and their ways and nodes are kept, so memory use does not depend on size of
+    extract. Entities are pinned in the entity cache, i.e. they never expire, and node
+    coordinates are added to the node store (see node_store). Relations without name are
+    cached but not saved to database.
+
+    Relations are saved offline (see osm_query.set_offline), i.e. from the imported entities
+    only. Ways and nodes missing in the extract (e.g. of relations crossing its boundary)
+    are left out of the saved relations, and a warning is issued.
+
+    @param engine: Database engine.
+    @param file_name: File name of extract (.osm, .osm.bz2, .osm.gz, or .osm.pbf).
+    @param routes: Values of route tag of imported relations.
+    @return: List of imported relation ids.
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> relation_ids = import_extract(engine, 'sweden-latest.osm.pbf')
+    """
+
+    cache = get_entity_cache()
+
+    relations = {}
+
+    def add_relation(relation):
+        if is_route(relation, routes):
+            relations[relation['id']] = relation
+
+    scan_extract(file_name, 'relation', add_relation)
+
+    way_ids = set(member['ref'] for relation in relations.values()
+                  for member in relation['member'] if member['type'] == 'way')
+
+    node_ids, missing_ways = cache_members(file_name, 'way', way_ids)
+    _, missing_nodes = cache_members(file_name, 'node', node_ids)
+
+    cache.put_many('relation', relations, pinned=True)
+
+    if missing_ways or missing_nodes:
+        incomplete = sorted(relation_id for relation_id, relation in relations.items()
+                            if any(member['type'] == 'way' and member['ref'] in missing_ways
+                                   for member in relation['member']))
+        warnings.warn('%d ways and %d nodes of route relations are missing in %s (relations with missing ways: %s)'
+                      % (len(missing_ways), len(missing_nodes), file_name, incomplete))
+
+    offline = is_offline()
+    set_offline(True)
+    try:
+        relation_ids = []
+        for relation_id, relation in sorted(relations.items()):
+            if 'name' in relation['tag']:
+                save_relation_to_db(engine, relation, incremental=True)
+                relation_ids.append(relation_id)
+    finally:
+        set_offline(offline)
+
+    return relation_ids
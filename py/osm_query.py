@@ -11,24 +11,154 @@ __version__ = "0.1.0"
 __status__ = "Development"
 
 import numpy as np
-import pandas as pd
 import sqlite3
 
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools32 import lru_cache
 
-import LatLon
+from instrumentation import instrumented, watch_lru_cache
+from lazy_import import LazyObject, lazy_import
+from node_store import get_node_store
+from osm_cache import cached_entity, get_entity_cache
+from trail_db import ensure_tables, upsert_rows, select_relations, select_versions, select_relation_versions, \
+    split_by_key
+
+# Heavy dependencies are imported on first use (see lazy_import). numpy is imported eagerly:
+# node_store, trail_db, and default arguments (dtypes) use it at import time, and it imports
+# in well under a tenth of a second
+pd = lazy_import('pandas')
+
+LatLon = lazy_import('LatLon')
 
 # TODO Swedish map projections
-import sgcpy
+sgcpy = lazy_import('sgcpy')
+
+osmapi = lazy_import('osmapi')
+
+# API clients with retries, backoff, and adaptive concurrency limits (see transport)
+transport = lazy_import('transport')
+
+OSM_API_URL = 'https://www.openstreetmap.org'
+
+# Max number of ids in each multi-fetch request (nodes/ways), keeps URLs within API limits
+OSM_MULTI_FETCH_MAX = 500
+
+# Number of threads sending multi-fetch requests (requests in flight are limited by transport)
+OSM_MAX_WORKERS = 4
+
+# Status codes of elements that do not exist (404) or are deleted (410)
+OSM_MISSING_STATUS_CODES = (404, 410)
+
+
+def create_osm_api(api=OSM_API_URL):
+    """
+    Create OSM API client (failed requests are retried, see transport).
+
+    @param api: Url of OSM API.
+    @return: OSM API object.
+    """
+
+    return transport.OsmApiClient(api=api)
+
+
+def create_overpass_api(endpoint=None):
+    """
+    Create Overpass API client (failed queries are retried, see transport).
+
+    @param endpoint: Url of Overpass API interpreter (default endpoint of overpass if None).
+    @return: Overpass API object.
+    """
+
+    return transport.OverpassApiClient() if endpoint is None else transport.OverpassApiClient(endpoint=endpoint)
+
+
+# API clients are created on first use
+osm_api = LazyObject(create_osm_api)
+overpass_api = LazyObject(create_overpass_api)
+
+# Read entities from entity cache only (e.g. after importing an OSM extract, see osm_import)
+osm_offline = False
+
+
+def set_osm_api(api=OSM_API_URL):
+    """
+    Connect to OSM API, e.g. a local (stub) OSM API server.
+
+    Note that entities are cached on disk (see osm_cache), so use a separate entity cache
+    when connecting to a test server.
+
+    @param api: Url of OSM API.
+    @return: OSM API object.
+
+    >>> from osm_cache import EntityCache, set_entity_cache
+    >>> entity_cache = set_entity_cache(EntityCache('/tmp/test_osm_cache.sqlite'))
+    >>> osm_api = set_osm_api('http://localhost:8000')
+    """
+
+    global osm_api
+
+    osm_api = create_osm_api(api)
+
+    return osm_api
+
+
+def set_overpass_api(endpoint=None):
+    """
+    Connect to Overpass API, e.g. a local (stub) Overpass API server.
+
+    @param endpoint: Url of Overpass API interpreter (default endpoint of overpass if None).
+    @return: Overpass API object.
+
+    >>> overpass_api = set_overpass_api('http://localhost:8000/api/interpreter')
+    """
+
+    global overpass_api
+
+    overpass_api = create_overpass_api(endpoint)
+
+    return overpass_api
+
+
+def set_offline(offline=True):
+    """
+    Read entities from entity cache only, i.e. never from OSM API or Overpass API.
+
+    Entities missing in the entity cache raise KeyError (get_*_by_id, get_*_by_name), or
+    are left out (get_nodes_by_ids, get_ways_by_ids).
+
+    @param offline: Offline if True.
+
+    >>> relation_ids = import_extract(engine, 'sweden-latest.osm.pbf')
+    >>> set_offline()
+    >>> relation = get_relation_by_id(660162)
+    """
+
+    global osm_offline
+
+    osm_offline = offline
 
-# TODO Circular reference
-from gpx_trail import create_gpx_file_name
 
-import osmapi
-import overpass
+def is_offline():
+    """
+    Check if entities are read from entity cache only (see set_offline).
+
+    @return: True if offline.
+    """
+
+    return osm_offline
 
-osm_api = osmapi.OsmApi()
-overpass_api = overpass.API()
+
+def require_online(kind, key):
+    """
+    Raise KeyError if offline (entity is missing in entity cache).
+
+    @param kind: Type of entity.
+    @param key: Id or name of entity.
+    """
+
+    if osm_offline:
+        raise KeyError('%s %s not in entity cache (offline)' % (kind, key))
 
 
 @lru_cache(maxsize=128)
@@ -288,6 +418,13 @@ def query_id_to_osm(query_id, what='node', layer_code='M'):
            '&layers=' + layer_code
 
 
+# Hits and misses of lru caches are included in instrumentation snapshots
+for function in [bbox_min_max_to_south_north_west_east, bbox_south_north_west_east_to_min_max,
+                 bbox_min_max_to_bbox_south_south_north_north, bbox_south_south_north_north_to_min_max,
+                 convert_lat_lon, lat_lon_to_osm, bbox_to_osm, query_id_to_osm]:
+    watch_lru_cache('osm_query.' + function.__name__, function)
+
+
 def node_to_osm(node_id, layer_code='M', marker=False, zoom_level=14):
     """
     Ask openstreetmap.org to show a particular node.
@@ -304,9 +441,9 @@ def node_to_osm(node_id, layer_code='M', marker=False, zoom_level=14):
     """
 
     if marker:
-        node = get_node_by_id(node_id)
+        lat, lon = get_node_coordinates([node_id])
         return lat_lon_to_osm(
-            node['lat'], node['lon'], 'decimal degrees', layer_code, zoom_level
+            float(lat[0]), float(lon[0]), 'decimal degrees', layer_code, zoom_level
         )
     else:
         return query_id_to_osm(node_id, 'node', layer_code)
@@ -342,7 +479,8 @@ def relation_to_osm(relation_id, layer_code='M'):
     return query_id_to_osm(relation_id, 'relation', layer_code)
 
 
-@lru_cache(maxsize=128)
+@instrumented('osm_query.get_relation_by_id')
+@cached_entity('relation')
 def get_relation_by_id(relation_id):
     """
     Read relation from OSM API using relation id.
@@ -351,10 +489,13 @@ def get_relation_by_id(relation_id):
     @return: Relation dictionary.
     """
 
+    require_online('relation', relation_id)
+
     return osm_api.RelationGet(relation_id)
 
 
-@lru_cache(maxsize=128)
+@instrumented('osm_query.get_relation_by_name')
+@cached_entity('relation_name')
 def get_relation_by_name(relation_name):
     """
     Read relation from Overpass API using relation name.
@@ -363,10 +504,13 @@ def get_relation_by_name(relation_name):
     @return: Relation dictionary.
     """
 
+    require_online('relation_name', relation_name)
+
     return overpass_api.Get('relation["name"~"' + relation_name + '"]')
 
 
-@lru_cache(maxsize=2048)
+@instrumented('osm_query.get_way_by_id')
+@cached_entity('way')
 def get_way_by_id(way_id):
     """
     Read way from OSM API using way id.
@@ -375,10 +519,13 @@ def get_way_by_id(way_id):
     @return: Way dictionary.
     """
 
+    require_online('way', way_id)
+
     return osm_api.WayGet(way_id)
 
 
-@lru_cache(maxsize=4096)
+@instrumented('osm_query.get_node_by_id')
+@cached_entity('node')
 def get_node_by_id(node_id):
     """
     Read node from OSM API using node id.
@@ -387,10 +534,202 @@ def get_node_by_id(node_id):
     @return: Node dictionary.
     """
 
+    require_online('node', node_id)
+
     return osm_api.NodeGet(node_id)
 
 
-@lru_cache(maxsize=4096)
+def split_ids(ids, n=OSM_MULTI_FETCH_MAX):
+    """
+    Split list of ids into unique ids in chunks of (at most) n ids.
+
+    @param ids: List of ids.
+    @param n: Max number of ids in each chunk.
+    @return: List of chunks (lists of ids).
+
+    >>> split_ids([3, 1, 2, 3, 4], 2)
+    [[3, 1], [2, 4]]
+    """
+
+    seen = set()
+    unique_ids = [i for i in ids if not (i in seen or seen.add(i))]
+
+    return [unique_ids[i:i + n] for i in range(0, len(unique_ids), n)]
+
+
+def fetch_elements(fetch, ids):
+    """
+    Read elements with a multi-fetch request. A request fails if some element does not
+    exist, so failing requests are split until the missing elements are found, and only
+    those are left out (other errors are raised, after retries, see transport).
+
+    @param fetch: Multi-fetch function, e.g. osm_api.WaysGet.
+    @param ids: List of ids.
+    @return: Dictionary of element dictionaries for ids.
+    """
+
+    try:
+        return fetch(ids)
+    except osmapi.ApiError as e:
+        if e.status not in OSM_MISSING_STATUS_CODES:
+            raise
+
+    if len(ids) == 1:
+        return {}
+
+    middle = len(ids) // 2
+
+    elements = fetch_elements(fetch, ids[:middle])
+    elements.update(fetch_elements(fetch, ids[middle:]))
+
+    return elements
+
+
+def fetch_chunks(fetch, ids, max_workers=OSM_MAX_WORKERS):
+    """
+    Read elements with multi-fetch requests (OSM_MULTI_FETCH_MAX ids per request, sent
+    by a thread pool).
+
+    @param fetch: Multi-fetch function, e.g. osm_api.WaysGet.
+    @param ids: List of ids.
+    @param max_workers: Number of threads.
+    @return: List of dictionaries of element dictionaries for ids (one for each request).
+    """
+
+    chunks = split_ids(ids)
+    if len(chunks) <= 1:
+        return [fetch_elements(fetch, chunk) for chunk in chunks]
+
+    with ThreadPoolExecutor(min(max_workers, len(chunks))) as executor:
+        return list(executor.map(lambda chunk: fetch_elements(fetch, chunk), chunks))
+
+
+@instrumented('osm_query.get_nodes_by_ids')
+def get_nodes_by_ids(node_ids):
+    """
+    Read nodes from entity cache, or from OSM API using multi-fetch requests
+    (OSM_MULTI_FETCH_MAX ids per request). Nodes that do not exist are left out (and
+    missing nodes if offline).
+
+    @param node_ids: List of node ids.
+    @return: Dictionary of node dictionaries for node ids.
+
+    >>> nodes = get_nodes_by_ids([360693242, 360693253, 360693255, 360693257, 550026012])
+    >>> nodes[360693242]['lat'], nodes[360693242]['lon']
+    """
+
+    cache = get_entity_cache()
+
+    nodes = cache.get_many('node', node_ids)
+    if osm_offline:
+        return nodes
+
+    for d_nodes in fetch_chunks(osm_api.NodesGet, [node_id for node_id in node_ids if node_id not in nodes]):
+        cache.put_many('node', d_nodes)
+        nodes.update(d_nodes)
+
+    return nodes
+
+
+@instrumented('osm_query.get_node_coordinates')
+def get_node_coordinates(node_ids):
+    """
+    Get coordinates of nodes from node store, or from entity cache or OSM API (nodes read
+    from entity cache or OSM API are added to node store).
+
+    @param node_ids: List of node ids.
+    @return: Arrays of latitudes and longitudes (NaN for missing nodes if offline).
+
+    >>> lat, lon = get_node_coordinates([360693242, 360693253, 360693255, 360693257, 550026012])
+    """
+
+    node_store = get_node_store()
+
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    missing = node_ids[~node_store.contains(node_ids)]
+    if missing.size:
+        d_nodes = get_nodes_by_ids(np.unique(missing).tolist())
+        node_store.add(
+            list(d_nodes), [node['lat'] for node in d_nodes.values()], [node['lon'] for node in d_nodes.values()]
+        )
+
+    return node_store.lookup(node_ids)
+
+
+@instrumented('osm_query.get_ways_by_ids')
+def get_ways_by_ids(way_ids, refresh=False):
+    """
+    Read ways from entity cache, or from OSM API using multi-fetch requests
+    (OSM_MULTI_FETCH_MAX ids per request). Ways that do not exist are left out (and
+    missing ways if offline).
+
+    @param way_ids: List of way ids.
+    @param refresh: Read all ways from OSM API, i.e. current versions (entity cache is
+                    updated), unless offline.
+    @return: Dictionary of way dictionaries for way ids.
+
+    >>> ways = get_ways_by_ids([234171837, 156967440])
+    >>> ways[234171837]['nd'][0]
+    360693242
+    """
+
+    cache = get_entity_cache()
+
+    ways = {} if refresh and not osm_offline else cache.get_many('way', way_ids)
+    if osm_offline:
+        return ways
+
+    for d_ways in fetch_chunks(osm_api.WaysGet, [way_id for way_id in way_ids if way_id not in ways]):
+        cache.put_many('way', d_ways)
+        ways.update(d_ways)
+
+    return ways
+
+
+@instrumented('osm_query.get_relation_full')
+def get_relation_full(relation_id):
+    """
+    Read relation together with all its ways and nodes from OSM API (in one request),
+    or from entity cache if offline.
+
+    @param relation_id: Id of relation.
+    @return: Relation dictionary, and dictionaries of way and node dictionaries for ids.
+
+    >>> relation, ways, nodes = get_relation_full(660162)
+    >>> len(ways), len(nodes)
+    """
+
+    if osm_offline:
+        relation = get_entity_cache().get('relation', relation_id)
+        if relation is None:
+            return None, {}, {}
+
+        ways = get_ways_by_ids([member['ref'] for member in relation['member'] if member['type'] == 'way'])
+        nodes = get_nodes_by_ids([node_id for way in ways.values() for node_id in way['nd']])
+
+        return relation, ways, nodes
+
+    relation, ways, nodes = None, {}, {}
+    for element in osm_api.RelationFull(relation_id):
+        data = element['data']
+        if element['type'] == 'node':
+            nodes[data['id']] = data
+        elif element['type'] == 'way':
+            ways[data['id']] = data
+        elif element['type'] == 'relation' and data['id'] == relation_id:
+            relation = data
+
+    cache = get_entity_cache()
+    cache.put_many('node', nodes)
+    cache.put_many('way', ways)
+    if relation is not None:
+        cache.put('relation', relation_id, relation)
+
+    return relation, ways, nodes
+
+
+@instrumented('osm_query.get_node_by_name')
+@cached_entity('node_name')
 def get_node_by_name(node_name):
     """
     Read node from Overpass API using node name.
@@ -399,14 +738,18 @@ def get_node_by_name(node_name):
     @return: Node dictionary.
     """
 
+    require_online('node_name', node_name)
+
     return overpass_api.Get('node["name"="' + node_name + '"]')
 
 
-def get_relation(ways):
+@instrumented('osm_query.get_relation')
+def get_relation(ways, d_ways=None):
     """
     Get all begin and end nodes of relation members (ways) and all nodes belonging to the relation.
 
     @param ways: List of ways (relation members).
+    @param d_ways: Dictionary of way dictionaries for way ids (read from OSM API if None).
     @return: Data frame with way ids, and the way's begin and end ids.
              List with all nodes belonging to the relation.
 
@@ -419,17 +762,13 @@ def get_relation(ways):
     1  156967440  1692053035   360693367
     """
 
-    def get_way_nodes(way):
-        try:
-            nd = get_way_by_id(way['ref'])['nd']
-            return nd
-        except:
-            return None
+    def get_relation_nodes(ways, d_ways):
+        if d_ways is None:
+            d_ways = get_ways_by_ids([way['ref'] for way in ways if way['type'] == 'way'])
 
-    def get_relation_nodes(ways):
         l_nodes, l_way, l_begin, l_end = [], [], [], []
         for way in ways:
-            nd = get_way_nodes(way)
+            nd = d_ways[way['ref']]['nd'] if way['type'] == 'way' and way['ref'] in d_ways else None
             if nd:
                 l_way.append(way['ref'])
                 l_begin.append(nd[0])
@@ -437,7 +776,7 @@ def get_relation(ways):
                 l_nodes.append(nd)
         return l_way, l_begin, l_end, l_nodes
 
-    l_way, l_begin, l_end, l_nodes = get_relation_nodes(ways)
+    l_way, l_begin, l_end, l_nodes = get_relation_nodes(ways, d_ways)
 
     df = pd.DataFrame(
         np.array([l_way, l_begin, l_end]).transpose(), columns=['way', 'begin', 'end']
@@ -446,13 +785,15 @@ def get_relation(ways):
     return df, l_nodes
 
 
-def get_relation_members(relation, skip=True, role='alternative'):
+@instrumented('osm_query.get_relation_members')
+def get_relation_members(relation, skip=True, role='alternative', d_ways=None):
     """
     Get all begin and end nodes of relation members (ways), and all nodes belonging to the relation.
 
     @param relation: Relation dictionary (as obtained from OSM API).
     @param skip: Skip relation members (ways) according to 'role'.
     @param role: Tag for relation members (ways).
+    @param d_ways: Dictionary of way dictionaries for way ids (read from OSM API if None).
     @return: Data frame with way ids, and the way's begin and end ids.
              List with all nodes belonging to the relation.
 
@@ -480,11 +821,77 @@ def get_relation_members(relation, skip=True, role='alternative'):
     else:
         members = relation['member']
 
-    df, l_nodes = get_relation(members)
+    df, l_nodes = get_relation(members, d_ways)
 
     return df, l_nodes
 
 
+# Result of chaining ways: track points, chained ways (way id, reversed),
+# unchained ways (gaps), and branches (node, way ids leaving node)
+Chain = namedtuple('Chain', ['track_points', 'ways', 'gaps', 'branches'])
+
+
+def chain_ways(l_way, l_nodes, start_node):
+    """
+    Chain ways (relation members) into a track starting from start node.
+
+    An index from end point nodes to ways is built once, and the ways are followed in
+    linear time. Ways are reversed if needed, and each way is used at most once. At a
+    branch the first way in relation order is followed (ways starting at the node before
+    ways ending at the node), and the branch is reported. Ways not reached are reported
+    as gaps.
+
+    @param l_way: List of way ids.
+    @param l_nodes: List of node lists (one for each way).
+    @param start_node: Start node of track.
+    @return: Chain (track points, ways, gaps, branches).
+
+    >>> l_way = [234171837, 156967440]
+    >>> l_nodes = [[360693242, 360693253, 1692053035], [360693367, 360693255, 1692053035]]
+    >>> chain = chain_ways(l_way, l_nodes, 360693242)
+    >>> chain.track_points
+    [360693242, 360693253, 1692053035, 360693255, 360693367]
+    >>> chain.ways
+    [(234171837, False), (156967440, True)]
+    >>> chain.gaps, chain.branches
+    ([], [])
+    """
+
+    endpoints = defaultdict(list)
+    for i, nodes in enumerate(l_nodes):
+        endpoints[nodes[0]].append((i, False))
+        endpoints[nodes[-1]].append((i, True))
+
+    for node in endpoints:
+        endpoints[node].sort(key=lambda candidate: (candidate[1], candidate[0]))
+
+    used = [False] * len(l_nodes)
+
+    current_node = start_node
+    track_points, ways, branches = [start_node], [], []
+    while True:
+        candidates = [(i, reverse) for i, reverse in endpoints.get(current_node, ()) if not used[i]]
+        if not candidates:
+            break
+
+        if len(set(i for i, _ in candidates)) > 1:
+            branches.append((current_node, [l_way[i] for i, _ in candidates]))
+
+        i, reverse = candidates[0]
+        used[i] = True
+
+        nodes = l_nodes[i][::-1] if reverse else l_nodes[i]
+        track_points.extend(nodes[1:])
+        ways.append((l_way[i], reverse))
+
+        current_node = nodes[-1]
+
+    gaps = [way for way, is_used in zip(l_way, used) if not is_used]
+
+    return Chain(track_points, ways, gaps, branches)
+
+
+@instrumented('osm_query.create_track_points')
 def create_track_points(relation, start_node):
     """
     Create track points (OSM node ids) of OSM relation starting from start node.
@@ -498,63 +905,12 @@ def create_track_points(relation, start_node):
     >>> track_points = create_track_points(relation, start_node)
     """
 
-    def check_node(df, current_way, current_node, node='begin'):
-        if current_node not in df.begin:
-            if current_way is None:
-                way = df[df[node] == current_node].way
-            else:
-                way = df[~(df.way == int(current_way)) & (df[node] == current_node)].way
-            if way.empty:
-                raise
-            return way
-        else:
-            raise
-
-    def get_segment(df, current_way):
-        return int(df[df.way == int(current_way)].index[0])
-
-    def get_nodes(nodes, current_segment, reverse=False):
-        list_of_nodes = nodes[current_segment][:]
-        if reverse:
-            list_of_nodes.reverse()
-        return list_of_nodes
-
-    def extend_track_points(track_points, list_of_nodes, reverse=False):
-        if reverse:
-            track_points.extend(list_of_nodes[:-1])
-        else:
-            track_points.extend(list_of_nodes[1:])
-        return track_points
-
-    def get_node_list(list_of_nodes):
-        return list_of_nodes[-1]
-
     df, l_nodes = get_relation_members(relation)
 
-    nodes = l_nodes[:]
-
-    current_way = None
-    current_node = start_node
-    track_points = [start_node]
-    while True:
-        try:
-            try:
-                reverse = False
-                current_way = check_node(df, current_way, current_node, node='begin')
-            except:
-                reverse = True
-                current_way = check_node(df, current_way, current_node, node='end')
-        except:
-            break
-
-        list_of_nodes = get_nodes(nodes, get_segment(df, current_way), reverse)
-        current_node = get_node_list(list_of_nodes)
-        #print current_node
-        track_points = extend_track_points(track_points, list_of_nodes, reverse)
-
-    return track_points
+    return chain_ways(map(int, df.way), l_nodes, start_node).track_points
 
 
+@instrumented('osm_query.get_way_points')
 def get_way_points(relation):
     """
     Get way points of OSM relation.
@@ -570,13 +926,17 @@ def get_way_points(relation):
     return [r['ref'] for r in relation['member'] if r['type'] == 'node']
 
 
-def relation_to_dataframes(relation, skip=True, role='alternative'):
+def relation_to_dataframes(relation, skip=True, role='alternative', d_ways=None):
     """
     Create data frames with relation, ways, and nodes.
 
+    The nodes data frame has one row for each node of each way (way_seq is the position
+    of the way in the relation and seq the position of the node in the way).
+
     @param relation: Id of relation.
     @param skip: Skip ways with role.
     @param role: Role value of ways to skip.
+    @param d_ways: Dictionary of way dictionaries for way ids (read from OSM API if None).
     @return: Data frames with relation, ways, and nodes.
 
     >>> relation_id = 660162
@@ -600,85 +960,152 @@ def relation_to_dataframes(relation, skip=True, role='alternative'):
         columns = data_frame.columns.tolist()
         return data_frame[columns[-1:] + columns[:-1]]
 
-    df_ways, l_nodes = get_relation_members(relation, skip=skip, role=role)
+    df_ways, l_nodes = get_relation_members(relation, skip=skip, role=role, d_ways=d_ways)
 
     df_ways = change_column_order(
         add_columns(df_ways, {'relation': relation['id']})
     )
 
+    lengths = np.array([len(nodes) for nodes in l_nodes], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+
     df_nodes = pd.DataFrame(
         {'relation': relation['id'],
-         'way': map(str, df_ways.way),
-         'nodes': map(str, l_nodes)}, columns=['relation', 'way', 'nodes']
+         'way_seq': np.repeat(np.arange(len(l_nodes)), lengths),
+         'seq': np.arange(lengths.sum()) - np.repeat(offsets, lengths),
+         'way': np.repeat(df_ways.way.values, lengths),
+         'node': np.array([nd for nodes in l_nodes for nd in nodes], dtype=np.int64)},
+        columns=['relation', 'way_seq', 'seq', 'way', 'node']
     )
 
     d_relation = {'relation': relation['id'],
                   'name': relation['tag']['name'],
-                  'source': relation['tag']['source'] if 'source' in relation['tag'] else None}
+                  'source': relation['tag']['source'] if 'source' in relation['tag'] else None,
+                  'version': relation.get('version')}
 
     df_relation = pd.DataFrame.from_dict({0: d_relation}, orient='index')
-    df_relation = df_relation[['relation', 'name', 'source']]
+    df_relation = df_relation[['relation', 'name', 'source', 'version']]
 
     return df_relation, df_ways, df_nodes
 
 
-def save_relation_to_db(engine, relation):
+def is_relation_in_db(engine, relation, d_ways=None):
     """
-    Save relation, ways, and nodes to database.
+    Check if relation, and its ways, are stored in database with current OSM versions.
+
+    @param engine: Database engine.
+    @param relation: OSM relation as dictionary.
+    @param d_ways: Dictionary of current way dictionaries for way ids, e.g. read together
+                   with relation (read from OSM API if None, since cached ways may be outdated).
+    @return: True if relation and ways are up to date.
+    """
+
+    row = engine.execute('select version from relations where relation = ?', (relation['id'],)).fetchone()
+    if row is None or row[0] is None or row[0] != relation.get('version'):
+        return False
+
+    if d_ways is None:
+        d_ways = get_ways_by_ids([member['ref'] for member in relation['member'] if member['type'] == 'way'],
+                                 refresh=True)
+    versions = select_versions(engine, d_ways.keys())
+
+    return all(versions.get(way_id) == way.get('version') for way_id, way in d_ways.items())
+
+
+@instrumented('osm_query.save_relation_to_db')
+def save_relation_to_db(engine, relation, incremental=False, spatial_index=None, d_ways=None):
+    """
+    Save relation, ways, and nodes to database (insert or update, in one transaction).
+
+    Saving a relation again replaces the stored relation, so jobs can be re-run.
 
     @param engine: Database engine.
     @param relation: Id of relation.
+    @param incremental: Only write relation if it (or any of its ways) has a new OSM version.
+    @param spatial_index: SpatialIndex updated with nodes of relation (see spatial_index), or None.
+    @param d_ways: Dictionary of current way dictionaries for way ids, e.g. read together
+                   with relation (read from entity cache or OSM API if None).
+    @return: True if relation was written.
 
     >>> engine = sqlite3.connect("relations.sqlite")
     >>> relation_id = 660162
     >>> relation = get_relation_by_id(relation_id)
     >>> save_relation_to_db(engine, relation)
+    True
+    >>> save_relation_to_db(engine, relation, incremental=True)
+    False
     """
 
-    df_relation, df_ways, df_nodes = relation_to_dataframes(relation)
+    ensure_tables(engine)
+
+    if incremental and is_relation_in_db(engine, relation, d_ways):
+        return False
+
+    df_relation, df_ways, df_nodes = relation_to_dataframes(relation, d_ways=d_ways)
+
+    relation_id = relation['id']
+    lengths = df_nodes.groupby('way_seq').size()
+
+    if d_ways is None:
+        d_ways = get_ways_by_ids(df_ways.way.values.tolist())
+    d_ways = dict((way_id, d_ways[way_id]) for way_id in df_ways.way.values.tolist() if way_id in d_ways)
+
+    with engine:
+        upsert_rows(engine, 'relations', ['relation', 'name', 'source', 'version'], ['relation'],
+                    [(relation_id, relation['tag']['name'], df_relation.source[0], relation.get('version'))])
+
+        upsert_rows(engine, 'ways', ['relation', 'seq', 'way', 'begin', 'end'], ['relation', 'seq'],
+                    zip([relation_id] * len(df_ways), range(len(df_ways)),
+                        *[df_ways[column].values.tolist() for column in ('way', 'begin', 'end')]))
+
+        upsert_rows(engine, 'way_nodes', ['relation', 'way_seq', 'seq', 'node'], ['relation', 'way_seq', 'seq'],
+                    zip(*[df_nodes[column].values.tolist() for column in ('relation', 'way_seq', 'seq', 'node')]))
 
-    df_relation.to_sql('relations', engine, if_exists='append', index=False)
-    df_ways.to_sql('ways', engine, if_exists='append', index=False)
-    df_nodes.to_sql('nodes', engine, if_exists='append', index=False)
+        upsert_rows(engine, 'way_versions', ['way', 'version'], ['way'],
+                    [(way_id, way.get('version')) for way_id, way in d_ways.items()])
 
-    # TODO: Figure out how to add records to existing tables... if_exists='append'
-    #l_nd = pd.read_sql_query('select * from nodes', engine, index_col='relation')
+        # Remove rows left from a previous (longer) version of the relation
+        engine.execute('delete from ways where relation = ? and seq >= ?', (relation_id, len(df_ways)))
+        engine.execute('delete from way_nodes where relation = ? and way_seq >= ?', (relation_id, len(df_ways)))
+        engine.executemany('delete from way_nodes where relation = ? and way_seq = ? and seq >= ?',
+                           [(relation_id, way_seq, length) for way_seq, length in lengths.iteritems()])
+
+    if spatial_index is not None:
+        nodes = np.unique(df_nodes.node.values)
+        lat, lon = get_node_coordinates(nodes)
+        version = select_relation_versions(engine, relation_id)[relation_id]
+        spatial_index.update_relation(relation_id, nodes, lat, lon, version)
+
+    return True
 
 
 def load_relation_from_db(engine, relation_id=None):
     """
-    Load relation, ways, and nodes from database.
+    Load ways and nodes from database.
 
     @param engine: Database engine.
-    @param relation_id: Id of relation.
-    @return: Relation, ways, and nodes data frames.
+    @param relation_id: Id of relation, list of ids, or None (all relations).
+    @return: Data frame with way ids, and the way's begin and end ids.
+             List with all nodes belonging to the relation(s).
 
     >>> engine = sqlite3.connect("/media/alpha/ransta/alpha/my/stockholm/py/relations.sqlite")
     >>> relation_id = 660162
     >>> df_ways, l_nodes = load_relation_from_db(engine, relation_id)
+    >>> df_ways, l_nodes = load_relation_from_db(engine, [660162, 4570739])
     """
 
-    where_relation_id = '' if relation_id is None else ' where relation="' + str(relation_id) + '"'
-
-    # Not needed
-    #df_relation = pd.read_sql_query(
-    #    'select * from relations' + where_relation_id, engine, index_col='relation'
-    #)
-
-    df_ways = pd.read_sql_query(
-        'select * from ways' + where_relation_id, engine, index_col='relation'
+    ways = select_relations(
+        engine, 'select way, "begin", "end" from ways', relation_id, ' order by relation, seq', n_columns=3
     )
 
-    df_ways = pd.DataFrame(df_ways.as_matrix(), columns=df_ways.columns)
+    df_ways = pd.DataFrame(ways, columns=['way', 'begin', 'end'])
 
-    df_nodes = pd.read_sql_query(
-        'select * from nodes' + where_relation_id, engine, index_col='relation'
+    way_nodes = select_relations(
+        engine, 'select relation, way_seq, node from way_nodes', relation_id, ' order by relation, way_seq, seq',
+        n_columns=3
     )
 
-    df_nodes = pd.DataFrame(df_nodes.as_matrix(), columns=df_nodes.columns)
-    df_nodes = df_nodes[df_ways.way == map(int, df_nodes.way)]
-
-    l_nodes = [eval(nodes) for nodes in map(str, df_nodes.nodes)]
+    l_nodes = split_by_key(way_nodes[:, :2], way_nodes[:, 2])
 
     return df_ways, l_nodes
 
@@ -691,6 +1118,8 @@ def write_relation_to_excel(dir_name, relation):
     @param relation: Id of relation.
     """
 
+    from gpx_trail import create_gpx_file_name
+
     file_name = create_gpx_file_name(dir_name, relation['id'], relation['tag']['name'], ext='xlsx')
     writer = pd.ExcelWriter(file_name)
 
@@ -707,9 +1136,10 @@ def read_relation_from_excel():
     pass
 
 
+@instrumented('osm_query.save_track_points_to_db')
 def save_track_points_to_db(engine, relation_id, track_points):
     """
-    Save track points to database.
+    Save track points to database (insert or update, in one transaction).
 
     @param engine: Database engine.
     @param relation_id: Id of relation.
@@ -721,11 +1151,14 @@ def save_track_points_to_db(engine, relation_id, track_points):
     >>> save_track_points_to_db(engine, relation_id, track_points)
     """
 
-    df_track_points = {'relation': relation_id, 'nodes': str(track_points)}
+    ensure_tables(engine)
 
-    df_track_points = pd.DataFrame.from_dict({0: df_track_points}, orient='index')
-    df_track_points = df_track_points[['relation', 'nodes']]
-    df_track_points.to_sql('track_points', engine, if_exists='append', index=False)
+    with engine:
+        upsert_rows(engine, 'track_point_nodes', ['relation', 'seq', 'node'], ['relation', 'seq'],
+                    zip([relation_id] * len(track_points), range(len(track_points)), map(int, track_points)))
+
+        engine.execute('delete from track_point_nodes where relation = ? and seq >= ?',
+                       (relation_id, len(track_points)))
 
 
 def load_track_points_from_db(engine, relation_id=None):
@@ -733,28 +1166,29 @@ def load_track_points_from_db(engine, relation_id=None):
     Load track points from database.
 
     @param engine: Database engine.
-    @param relation_id: Id of relation.
-    @return: List of track points (OSM node ids).
+    @param relation_id: Id of relation (first relation in database if None), or list of ids.
+    @return: List of track points (OSM node ids), or dictionary of lists for relation ids
+             if relation_id is a list.
 
     >>> engine = sqlite3.connect("/media/alpha/ransta/alpha/my/stockholm/py/relations.sqlite")
     >>> relation_id = 660162
     >>> track_points = load_track_points_from_db(engine, relation_id)
+    >>> d_track_points = load_track_points_from_db(engine, [660162, 4570739])
     """
 
-    where_relation_id = '' if relation_id is None else ' where relation="' + str(relation_id) + '"'
+    if relation_id is None:
+        relation_id = engine.execute('select min(relation) from track_point_nodes').fetchone()[0]
 
-    df_nodes = pd.read_sql_query(
-        'select * from track_points' + where_relation_id, engine, index_col='relation'
+    nodes = select_relations(
+        engine, 'select relation, node from track_point_nodes', relation_id, ' order by relation, seq', n_columns=2
     )
 
-    df_nodes = pd.DataFrame(df_nodes.as_matrix(), columns=df_nodes.columns)
+    if not isinstance(relation_id, (list, tuple, np.ndarray)):
+        return nodes[:, 1].tolist()
 
-    if df_nodes.empty:
-        track_points = []
-    else:
-        track_points = [eval(nodes) for nodes in map(str, df_nodes.nodes)][0]
+    relation_ids = np.unique(nodes[:, 0]).tolist()
 
-    return track_points
+    return dict(zip(relation_ids, split_by_key(nodes[:, 0], nodes[:, 1])))
 
 
 # http://osmapi.divshot.io/
@@ -0,0 +1,103 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+from datetime import datetime
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+OSM_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def parse_attributes(elem):
+    """
+    Parse common attributes of OSM element (as in dictionaries from osmapi).
+
+    @param elem: XML element (node, way, or relation).
+    @return: Dictionary with id, tags, and metadata (if available).
+    """
+
+    attrib = elem.attrib
+
+    data = {'id': int(attrib['id']),
+            'tag': dict((tag.get('k'), tag.get('v')) for tag in elem.iterfind('tag'))}
+
+    for key in ('version', 'changeset', 'uid'):
+        if key in attrib:
+            data[key] = int(attrib[key])
+
+    if 'user' in attrib:
+        data['user'] = attrib['user']
+    if 'visible' in attrib:
+        data['visible'] = attrib['visible'] == 'true'
+    if 'timestamp' in attrib:
+        data['timestamp'] = datetime.strptime(attrib['timestamp'], OSM_TIMESTAMP_FORMAT)
+
+    return data
+
+
+def parse_element(elem):
+    """
+    Parse OSM element into dictionary (as in dictionaries from osmapi).
+
+    @param elem: XML element (node, way, or relation).
+    @return: Dictionary of element.
+    """
+
+    data = parse_attributes(elem)
+
+    if elem.tag == 'node':
+        data['lat'] = float(elem.get('lat'))
+        data['lon'] = float(elem.get('lon'))
+    elif elem.tag == 'way':
+        data['nd'] = [int(nd.get('ref')) for nd in elem.iterfind('nd')]
+    elif elem.tag == 'relation':
+        data['member'] = [{'type': member.get('type'), 'ref': int(member.get('ref')), 'role': member.get('role')}
+                          for member in elem.iterfind('member')]
+
+    return data
+
+
+def iter_osm_elements(source, types=('node', 'way', 'relation')):
+    """
+    Stream-parse OSM XML (e.g. an Overpass response or an .osm file) in constant memory.
+
+    @param source: File name or file object.
+    @param types: Types of elements to parse (other elements are skipped).
+    @return: Iterator of (type, dictionary) for each element.
+
+    >>> from StringIO import StringIO
+    >>> source = StringIO('<osm><node id="1" lat="59.2" lon="18.1"/><way id="2"><nd ref="1"/></way></osm>')
+    >>> [(element_type, data['id']) for element_type, data in iter_osm_elements(source)]
+    [('node', 1), ('way', 2)]
+    """
+
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+
+    root = None
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+
+        # Top level elements (children of root)
+        if depth == 1:
+            if elem.tag in types:
+                yield elem.tag, parse_element(elem)
+            root.clear()
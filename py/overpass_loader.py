@@ -0,0 +1,144 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import numpy as np
+
+import osm_query
+
+from osm_cache import get_entity_cache
+from osm_query import bbox_min_max_to_bbox_south_south_north_north, save_relation_to_db
+from osm_xml import iter_osm_elements
+
+# Max size of bounding box tiles (degrees), and timeout (seconds) of each Overpass query
+OVERPASS_TILE_SIZE = 0.5
+OVERPASS_TIMEOUT = 180
+
+# Number of entities written to entity cache at once
+OVERPASS_CACHE_BATCH = 10000
+
+
+def split_bbox(min_longitude, min_latitude, max_longitude, max_latitude, tile_size=OVERPASS_TILE_SIZE):
+    """
+    Split bounding box into tiles (of at most tile size degrees).
+
+    @param min_longitude: Min longitude of bounding box.
+    @param min_latitude: Min latitude of bounding box.
+    @param max_longitude: Max longitude of bounding box.
+    @param max_latitude: Max latitude of bounding box.
+    @param tile_size: Max size of tiles in degrees.
+    @return: List of tiles (min_longitude, min_latitude, max_longitude, max_latitude).
+
+    >>> split_bbox(12.0, 56.0, 13.0, 56.4, 0.5)
+    [(12.0, 56.0, 12.5, 56.4), (12.5, 56.0, 13.0, 56.4)]
+    """
+
+    n_longitude = max(int(np.ceil((max_longitude - min_longitude) / tile_size)), 1)
+    n_latitude = max(int(np.ceil((max_latitude - min_latitude) / tile_size)), 1)
+
+    longitudes = np.linspace(min_longitude, max_longitude, n_longitude + 1).tolist()
+    latitudes = np.linspace(min_latitude, max_latitude, n_latitude + 1).tolist()
+
+    return [(west, south, east, north)
+            for south, north in zip(latitudes[:-1], latitudes[1:])
+            for west, east in zip(longitudes[:-1], longitudes[1:])]
+
+
+def overpass_route_query(min_longitude, min_latitude, max_longitude, max_latitude, route='hiking'):
+    """
+    Create Overpass query for route relations in bounding box, with all their ways and nodes.
+
+    @param min_longitude: Min longitude of bounding box.
+    @param min_latitude: Min latitude of bounding box.
+    @param max_longitude: Max longitude of bounding box.
+    @param max_latitude: Max latitude of bounding box.
+    @param route: Value of route tag of relations.
+    @return: Query string (Overpass QL).
+    """
+
+    bbox = ','.join(map(str, bbox_min_max_to_bbox_south_south_north_north(
+        min_longitude, min_latitude, max_longitude, max_latitude
+    )))
+
+    return '[out:xml][timeout:' + str(OVERPASS_TIMEOUT) + '];' + \
+           'relation["type"="route"]["route"="' + route + '"](' + bbox + ')->.routes;' + \
+           'way(r.routes)->.ways;' + \
+           '(node(w.ways);node(r.routes);.ways;.routes;);' + \
+           'out meta;'
+
+
+def load_bbox(engine, min_longitude, min_latitude, max_longitude, max_latitude,
+              route='hiking', tile_size=OVERPASS_TILE_SIZE):
+    """
+    Load route relations in bounding box, with all their ways and nodes, from Overpass API
+    into entity cache and database (one Overpass query for each tile of bounding box).
+
+    Responses are stream-parsed, and nodes and ways are written to the entity cache in
+    batches, so memory use does not depend on size of bounding box. Relations without
+    name are cached but not saved to database.
+
+    @param engine: Database engine.
+    @param min_longitude: Min longitude of bounding box.
+    @param min_latitude: Min latitude of bounding box.
+    @param max_longitude: Max longitude of bounding box.
+    @param max_latitude: Max latitude of bounding box.
+    @param route: Value of route tag of relations.
+    @param tile_size: Max size of tiles in degrees.
+    @return: List of loaded relation ids.
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> min_longitude, min_latitude, max_longitude, max_latitude = 12.4985, 56.0189, 12.6314, 56.0763
+    >>> relation_ids = load_bbox(engine, min_longitude, min_latitude, max_longitude, max_latitude)
+    """
+
+    cache = get_entity_cache()
+    session = osm_query.overpass_api.session
+
+    relation_ids, saved = [], set()
+    for tile in split_bbox(min_longitude, min_latitude, max_longitude, max_latitude, tile_size):
+
+        response = session.post(
+            osm_query.overpass_api.endpoint, data={'data': overpass_route_query(*tile, route=route)},
+            stream=True, timeout=OVERPASS_TIMEOUT + 30
+        )
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            batch = {'node': {}, 'way': {}}
+            relations = []
+            for element_type, data in iter_osm_elements(response.raw):
+                if element_type == 'relation':
+                    relations.append(data)
+                    continue
+
+                batch[element_type][data['id']] = data
+                if len(batch[element_type]) >= OVERPASS_CACHE_BATCH:
+                    cache.put_many(element_type, batch[element_type])
+                    batch[element_type] = {}
+        finally:
+            # Releases connection, and slot of concurrency limit of session (see transport)
+            response.close()
+
+        for element_type, entities in batch.items():
+            cache.put_many(element_type, entities)
+
+        for relation in relations:
+            cache.put('relation', relation['id'], relation)
+            if relation['id'] not in saved and 'name' in relation['tag']:
+                # Ways were just read from Overpass, so versions are compared without requests
+                d_ways = cache.get_many('way', [member['ref'] for member in relation['member']
+                                                if member['type'] == 'way'])
+                save_relation_to_db(engine, relation, incremental=True, d_ways=d_ways)
+                relation_ids.append(relation['id'])
+                saved.add(relation['id'])
+
+    return relation_ids
@@ -0,0 +1,256 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import heapq
+import numpy as np
+
+from collections import namedtuple
+
+from geodesy import haversine
+from osm_query import get_node_coordinates, get_relation_members
+
+# Route graph in compressed sparse row (CSR) format: OSM node ids (sorted) and their
+# coordinates, and for graph node i the neighbours indices[indptr[i]:indptr[i + 1]]
+# at distances (meters) weights[indptr[i]:indptr[i + 1]].
+RouteGraph = namedtuple('RouteGraph', ['nodes', 'lat', 'lon', 'indptr', 'indices', 'weights'])
+
+# Route (path) in route graph: OSM node ids, and cumulative distance (meters) at each node
+Route = namedtuple('Route', ['nodes', 'distance'])
+
+
+def build_route_graph(l_nodes, node_ids, lat, lon):
+    """
+    Build route graph from ways (undirected, edges between consecutive way nodes).
+
+    @param l_nodes: List of node lists (one for each way).
+    @param node_ids: Array of OSM node ids (covering all way nodes).
+    @param lat: Array of latitudes of node ids.
+    @param lon: Array of longitudes of node ids.
+    @return: RouteGraph.
+
+    >>> l_nodes = [[1, 2, 3], [3, 4], [2, 4]]
+    >>> graph = build_route_graph(l_nodes, [1, 2, 3, 4], [59.0, 59.001, 59.002, 59.003], [18.0] * 4)
+    >>> graph.nodes
+    array([1, 2, 3, 4])
+    >>> graph.indices[graph.indptr[1]:graph.indptr[2]]
+    array([0, 2, 3], dtype=int32)
+    """
+
+    l_nodes = [nodes for nodes in l_nodes if len(nodes) > 1]
+
+    flat = np.concatenate([np.asarray(nodes, dtype=np.int64) for nodes in l_nodes]) \
+        if l_nodes else np.zeros(0, dtype=np.int64)
+    way = np.repeat(np.arange(len(l_nodes)), [len(nodes) for nodes in l_nodes])
+
+    nodes, inverse = np.unique(flat, return_inverse=True)
+
+    # Coordinates of graph nodes (positions are clipped, so ids above all node ids are
+    # reported as missing)
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    if nodes.size and not node_ids.size:
+        raise ValueError('Coordinates missing for way nodes')
+    order = np.argsort(node_ids)
+    position = order[np.minimum(np.searchsorted(node_ids, nodes, sorter=order), max(node_ids.size - 1, 0))]
+    if nodes.size and not np.array_equal(node_ids[position], nodes):
+        raise ValueError('Coordinates missing for way nodes')
+    lat = np.asarray(lat, dtype=np.float64)[position]
+    lon = np.asarray(lon, dtype=np.float64)[position]
+
+    # Edges between consecutive nodes of the same way (in both directions)
+    same_way = way[:-1] == way[1:]
+    source, target = inverse[:-1][same_way], inverse[1:][same_way]
+    weight = haversine(lat[source], lon[source], lat[target], lon[target])
+
+    source, target = np.concatenate([source, target]), np.concatenate([target, source])
+    weight = np.concatenate([weight, weight])
+
+    # Sort edges by source, target, and weight, and keep the shortest of parallel edges
+    order = np.lexsort((weight, target, source))
+    source, target, weight = source[order], target[order], weight[order]
+
+    keep = np.ones(source.size, dtype=bool)
+    keep[1:] = (source[1:] != source[:-1]) | (target[1:] != target[:-1])
+    keep &= source != target
+    source, target, weight = source[keep], target[keep], weight[keep]
+
+    indptr = np.zeros(nodes.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source, minlength=nodes.size), out=indptr[1:])
+
+    return RouteGraph(nodes, lat, lon, indptr, target.astype(np.int32), weight)
+
+
+def route_graph_from_relations(relations, skip=True, role='alternative'):
+    """
+    Build route graph from ways of OSM relations.
+
+    @param relations: List of OSM relations as dictionaries.
+    @param skip: Skip ways with role.
+    @param role: Role value of ways to skip.
+    @return: RouteGraph.
+
+    >>> relations = [get_relation_by_id(relation_id) for relation_id in (660162, 4570739)]
+    >>> graph = route_graph_from_relations(relations)
+    """
+
+    l_nodes = []
+    for relation in relations:
+        l_nodes.extend(get_relation_members(relation, skip=skip, role=role)[1])
+
+    node_ids = np.unique([nd for nodes in l_nodes for nd in nodes])
+    lat, lon = get_node_coordinates(node_ids)
+
+    return build_route_graph(l_nodes, node_ids, lat, lon)
+
+
+def node_index(graph, node):
+    """
+    Get index of OSM node in route graph.
+
+    @param graph: RouteGraph.
+    @param node: OSM node id.
+    @return: Index of node.
+    """
+
+    i = int(np.searchsorted(graph.nodes, node))
+    if i == graph.nodes.size or graph.nodes[i] != node:
+        raise KeyError('Node %s not in route graph' % node)
+
+    return i
+
+
+def shortest_path(graph, source_node, target_node, a_star=True):
+    """
+    Find shortest route between two nodes (A*, or Dijkstra if a_star is False).
+
+    The A* heuristic is the great circle distance to the target node, which never
+    overestimates the remaining distance along the graph.
+
+    @param graph: RouteGraph.
+    @param source_node: OSM id of start node.
+    @param target_node: OSM id of end node.
+    @param a_star: Use A* search (otherwise Dijkstra).
+    @return: Route, or None if there is no route between the nodes.
+
+    >>> l_nodes = [[1, 2, 3], [3, 4], [2, 4]]
+    >>> graph = build_route_graph(l_nodes, [1, 2, 3, 4], [59.0, 59.001, 59.002, 59.003], [18.0] * 4)
+    >>> shortest_path(graph, 1, 4).nodes
+    [1, 2, 4]
+    """
+
+    source, target = node_index(graph, source_node), node_index(graph, target_node)
+
+    if a_star:
+        heuristic = haversine(graph.lat, graph.lon, graph.lat[target], graph.lon[target]).tolist()
+    else:
+        heuristic = [0.0] * graph.nodes.size
+
+    indptr, indices, weights = graph.indptr.tolist(), graph.indices.tolist(), graph.weights.tolist()
+
+    n = graph.nodes.size
+    distance = [float('inf')] * n
+    previous = [-1] * n
+    done = [False] * n
+
+    distance[source] = 0.0
+
+    heap = [(heuristic[source], source)]
+    while heap:
+        _, i = heapq.heappop(heap)
+        if done[i]:
+            continue
+        if i == target:
+            break
+        done[i] = True
+
+        d_i = distance[i]
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            d_j = d_i + weights[k]
+            if d_j < distance[j]:
+                distance[j] = d_j
+                previous[j] = i
+                heapq.heappush(heap, (d_j + heuristic[j], j))
+
+    if distance[target] == float('inf'):
+        return None
+
+    path = [target]
+    while previous[path[-1]] != -1:
+        path.append(previous[path[-1]])
+    path.reverse()
+
+    return Route([int(graph.nodes[i]) for i in path], [distance[i] for i in path])
+
+
+def split_stages(route, stage_length):
+    """
+    Split route into stages of (about) stage length, splitting at the route nodes
+    closest to multiples of stage length.
+
+    @param route: Route.
+    @param stage_length: Length of each stage in meters.
+    @return: List of routes (one for each stage, with distances from start of stage). A
+             route of less than two nodes is one (zero length) stage.
+
+    >>> route = Route([1, 2, 3, 4, 5], [0.0, 4000.0, 9000.0, 12000.0, 21000.0])
+    >>> [stage.nodes for stage in split_stages(route, 10000.0)]
+    [[1, 2, 3], [3, 4, 5]]
+    >>> split_stages(Route([1], [0.0]), 10000.0)
+    [Route(nodes=[1], distance=[0.0])]
+    """
+
+    if len(route.nodes) < 2:
+        return [route]
+
+    distance = np.asarray(route.distance, dtype=np.float64)
+
+    n_stages = max(int(round(distance[-1] / stage_length)), 1)
+    targets = stage_length * np.arange(1, n_stages)
+
+    # Split at closest of the nodes before and after each multiple of stage length
+    after = np.minimum(np.searchsorted(distance, targets), distance.size - 1)
+    before = np.maximum(after - 1, 0)
+    split = np.where(np.abs(distance[before] - targets) < np.abs(distance[after] - targets), before, after)
+
+    boundaries = np.unique(np.concatenate([[0], split, [distance.size - 1]]))
+
+    stages = []
+    for begin, end in zip(boundaries[:-1], boundaries[1:]):
+        stages.append(
+            Route(route.nodes[begin:end + 1], (distance[begin:end + 1] - distance[begin]).tolist())
+        )
+
+    return stages
+
+
+def plan_route(graph, source_node, target_node, stage_length=None):
+    """
+    Plan route between two nodes of route graph, optionally split into stages.
+
+    @param graph: RouteGraph.
+    @param source_node: OSM id of start node.
+    @param target_node: OSM id of end node.
+    @param stage_length: Length of each stage in meters (no stages if None).
+    @return: List of routes (one for each stage), empty list if there is no route.
+
+    >>> stages = plan_route(graph, 1458482713, 360693242, stage_length=15000.0)
+    """
+
+    route = shortest_path(graph, source_node, target_node)
+
+    if route is None:
+        return []
+
+    if stage_length is None:
+        return [route]
+
+    return split_stages(route, stage_length)
@@ -0,0 +1,223 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import numpy as np
+
+from geodesy import project
+from osm_query import get_node_coordinates, get_way_points
+
+# Default tolerance (meters), i.e. max deviation of simplified track from track
+SIMPLIFY_TOLERANCE = 5.0
+
+
+def segment_distance(x, y, x_1, y_1, x_2, y_2):
+    """
+    Distance from points to line segment (vectorized).
+
+    @param x: Array of x of points.
+    @param y: Array of y of points.
+    @param x_1: x of first end point of segment.
+    @param y_1: y of first end point of segment.
+    @param x_2: x of second end point of segment.
+    @param y_2: y of second end point of segment.
+    @return: Array of distances.
+
+    >>> segment_distance(np.array([1.0, 3.0]), np.array([1.0, 0.0]), 0.0, 0.0, 2.0, 0.0)
+    array([1., 1.])
+    """
+
+    dx, dy = x_2 - x_1, y_2 - y_1
+    length_2 = dx * dx + dy * dy
+
+    t = np.clip(((x - x_1) * dx + (y - y_1) * dy) / length_2, 0.0, 1.0) if length_2 > 0 else 0.0
+
+    return np.hypot(x - x_1 - t * dx, y - y_1 - t * dy)
+
+
+def douglas_peucker(x, y, tolerance, keep=None):
+    """
+    Simplify polyline using the Douglas-Peucker algorithm.
+
+    Reference: https://en.wikipedia.org/wiki/Ramer-Douglas-Peucker_algorithm
+
+    @param x: Array of x of points (e.g. meters, see geodesy.project).
+    @param y: Array of y of points.
+    @param tolerance: Max distance from simplified polyline to removed points.
+    @param keep: Boolean array of points that are always kept (end points are always kept).
+    @return: Boolean array of kept points.
+
+    >>> douglas_peucker(np.arange(5.0), np.array([0.0, 0.1, 0.0, 2.0, 0.0]), 0.5)
+    array([ True, False,  True,  True,  True])
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    kept = np.zeros(x.size, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+    if x.size == 0:
+        return kept
+    kept[[0, -1]] = True
+
+    # Polyline is split at points that are always kept, and each part is simplified
+    fixed = np.flatnonzero(kept)
+    stack = zip(fixed[:-1].tolist(), fixed[1:].tolist())
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        distance = segment_distance(x[first + 1:last], y[first + 1:last], x[first], y[first], x[last], y[last])
+
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            i += first + 1
+            kept[i] = True
+            stack.append((first, i))
+            stack.append((i, last))
+
+    return kept
+
+
+def triangle_area(x, y, previous, middle, following):
+    """
+    Areas of triangles formed by points and their previous and following points.
+
+    @param x: Array of x of points.
+    @param y: Array of y of points.
+    @param previous: Array of indexes of previous points.
+    @param middle: Array of indexes of points.
+    @param following: Array of indexes of following points.
+    @return: Array of areas.
+
+    >>> triangle_area(np.array([0.0, 1.0, 2.0]), np.array([0.0, 1.0, 0.0]), [0], [1], [2])
+    array([1.])
+    """
+
+    x_0, y_0 = x[middle], y[middle]
+
+    return 0.5 * np.abs((x[previous] - x_0) * (y[following] - y_0) - (x[following] - x_0) * (y[previous] - y_0))
+
+
+def visvalingam_whyatt(x, y, tolerance, keep=None):
+    """
+    Simplify polyline using the Visvalingam-Whyatt algorithm, removing points whose
+    effective area is less than tolerance squared.
+
+    Points are removed in rounds (vectorized): in each round all points with area below
+    the threshold and smaller than the areas of their neighbours are removed, and the
+    areas of their neighbours are recomputed.
+
+    Reference: https://en.wikipedia.org/wiki/Visvalingam-Whyatt_algorithm
+
+    @param x: Array of x of points (e.g. meters, see geodesy.project).
+    @param y: Array of y of points.
+    @param tolerance: Tolerance (side of square with threshold area).
+    @param keep: Boolean array of points that are always kept (end points are always kept).
+    @return: Boolean array of kept points.
+
+    >>> visvalingam_whyatt(np.arange(5.0), np.array([0.0, 0.1, 0.0, 2.0, 0.0]), 0.5)
+    array([ True, False,  True,  True,  True])
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    fixed = np.zeros(x.size, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+    if x.size == 0:
+        return fixed
+    fixed[[0, -1]] = True
+
+    threshold = tolerance * tolerance
+
+    index = np.arange(x.size)
+    while index.size > 2:
+        area = np.full(index.size, np.inf)
+        area[1:-1] = triangle_area(x, y, index[:-2], index[1:-1], index[2:])
+        area[fixed[index]] = np.inf
+
+        # Local minima below threshold (ties are broken by position, so that neighbours
+        # are never removed in the same round)
+        candidate = area < threshold
+        candidate[1:] &= area[1:] < area[:-1]
+        candidate[:-1] &= area[:-1] <= area[1:]
+
+        if not candidate.any():
+            break
+
+        index = index[~candidate]
+
+    kept = np.zeros(x.size, dtype=bool)
+    kept[index] = True
+
+    return kept
+
+
+SIMPLIFY_METHODS = {'douglas_peucker': douglas_peucker, 'visvalingam_whyatt': visvalingam_whyatt}
+
+
+def simplify_mask(lat, lon, tolerance=SIMPLIFY_TOLERANCE, method='douglas_peucker', keep=None):
+    """
+    Simplify track.
+
+    @param lat: Array of latitudes of track points.
+    @param lon: Array of longitudes of track points.
+    @param tolerance: Tolerance in meters.
+    @param method: Simplification method ('douglas_peucker' or 'visvalingam_whyatt').
+    @param keep: Boolean array of track points that are always kept.
+    @return: Boolean array of kept track points.
+    """
+
+    x, y = project(lat, lon)
+
+    return SIMPLIFY_METHODS[method](x, y, tolerance, keep)
+
+
+def simplify_track(track_points, lat, lon, tolerance=SIMPLIFY_TOLERANCE, method='douglas_peucker',
+                   keep_nodes=None):
+    """
+    Simplify track (for GPX files, Excel workbooks, database, and maps).
+
+    @param track_points: List of OSM node ids of track.
+    @param lat: Array of latitudes of track points.
+    @param lon: Array of longitudes of track points.
+    @param tolerance: Tolerance in meters.
+    @param method: Simplification method ('douglas_peucker' or 'visvalingam_whyatt').
+    @param keep_nodes: List of OSM node ids that are always kept (e.g. way points).
+    @return: List of OSM node ids of simplified track.
+
+    >>> simplify_track([1, 2, 3], [59.0, 59.00001, 59.00002], [18.0, 18.0, 18.0])
+    [1, 3]
+    """
+
+    track_points = np.asarray(track_points, dtype=np.int64)
+    keep = np.in1d(track_points, keep_nodes) if keep_nodes else None
+
+    return track_points[simplify_mask(lat, lon, tolerance, method, keep)].tolist()
+
+
+def simplify_relation_track(relation, track_points, tolerance=SIMPLIFY_TOLERANCE, method='douglas_peucker'):
+    """
+    Simplify track of relation, keeping way points of relation (see get_way_points).
+
+    @param relation: OSM relation as dictionary.
+    @param track_points: List of OSM node ids of track.
+    @param tolerance: Tolerance in meters.
+    @param method: Simplification method ('douglas_peucker' or 'visvalingam_whyatt').
+    @return: List of OSM node ids of simplified track.
+
+    >>> relation = get_relation_by_id(660162)
+    >>> simplified = simplify_relation_track(relation, track_points)
+    """
+
+    lat, lon = get_node_coordinates(track_points)
+
+    return simplify_track(track_points, lat, lon, tolerance, method, get_way_points(relation))
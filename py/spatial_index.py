@@ -0,0 +1,323 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import os
+import threading
+import numpy as np
+
+from geodesy import EARTH_RADIUS, haversine
+from osm_query import get_node_coordinates
+from trail_db import create_tables, select_relations, select_relation_versions
+
+# Size of grid cells (degrees), about 1 km
+SPATIAL_CELL_SIZE = 0.01
+
+# File name extension of index saved next to database file
+SPATIAL_INDEX_EXT = '.index.npz'
+
+# Records of index: node and relation ids, coordinates, and grid cell
+SPATIAL_DTYPE = np.dtype([('node', np.int64), ('relation', np.int64),
+                          ('lat', np.float64), ('lon', np.float64), ('cell', np.int64)])
+
+
+def grid_cell(lat, lon, cell_size=SPATIAL_CELL_SIZE):
+    """
+    Get grid cells of coordinates (row-major, so cells of a row are consecutive).
+
+    @param lat: Array of latitudes.
+    @param lon: Array of longitudes.
+    @param cell_size: Size of cells in degrees.
+    @return: Array of cells.
+
+    >>> grid_cell(np.array([-89.995, -89.995, -89.985]), np.array([-179.995, -179.985, -179.995]))
+    array([    0,     1, 36000])
+    """
+
+    columns = int(round(360.0 / cell_size))
+
+    row = np.floor((np.asarray(lat) + 90.0) / cell_size).astype(np.int64)
+    column = np.minimum(np.floor((np.asarray(lon) + 180.0) / cell_size).astype(np.int64), columns - 1)
+
+    return row * columns + column
+
+
+class SpatialIndex(object):
+    """
+    Grid index of nodes of stored relations (records sorted by grid cell), with bounding
+    box, radius, and k nearest neighbour queries.
+
+    >>> index = SpatialIndex()
+    >>> index.update_relation(1, [10, 11, 12], [59.30, 59.31, 59.40], [18.00, 18.01, 18.10])
+    >>> index.nearest(59.301, 18.0, k=2).node
+    array([10, 11])
+    """
+
+    def __init__(self, cell_size=SPATIAL_CELL_SIZE):
+        self.cell_size = cell_size
+        self.columns = int(round(360.0 / cell_size))
+
+        self.records = np.recarray(0, dtype=SPATIAL_DTYPE)
+        self.versions = {}
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.records.size
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Load index from file.
+
+        @param file_name: File name (.npz).
+        @return: SpatialIndex.
+        """
+
+        data = np.load(file_name)
+
+        index = cls(float(data['cell_size']))
+        index.records = data['records'].view(np.recarray)
+        index.versions = dict(zip(data['relations'].tolist(), data['versions'].tolist()))
+
+        return index
+
+    def save(self, file_name):
+        """
+        Save index to file (written to temporary file first, so readers never see a
+        partially written index).
+
+        @param file_name: File name (.npz).
+        """
+
+        relations = sorted(self.versions)
+
+        temp_file_name = file_name + '.tmp.npz'
+        np.savez(temp_file_name, records=self.records, cell_size=self.cell_size,
+                 relations=np.array(relations, dtype=np.int64),
+                 versions=np.array([self.versions[relation] for relation in relations], dtype=np.int64))
+        os.rename(temp_file_name, file_name)
+
+    def update(self, relations, nodes, lat, lon, versions=None):
+        """
+        Replace nodes of relations in index. Relations in versions are replaced too, so
+        relations without nodes are removed (and their versions recorded).
+
+        @param relations: Array of relation ids (one for each node).
+        @param nodes: Array of node ids.
+        @param lat: Array of latitudes of nodes (nodes with NaN coordinates are skipped).
+        @param lon: Array of longitudes of nodes.
+        @param versions: Dictionary of versions for relation ids (see
+                         trail_db.select_relation_versions).
+        """
+
+        relations = np.asarray(relations, dtype=np.int64)
+        versions = versions or {}
+        replaced = np.union1d(relations, np.array(list(versions), dtype=np.int64))
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+
+        known = ~(np.isnan(lat) | np.isnan(lon))
+
+        added = np.recarray(int(known.sum()), dtype=SPATIAL_DTYPE)
+        added.node = np.asarray(nodes, dtype=np.int64)[known]
+        added.relation = relations[known]
+        added.lat, added.lon = lat[known], lon[known]
+        added.cell = grid_cell(added.lat, added.lon, self.cell_size)
+
+        with self.lock:
+            records = self.records[~np.in1d(self.records.relation, replaced)]
+            records = np.concatenate([records, added]).view(np.recarray)
+
+            # Unique (relation, node) records, sorted by cell
+            records = records[np.lexsort((records.node, records.relation))]
+            unique = np.ones(records.size, dtype=bool)
+            unique[1:] = (records.relation[1:] != records.relation[:-1]) | (records.node[1:] != records.node[:-1])
+            records = records[unique]
+            self.records = records[np.argsort(records.cell, kind='mergesort')]
+
+            for relation in replaced.tolist():
+                self.versions[relation] = versions.get(relation, 0) or 0
+
+    def update_relation(self, relation_id, nodes, lat, lon, version=None):
+        """
+        Replace nodes of relation in index.
+
+        @param relation_id: Id of relation.
+        @param nodes: Array of node ids.
+        @param lat: Array of latitudes of nodes.
+        @param lon: Array of longitudes of nodes.
+        @param version: Version of relation (see trail_db.select_relation_versions).
+        """
+
+        self.update(np.full(len(nodes), relation_id, dtype=np.int64), nodes, lat, lon, {relation_id: version})
+
+    def remove(self, relation_ids):
+        """
+        Remove nodes of relations from index.
+
+        @param relation_ids: List of relation ids.
+        """
+
+        with self.lock:
+            self.records = self.records[~np.in1d(self.records.relation, relation_ids)]
+            for relation in relation_ids:
+                self.versions.pop(relation, None)
+
+    def bbox(self, min_longitude, min_latitude, max_longitude, max_latitude):
+        """
+        Get nodes in bounding box.
+
+        @param min_longitude: Min longitude of bounding box.
+        @param min_latitude: Min latitude of bounding box.
+        @param max_longitude: Max longitude of bounding box.
+        @param max_latitude: Max latitude of bounding box.
+        @return: Record array of nodes (node, relation, lat, lon, cell).
+        """
+
+        records = self.records
+
+        # One range of cells for each row of grid
+        row_min, row_max = (int(np.floor((latitude + 90.0) / self.cell_size))
+                            for latitude in (min_latitude, max_latitude))
+        column_min, column_max = (min(int(np.floor((longitude + 180.0) / self.cell_size)), self.columns - 1)
+                                  for longitude in (min_longitude, max_longitude))
+
+        rows = np.arange(row_min, row_max + 1, dtype=np.int64) * self.columns
+        begin = np.searchsorted(records.cell, rows + column_min, side='left')
+        end = np.searchsorted(records.cell, rows + column_max, side='right')
+
+        candidates = records[np.concatenate([np.arange(b, e) for b, e in zip(begin, end)])
+                             if begin.size else np.zeros(0, dtype=np.int64)]
+
+        inside = (candidates.lat >= min_latitude) & (candidates.lat <= max_latitude) & \
+                 (candidates.lon >= min_longitude) & (candidates.lon <= max_longitude)
+
+        return candidates[inside]
+
+    def radius(self, latitude, longitude, radius):
+        """
+        Get nodes within radius of coordinate, ordered by distance.
+
+        @param latitude: Latitude of center.
+        @param longitude: Longitude of center.
+        @param radius: Radius in meters.
+        @return: Record array of nodes, and array of distances in meters.
+        """
+
+        d_latitude = np.degrees(radius / EARTH_RADIUS)
+        d_longitude = d_latitude / max(np.cos(np.radians(min(abs(latitude) + d_latitude, 89.9))), 1e-6)
+
+        candidates = self.bbox(max(longitude - d_longitude, -180.0), max(latitude - d_latitude, -90.0),
+                               min(longitude + d_longitude, 180.0), min(latitude + d_latitude, 90.0))
+
+        distance = haversine(latitude, longitude, candidates.lat, candidates.lon)
+        order = np.argsort(distance, kind='mergesort')
+        order = order[distance[order] <= radius]
+
+        return candidates[order], distance[order]
+
+    def nearest(self, latitude, longitude, k=1):
+        """
+        Get k nearest nodes of coordinate (searching within increasing radius).
+
+        @param latitude: Latitude.
+        @param longitude: Longitude.
+        @param k: Number of nodes.
+        @return: Record array of nodes ordered by distance (fewer than k if index is small).
+        """
+
+        return self.nearest_with_distance(latitude, longitude, k)[0]
+
+    def nearest_with_distance(self, latitude, longitude, k=1):
+        """
+        Get k nearest nodes of coordinate, and their distances.
+
+        @param latitude: Latitude.
+        @param longitude: Longitude.
+        @param k: Number of nodes.
+        @return: Record array of nodes ordered by distance, and array of distances in meters.
+        """
+
+        radius = np.radians(self.cell_size) * EARTH_RADIUS
+        while True:
+            nodes, distance = self.radius(latitude, longitude, radius)
+            if nodes.size >= k or radius > np.pi * EARTH_RADIUS:
+                return nodes[:k], distance[:k]
+            radius *= 4.0
+
+
+def spatial_index_file_name(engine):
+    """
+    Get file name of spatial index of database (next to database file).
+
+    @param engine: Database engine (SQLite connection).
+    @return: File name (None for in-memory databases).
+    """
+
+    for _, name, file_name in engine.execute('pragma database_list').fetchall():
+        if name == 'main':
+            return file_name + SPATIAL_INDEX_EXT if file_name else None
+
+
+def sync_spatial_index(engine, index):
+    """
+    Update spatial index with relations added, changed (relation or any of its ways saved
+    with a new version), or removed in database.
+
+    @param engine: Database engine.
+    @param index: SpatialIndex.
+    @return: True if index was changed.
+    """
+
+    create_tables(engine)
+
+    stored = select_relation_versions(engine)
+
+    removed = [relation for relation in index.versions if relation not in stored]
+    changed = [relation for relation, version in stored.items() if index.versions.get(relation) != version]
+
+    if removed:
+        index.remove(removed)
+
+    for i in range(0, len(changed), 500):
+        chunk = changed[i:i + 500]
+        rows = select_relations(engine, 'select distinct relation, node from way_nodes', chunk, n_columns=2)
+        lat, lon = get_node_coordinates(rows[:, 1])
+        index.update(rows[:, 0], rows[:, 1], lat, lon, {relation: stored[relation] for relation in chunk})
+
+    return bool(removed or changed)
+
+
+def get_spatial_index(engine, save=True):
+    """
+    Load spatial index of database (saved next to database file), and update it with
+    relations added, changed, or removed since it was saved (built from nodes of stored
+    relations if no index is saved).
+
+    @param engine: Database engine.
+    @param save: Save index if it was updated.
+    @return: SpatialIndex.
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> index = get_spatial_index(engine)
+    >>> nodes, distance = index.radius(59.2766, 18.1870, 500.0)
+    >>> index.bbox(18.0, 59.0, 18.5, 59.5).relation
+    """
+
+    file_name = spatial_index_file_name(engine)
+
+    index = SpatialIndex.load(file_name) if file_name and os.path.exists(file_name) else SpatialIndex()
+
+    if sync_spatial_index(engine, index) and save and file_name:
+        index.save(file_name)
+
+    return index
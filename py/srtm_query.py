@@ -10,39 +10,344 @@ __license__ = "The MIT License (MIT)"
 __version__ = "0.1.0"
 __status__ = "Development"
 
+import os
 import sqlite3
-import pandas as pd
+import threading
+import numpy as np
 import srtm
 
-from osm_query import get_node_by_id
+from collections import OrderedDict
+from functools32 import lru_cache
 
+from instrumentation import instrumented, count_cache
+from osm_query import get_node_coordinates
+from trail_db import ensure_tables, upsert_rows, select_elevations
 
-def get_elevation(track_points):
+# Void value of SRTM height files (and limits used by srtm.py for valid heights)
+SRTM_VOID = -32768
+SRTM_MIN_ELEVATION = -1000
+SRTM_MAX_ELEVATION = 10000
+
+# Local directory of SRTM height files (same as srtm.py) and max number of memory-mapped tiles
+SRTM_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'srtm')
+SRTM_MAX_TILES = 16
+
+
+@lru_cache(maxsize=1)
+def get_elevation_data():
+    """
+    Get (and keep) the srtm.py elevation data object.
+
+    @return: GeoElevationData object.
+    """
+
+    return srtm.get_data()
+
+
+def get_tile_origin(latitude, longitude):
+    """
+    Get lower left corner (south west) of the SRTM tiles covering coordinates.
+
+    @param latitude: Array of latitudes, decimal degrees format.
+    @param longitude: Array of longitudes, decimal degrees format.
+    @return: Integer arrays with tile latitudes and tile longitudes.
+
+    >>> get_tile_origin(np.array([59.2766213, -33.5]), np.array([18.1870509, -70.25]))
+    (array([ 59, -34]), array([ 18, -71]))
+    """
+
+    return np.floor(latitude).astype(np.int64), np.floor(longitude).astype(np.int64)
+
+
+def get_hgt_file_name(tile_latitude, tile_longitude):
+    """
+    Get name of SRTM height file of tile.
+
+    @param tile_latitude: Latitude of lower left corner of tile.
+    @param tile_longitude: Longitude of lower left corner of tile.
+    @return: File name (string).
+
+    >>> get_hgt_file_name(59, 18)
+    'N59E018.hgt'
+    >>> get_hgt_file_name(-34, -71)
+    'S34W071.hgt'
+    """
+
+    return '%s%02d%s%03d.hgt' % ('N' if tile_latitude >= 0 else 'S', abs(tile_latitude),
+                                 'E' if tile_longitude >= 0 else 'W', abs(tile_longitude))
+
+
+class HgtTileStore(object):
+    """
+    Local store of SRTM height files (.hgt), memory-mapped read-only as big-endian int16 arrays.
+
+    Only the max_tiles most recently used tiles are kept mapped, so memory use is bounded
+    no matter how many tiles a batch job touches. Tiles missing on disk are downloaded
+    (once) with srtm.py if download is True.
+
+    >>> tile_store = HgtTileStore(max_tiles=4)
+    >>> tile = tile_store.get_tile(59, 18)
+    >>> tile_store.statistics()['misses']
+    1
+    """
+
+    def __init__(self, directory=SRTM_DIRECTORY, max_tiles=SRTM_MAX_TILES, download=True):
+        self.directory = directory
+        self.max_tiles = max_tiles
+        self.download = download
+
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_tile(self, tile_latitude, tile_longitude):
+        """
+        Get tile as array (rows from north to south, columns from west to east).
+
+        @param tile_latitude: Latitude of lower left corner of tile.
+        @param tile_longitude: Longitude of lower left corner of tile.
+        @return: Square int16 array with heights, or None if tile is missing (e.g. sea).
+        """
+
+        key = (tile_latitude, tile_longitude)
+
+        with self.lock:
+            if key in self.tiles:
+                self.hits += 1
+                count_cache('srtm_tiles', 'hit')
+                tile = self.tiles.pop(key)
+                self.tiles[key] = tile
+                return tile
+
+            self.misses += 1
+            count_cache('srtm_tiles', 'miss')
+            tile = self.map_tile(tile_latitude, tile_longitude)
+
+            self.tiles[key] = tile
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+                self.evictions += 1
+
+        return tile
+
+    @instrumented('srtm_query.HgtTileStore.map_tile')
+    def map_tile(self, tile_latitude, tile_longitude):
+        """
+        Memory-map height file of tile (download it first if needed).
+
+        @param tile_latitude: Latitude of lower left corner of tile.
+        @param tile_longitude: Longitude of lower left corner of tile.
+        @return: Read-only memory-mapped array, or None if tile is missing.
+        """
+
+        file_name = os.path.join(self.directory, get_hgt_file_name(tile_latitude, tile_longitude))
+
+        if not os.path.exists(file_name) and self.download:
+            download_tile(tile_latitude, tile_longitude, self.directory)
+
+        if not os.path.exists(file_name):
+            return None
+
+        side = int(round(np.sqrt(os.path.getsize(file_name) / 2.)))
+
+        return np.memmap(file_name, dtype='>i2', mode='r', shape=(side, side))
+
+    def statistics(self):
+        """
+        Get cache statistics of tile store.
+
+        @return: Dictionary with hits, misses, evictions, and number of mapped tiles.
+        """
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'tiles': len(self.tiles)}
+
+    def clear(self):
+        """
+        Unmap all tiles.
+        """
+
+        with self.lock:
+            self.tiles.clear()
+
+
+@lru_cache(maxsize=1)
+def get_tile_store():
+    """
+    Get (and keep) the default tile store.
+
+    @return: HgtTileStore object.
+    """
+
+    return HgtTileStore()
+
+
+def download_tile(tile_latitude, tile_longitude, directory=SRTM_DIRECTORY):
+    """
+    Download SRTM tile to local directory using srtm.py (no-op if no such tile exists).
+
+    @param tile_latitude: Latitude of lower left corner of tile.
+    @param tile_longitude: Longitude of lower left corner of tile.
+    @param directory: Directory of height files.
+    """
+
+    elevation_data = get_elevation_data()
+
+    file_name = elevation_data.get_file_name(tile_latitude + 0.5, tile_longitude + 0.5)
+    if not file_name:
+        return
+
+    data = elevation_data.retrieve_or_load_file_data(file_name)
+
+    file_name = os.path.join(directory, file_name)
+    if data and not os.path.exists(file_name):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(file_name + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(file_name + '.tmp', file_name)
+
+
+def sample_tile(tile, tile_latitude, tile_longitude, latitude, longitude, interpolate=False):
+    """
+    Sample heights of SRTM tile at coordinates (all within the tile).
+
+    @param tile: Square array with heights (see HgtTileStore.get_tile).
+    @param tile_latitude: Latitude of lower left corner of tile.
+    @param tile_longitude: Longitude of lower left corner of tile.
+    @param latitude: Array of latitudes.
+    @param longitude: Array of longitudes.
+    @param interpolate: Bilinear interpolation if True, otherwise nearest grid point.
+    @return: Array of elevations (NaN for voids).
+
+    >>> tile = np.array([[3, 4], [1, 2]], dtype='>i2')
+    >>> sample_tile(tile, 59, 18, np.array([59.5]), np.array([18.5]), interpolate=True)
+    array([2.5])
+    """
+
+    last = tile.shape[0] - 1
+
+    row = (tile_latitude + 1 - latitude) * last
+    column = (longitude - tile_longitude) * last
+
+    if not interpolate:
+        row = np.clip(np.rint(row).astype(np.int64), 0, last)
+        column = np.clip(np.rint(column).astype(np.int64), 0, last)
+        return valid_elevation(tile[row, column])
+
+    row_0 = np.clip(np.floor(row).astype(np.int64), 0, last - 1)
+    column_0 = np.clip(np.floor(column).astype(np.int64), 0, last - 1)
+
+    d_row = np.clip(row - row_0, 0.0, 1.0)
+    d_column = np.clip(column - column_0, 0.0, 1.0)
+
+    upper = valid_elevation(tile[row_0, column_0]) * (1.0 - d_column) + \
+        valid_elevation(tile[row_0, column_0 + 1]) * d_column
+    lower = valid_elevation(tile[row_0 + 1, column_0]) * (1.0 - d_column) + \
+        valid_elevation(tile[row_0 + 1, column_0 + 1]) * d_column
+
+    return upper * (1.0 - d_row) + lower * d_row
+
+
+def valid_elevation(heights):
+    """
+    Convert SRTM heights to float and replace voids (and invalid heights) with NaN.
+
+    @param heights: Array of SRTM heights.
+    @return: Array of elevations.
+    """
+
+    elevation = heights.astype(np.float64)
+    elevation[(heights < SRTM_MIN_ELEVATION) | (heights > SRTM_MAX_ELEVATION)] = np.nan
+
+    return elevation
+
+
+@instrumented('srtm_query.get_elevations')
+def get_elevations(latitude, longitude, interpolate=False, tile_store=None):
+    """
+    Get elevation of coordinates (vectorized).
+
+    Coordinates are grouped by SRTM tile, each tile is loaded once, and all elevations
+    of a tile are sampled in one pass.
+
+    @param latitude: Array (or list) of latitudes, decimal degrees format.
+    @param longitude: Array (or list) of longitudes, decimal degrees format.
+    @param interpolate: Bilinear interpolation if True, otherwise nearest grid point.
+    @param tile_store: Tile store (default tile store if None).
+    @return: Array of elevations in meters (NaN where no data is available, and for NaN
+             coordinates, e.g. of unknown nodes).
+
+    >>> latitude, longitude = np.array([59.2766213, 59.2775]), np.array([18.1870509, 18.19])
+    >>> elevation = get_elevations(latitude, longitude, interpolate=True)
+    """
+
+    if tile_store is None:
+        tile_store = get_tile_store()
+
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+
+    elevation = np.empty(latitude.shape, dtype=np.float64)
+    elevation.fill(np.nan)
+
+    # Coordinates that are not finite have no tile
+    known = np.flatnonzero(np.isfinite(latitude) & np.isfinite(longitude))
+    if known.size == 0:
+        return elevation
+
+    tile_latitude, tile_longitude = np.zeros(latitude.shape, dtype=np.int64), np.zeros(latitude.shape, dtype=np.int64)
+    tile_latitude[known], tile_longitude[known] = get_tile_origin(latitude[known], longitude[known])
+
+    # Group coordinates by tile (stable sort on a single tile key)
+    tile_key = (tile_latitude[known] + 90) * 360 + (tile_longitude[known] + 180)
+    sort = np.argsort(tile_key, kind='mergesort')
+    order = known[sort]
+    boundaries = np.flatnonzero(np.diff(tile_key[sort])) + 1
+
+    for index in np.split(order, boundaries):
+        tile_lat, tile_lon = int(tile_latitude[index[0]]), int(tile_longitude[index[0]])
+
+        tile = tile_store.get_tile(tile_lat, tile_lon)
+        if tile is None:
+            continue
+
+        elevation[index] = sample_tile(
+            tile, tile_lat, tile_lon, latitude[index], longitude[index], interpolate
+        )
+
+    return elevation
+
+
+@instrumented('srtm_query.get_elevation')
+def get_elevation(track_points, tile_store=None):
     """
     Get elevation of track points.
 
-    Typically, requesting elevation of track points can take time.
+    Thin wrapper around get_elevations (bilinear interpolation).
 
     @param track_points: List of OSM node ids.
+    @param tile_store: Tile store (default tile store if None).
     @return: Dictionary of elevations for node ids.
 
     >>> elevation_nodes = [360693242, 360693253, 360693255, 360693257, 550026012]
     >>> elevation = get_elevation(elevation_nodes)
     """
 
-    elevation = {}
-    for nd in track_points:
-        node = get_node_by_id(nd)
-        elevation_data = srtm.get_data()
-        elevation[nd] = elevation_data.get_elevation(node['lat'], node['lon'], approximate=True)
-        print 'Elevation (meters):', elevation[nd]
+    lat, lon = get_node_coordinates(track_points)
 
-    return elevation
+    elevations = get_elevations(lat, lon, interpolate=True, tile_store=tile_store)
+
+    return {nd: (None if np.isnan(value) else value) for nd, value in zip(track_points, elevations.tolist())}
 
 
+@instrumented('srtm_query.save_elevation_to_db')
 def save_elevation_to_db(engine, relation_id, elevation):
     """
-    Save elevations to database.
+    Save elevations to database (insert or update, only changed elevations are written).
 
     @param engine: Database engine.
     @param relation_id: Id of relation.
@@ -55,13 +360,11 @@ def save_elevation_to_db(engine, relation_id, elevation):
     >>> save_elevation_to_db(engine, relation_id, elevation)
     """
 
-    df_elevation = pd.DataFrame(
-        {'relation': relation_id,
-         'node': elevation.keys(),
-         'elevation': elevation.values()}, columns=['relation', 'node', 'elevation']
-    )
+    ensure_tables(engine)
 
-    df_elevation.to_sql('elevations', engine, if_exists='append', index=False)
+    with engine:
+        upsert_rows(engine, 'elevations', ['relation', 'node', 'elevation'], ['relation', 'node'],
+                    [(relation_id, int(node), value) for node, value in elevation.items()])
 
 
 def load_elevation_from_db(engine, relation_id=None):
@@ -69,24 +372,16 @@ def load_elevation_from_db(engine, relation_id=None):
     Load elevations from database.
 
     @param engine: Database engine.
-    @param relation_id: Id of relation
-    @return: Dictionary of elevations for OSM node ids.
+    @param relation_id: Id of relation, list of ids, or None (all relations).
+    @return: Dictionary of elevations for OSM node ids (None where elevation is missing).
 
     >>> engine = sqlite3.connect("relations.sqlite")
     >>> relation_id = 660162
     >>> elevation = load_elevation_from_db(engine, relation_id)
     """
 
-    where_relation_id = '' if relation_id is None else ' where relation="' + str(relation_id) + '"'
-
-    df_elevation = pd.read_sql_query(
-        'select * from elevations' + where_relation_id, engine, index_col='relation'
-    )
+    nodes, elevations = select_elevations(engine, relation_id)
 
-    d_elevation = pd.DataFrame(df_elevation.as_matrix(), columns=df_elevation.columns).to_dict()
-
-    elevation = {int(key): value for key, value in zip(d_elevation['node'].values(), d_elevation['elevation'].values())}
-
-    return elevation
+    return {node: (None if np.isnan(value) else value) for node, value in zip(nodes.tolist(), elevations.tolist())}
 
 
@@ -0,0 +1,52 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import time
+import threading
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter shared by threads (at most rate calls per second on
+    average, and at most burst calls at once).
+
+    >>> rate_limiter = RateLimiter(2.0)
+    >>> for i in range(4):
+    ...     rate_limiter.wait()  # Returns after about 1.5 seconds in total
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Wait until a call is allowed.
+        """
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+
+                delay = (1.0 - self.tokens) / self.rate
+
+            time.sleep(delay)
@@ -0,0 +1,253 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import numpy as np
+
+from collections import namedtuple
+
+from geodesy import cumulative_distance
+from osm_query import get_node_coordinates
+from srtm_query import get_elevation
+from trail_db import ensure_tables, upsert_rows, select_relations
+
+# Elevations are smoothed with a moving average over TRACK_SMOOTHING_DISTANCE meters
+# (removes SRTM noise, which otherwise adds to ascent and descent), and grades are
+# computed over TRACK_GRADE_DISTANCE meters.
+TRACK_SMOOTHING_DISTANCE = 100.0
+TRACK_GRADE_DISTANCE = 100.0
+
+# Naismith's rule: 5 km/h, plus 1 hour for every 600 meters of ascent
+NAISMITH_SPEED = 5000.0
+NAISMITH_ASCENT_RATE = 600.0
+
+# Metrics of track: distance, ascent and descent (meters), max grade (absolute value, rise
+# over run), and walking times (hours) using Naismith's rule and Tobler's hiking function.
+TrackMetrics = namedtuple('TrackMetrics', ['distance', 'ascent', 'descent', 'max_grade', 'naismith', 'tobler'])
+
+# Columns of stored metrics (one row for each relation)
+TRACK_METRICS_COLUMNS = ['relation'] + list(TrackMetrics._fields)
+
+
+def fill_elevation(distance, elevation):
+    """
+    Fill missing elevations (NaN) by linear interpolation along track.
+
+    @param distance: Array of cumulative distances.
+    @param elevation: Array of elevations (NaN where missing).
+    @return: Array of elevations (all NaN if no elevation is known).
+    """
+
+    elevation = np.asarray(elevation, dtype=np.float64)
+
+    known = ~np.isnan(elevation)
+    if known.all() or not known.any():
+        return elevation
+
+    return np.interp(distance, distance[known], elevation[known])
+
+
+def smooth_elevation(distance, elevation, window=TRACK_SMOOTHING_DISTANCE):
+    """
+    Smooth elevations with a moving average over distance (window centered at each point).
+
+    @param distance: Array of cumulative distances (non-decreasing).
+    @param elevation: Array of elevations.
+    @param window: Length of window in meters.
+    @return: Array of smoothed elevations.
+
+    >>> smooth_elevation(np.array([0., 10., 20., 30.]), np.array([0., 10., 0., 10.]), 20.0)
+    array([5.        , 3.33333333, 6.66666667, 5.        ])
+    """
+
+    elevation = np.asarray(elevation, dtype=np.float64)
+    if elevation.size < 2 or window <= 0:
+        return elevation
+
+    # Points within window of each point, and sums of elevations from cumulative sums
+    begin = np.searchsorted(distance, distance - window / 2.0, side='left')
+    end = np.searchsorted(distance, distance + window / 2.0, side='right')
+
+    cumulative = np.concatenate([[0.0], np.cumsum(elevation)])
+
+    return (cumulative[end] - cumulative[begin]) / (end - begin)
+
+
+def grade_profile(distance, elevation, step=TRACK_GRADE_DISTANCE):
+    """
+    Grade (rise over run) along track, over intervals of step meters.
+
+    @param distance: Array of cumulative distances.
+    @param elevation: Array of (smoothed) elevations.
+    @param step: Length of intervals in meters.
+    @return: Array of distances at start of intervals, and array of grades.
+
+    >>> grade_profile(np.array([0., 100., 200.]), np.array([0., 10., 5.]))
+    (array([  0., 100.]), array([ 0.1 , -0.05]))
+    """
+
+    if distance.size < 2 or distance[-1] <= 0:
+        return np.zeros(0), np.zeros(0)
+
+    n_steps = max(int(np.ceil(distance[-1] / step)), 1)
+    profile = np.linspace(0.0, distance[-1], n_steps + 1)
+
+    return profile[:-1], np.diff(np.interp(profile, distance, elevation)) / np.diff(profile)
+
+
+def tobler_speed(grade):
+    """
+    Walking speed using Tobler's hiking function.
+
+    Reference: https://en.wikipedia.org/wiki/Tobler%27s_hiking_function
+
+    @param grade: Grade(s) (rise over run).
+    @return: Speed(s) in meters per hour.
+
+    >>> round(tobler_speed(-0.05))
+    6000.0
+    """
+
+    return 6000.0 * np.exp(-3.5 * np.abs(np.asarray(grade) + 0.05))
+
+
+def track_metrics(track_points, lat, lon, elevation):
+    """
+    Compute metrics of track (vectorized).
+
+    @param track_points: List of OSM node ids of track.
+    @param lat: Array of latitudes of track points.
+    @param lon: Array of longitudes of track points.
+    @param elevation: Array of elevations of track points (NaN where missing), or
+                      dictionary of elevations for node ids (e.g. from get_elevation).
+    @return: TrackMetrics.
+
+    >>> lat, lon = np.linspace(59.0, 59.01, 11), np.full(11, 18.0)
+    >>> metrics = track_metrics(range(11), lat, lon, np.linspace(0.0, 100.0, 11))
+    >>> round(metrics.distance), round(metrics.ascent), round(metrics.descent)
+    (1112.0, 100.0, 0.0)
+    """
+
+    if isinstance(elevation, dict):
+        elevation = [elevation.get(nd) for nd in track_points]
+    elevation = np.array(elevation, dtype=np.float64)
+
+    distance = cumulative_distance(lat, lon)
+    length = distance[-1] if distance.size else 0.0
+
+    elevation = smooth_elevation(distance, fill_elevation(distance, elevation))
+
+    change = np.diff(elevation)
+    ascent = change[change > 0].sum()
+    descent = (-change[change < 0]).sum()
+
+    _, grade = grade_profile(distance, elevation)
+    max_grade = np.abs(grade).max() if grade.size else 0.0
+
+    # Tobler's hiking function for each segment between track points
+    run = np.diff(distance)
+    segment_grade = np.where(run > 0, change / np.where(run > 0, run, 1.0), 0.0)
+    tobler = (run / tobler_speed(segment_grade)).sum()
+
+    if np.isnan(elevation).all():
+        ascent = descent = max_grade = tobler = np.nan
+
+    naismith = length / NAISMITH_SPEED + ascent / NAISMITH_ASCENT_RATE
+
+    return TrackMetrics(*[float(value) for value in (length, ascent, descent, max_grade, naismith, tobler)])
+
+
+def get_track_metrics(track_points, elevation=None):
+    """
+    Compute metrics of track, using coordinates from node store (see get_node_coordinates).
+
+    @param track_points: List of OSM node ids of track.
+    @param elevation: Dictionary of elevations for node ids (get_elevation if None).
+    @return: TrackMetrics.
+
+    >>> relation = get_relation_by_id(660162)
+    >>> track_points = create_track_points(relation, 360693242)
+    >>> metrics = get_track_metrics(track_points)
+    """
+
+    lat, lon = get_node_coordinates(track_points)
+
+    if elevation is None:
+        elevation = get_elevation(track_points)
+
+    return track_metrics(track_points, lat, lon, elevation)
+
+
+def save_track_metrics_to_db(engine, relation_id, metrics):
+    """
+    Save metrics of track to database (insert or update).
+
+    @param engine: Database engine.
+    @param relation_id: Id of relation.
+    @param metrics: TrackMetrics.
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> save_track_metrics_to_db(engine, 660162, get_track_metrics(track_points))
+    """
+
+    ensure_tables(engine)
+
+    row = [int(relation_id)] + [None if np.isnan(value) else value for value in metrics]
+
+    with engine:
+        upsert_rows(engine, 'track_metrics', TRACK_METRICS_COLUMNS, ['relation'], [row])
+
+
+def load_track_metrics_from_db(engine, relation_id=None):
+    """
+    Load metrics of tracks from database.
+
+    @param engine: Database engine.
+    @param relation_id: Id of relation, list of ids, or None (all relations).
+    @return: Record array with relation and metrics (NaN where missing), one record
+             for each relation.
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> metrics = load_track_metrics_from_db(engine)
+    >>> metrics.relation[metrics.distance > 10000.0]
+    """
+
+    ensure_tables(engine)
+
+    rows = select_relations(
+        engine, 'select ' + ', '.join(TRACK_METRICS_COLUMNS) + ' from track_metrics', relation_id, ' order by relation',
+        n_columns=len(TRACK_METRICS_COLUMNS), dtype=np.float64
+    )
+
+    metrics = np.recarray(len(rows), dtype=[('relation', np.int64)] + [(name, np.float64)
+                                                                      for name in TrackMetrics._fields])
+    for i, name in enumerate(TRACK_METRICS_COLUMNS):
+        metrics[name] = rows[:, i]
+
+    return metrics
+
+
+def rank_tracks(metrics, by='tobler', ascending=True):
+    """
+    Rank tracks by a metric (tracks with missing metric last).
+
+    @param metrics: Record array of metrics (see load_track_metrics_from_db).
+    @param by: Name of metric.
+    @param ascending: Rank in ascending order.
+    @return: Array of relation ids in order of rank.
+
+    >>> metrics = load_track_metrics_from_db(engine)
+    >>> rank_tracks(metrics, by='ascent', ascending=False)[:10]
+    """
+
+    values = metrics[by] if ascending else -metrics[by]
+
+    return metrics['relation'][np.argsort(values, kind='mergesort')]
@@ -0,0 +1,370 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import zlib
+import sqlite3
+import warnings
+import numpy as np
+
+# Tables of relations, ways (relation members in order), way nodes and track points
+# (one row per node, in order), elevations of nodes, metrics of tracks (see track_metrics),
+# and versions of stored ways.
+TABLES = [
+    'create table if not exists relations ('
+    'relation integer primary key, name text, source text, version integer)',
+
+    'create table if not exists ways ('
+    'relation integer not null, seq integer not null, way integer not null, '
+    '"begin" integer not null, "end" integer not null, '
+    'primary key (relation, seq))',
+
+    'create table if not exists way_nodes ('
+    'relation integer not null, way_seq integer not null, seq integer not null, node integer not null, '
+    'primary key (relation, way_seq, seq)) without rowid',
+
+    'create table if not exists track_point_nodes ('
+    'relation integer not null, seq integer not null, node integer not null, '
+    'primary key (relation, seq)) without rowid',
+
+    'create table if not exists elevations ('
+    'relation integer not null, node integer not null, elevation real, '
+    'primary key (relation, node)) without rowid',
+
+    'create table if not exists track_metrics ('
+    'relation integer primary key, distance real, ascent real, descent real, max_grade real, '
+    'naismith real, tobler real)',
+
+    'create table if not exists way_versions ('
+    'way integer primary key, version integer)',
+]
+
+# Indexes for lookups by node (lookups by relation use the primary keys)
+INDEXES = [
+    'create index if not exists ways_way on ways (way)',
+    'create index if not exists way_nodes_node on way_nodes (node)',
+    'create index if not exists track_point_nodes_node on track_point_nodes (node)',
+    'create index if not exists elevations_node on elevations (node)',
+]
+
+# Tables that earlier versions wrote with pandas to_sql (without primary keys), and suffix of
+# renamed tables (see migrate_legacy_tables)
+LEGACY_TABLES = ['relations', 'ways', 'elevations']
+LEGACY_SUFFIX = '_legacy'
+
+# Columns of legacy tables that are copied to current tables (rows of repeated saves collapse
+# on primary key, last row wins)
+LEGACY_COPY = {'elevations': ['relation', 'node', 'elevation']}
+
+# Max number of variables in each SQL statement
+SQLITE_MAX_VARIABLES = 900
+
+# Upsert (insert ... on conflict do update) requires SQLite 3.24
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def table_info(engine, table):
+    """
+    Get columns of table.
+
+    @param engine: Database engine (SQLite connection).
+    @param table: Name of table.
+    @return: List of (name, position in primary key) of columns (empty if table does not exist).
+    """
+
+    return [(row[1], row[5]) for row in engine.execute('pragma table_info(' + table + ')').fetchall()]
+
+
+def migrate_legacy_tables(engine):
+    """
+    Rename tables written by earlier versions (pandas to_sql, without primary keys) to
+    <table>_legacy, so that tables of the current schema can be created. Rows of tables
+    in LEGACY_COPY are copied by create_tables. Relations of other renamed tables have to
+    be saved again (the old ways cannot be matched with their nodes reliably, since
+    relations were appended on every save). Legacy tables are kept, and can be dropped.
+
+    @param engine: Database engine (SQLite connection).
+    @return: List of renamed tables.
+    """
+
+    renamed = []
+    for table in LEGACY_TABLES:
+        columns = table_info(engine, table)
+        if not columns or any(key for _, key in columns):
+            continue
+
+        legacy = table + LEGACY_SUFFIX
+        if table_info(engine, legacy):
+            raise ValueError('Table %s has an earlier format, but %s already exists' % (table, legacy))
+
+        # Indexes move with the table, and would keep current indexes from being created
+        for row in engine.execute('pragma index_list(' + table + ')').fetchall():
+            if not row[1].startswith('sqlite_autoindex'):
+                engine.execute('drop index "' + row[1] + '"')
+
+        engine.execute('alter table ' + table + ' rename to ' + legacy)
+        renamed.append(table)
+
+    lost = [table for table in renamed if table not in LEGACY_COPY]
+    if lost:
+        warnings.warn('Tables %s have an earlier format and were renamed (suffix %s), save relations again'
+                      % (', '.join(lost), LEGACY_SUFFIX))
+
+    return renamed
+
+
+def create_tables(engine):
+    """
+    Create tables and indexes (if they do not exist), and use write-ahead logging (WAL).
+    Tables of earlier versions are renamed (see migrate_legacy_tables).
+
+    @param engine: Database engine (SQLite connection).
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> create_tables(engine)
+    """
+
+    engine.execute('PRAGMA journal_mode=WAL')
+
+    renamed = migrate_legacy_tables(engine)
+
+    for statement in TABLES + INDEXES:
+        engine.execute(statement)
+
+    for table in renamed:
+        if table in LEGACY_COPY:
+            columns = ', '.join('"' + column + '"' for column in LEGACY_COPY[table])
+            engine.execute(
+                'insert or replace into ' + table + ' (' + columns + ') select ' + columns + ' from ' +
+                table + LEGACY_SUFFIX + ' where ' + ' and '.join('"' + column + '" is not null'
+                                                                 for column in LEGACY_COPY[table][:-1]) +
+                ' order by rowid'
+            )
+            engine.commit()
+
+
+def ensure_tables(engine):
+    """
+    Create tables and indexes (see create_tables) unless they all exist, so functions
+    writing one relation at a time check the schema with one query only.
+
+    @param engine: Database engine (SQLite connection).
+    """
+
+    names = [statement.split()[5] for statement in TABLES + INDEXES]
+
+    n_existing = engine.execute(
+        'select count(*) from sqlite_master where name in (' + ','.join('?' * len(names)) + ')', names
+    ).fetchone()[0]
+
+    if n_existing < len(names):
+        create_tables(engine)
+
+
+def upsert_rows(engine, table, columns, keys, rows):
+    """
+    Insert rows into table, or update existing rows with the same keys.
+
+    Rows are only written if some value has changed (insert ... on conflict do update
+    ... where). With SQLite older than 3.24 existing rows are replaced.
+
+    @param engine: Database engine (SQLite connection).
+    @param table: Name of table.
+    @param columns: List of column names.
+    @param keys: List of key column names (primary key of table).
+    @param rows: List (or iterator) of row tuples (Python values, not NumPy scalars).
+    """
+
+    quote = lambda column: '"' + column + '"'
+
+    insert = 'into ' + table + ' (' + ', '.join(map(quote, columns)) + ') ' + \
+             'values (' + ', '.join('?' * len(columns)) + ')'
+
+    values = [column for column in columns if column not in keys]
+
+    if not SQLITE_HAS_UPSERT:
+        query = 'insert or replace ' + insert
+    elif not values:
+        query = 'insert ' + insert + ' on conflict (' + ', '.join(map(quote, keys)) + ') do nothing'
+    else:
+        query = 'insert ' + insert + ' on conflict (' + ', '.join(map(quote, keys)) + ') do update set ' + \
+                ', '.join(quote(column) + ' = excluded.' + quote(column) for column in values) + ' where ' + \
+                ' or '.join(table + '.' + quote(column) + ' is not excluded.' + quote(column) for column in values)
+
+    engine.executemany(query, rows)
+
+
+def where_relations(relation_ids):
+    """
+    Create where clauses (with bound parameters) selecting relations, one for each chunk
+    of (at most) SQLITE_MAX_VARIABLES relation ids. Ids are sorted, so queries ordered by
+    relation give ordered results when concatenated.
+
+    @param relation_ids: Id of relation, list of ids, or None (all relations).
+    @return: List of where clauses and lists of parameters (empty if list of ids is empty).
+
+    >>> where_relations(660162)
+    [(' where relation = ?', [660162])]
+    >>> where_relations([4570739, 660162])
+    [(' where relation in (?,?)', [660162, 4570739])]
+    """
+
+    if relation_ids is None:
+        return [('', [])]
+
+    if isinstance(relation_ids, (int, long, np.integer)):
+        return [(' where relation = ?', [int(relation_ids)])]
+
+    relation_ids = sorted(set(int(relation_id) for relation_id in relation_ids))
+
+    return [(' where relation in (' + ','.join('?' * len(chunk)) + ')', chunk)
+            for chunk in (relation_ids[i:i + SQLITE_MAX_VARIABLES]
+                          for i in range(0, len(relation_ids), SQLITE_MAX_VARIABLES))]
+
+
+def select_array(engine, query, parameters=(), n_columns=1, dtype=np.int64):
+    """
+    Select columns into array (one column for each selected column).
+
+    @param engine: Database engine (SQLite connection).
+    @param query: Query string (with ? parameters).
+    @param parameters: Query parameters.
+    @param n_columns: Number of selected columns.
+    @param dtype: Data type of array.
+    @return: Array of shape (number of rows, n_columns).
+    """
+
+    rows = engine.execute(query, parameters).fetchall()
+
+    return np.array(rows, dtype=dtype).reshape(len(rows), n_columns)
+
+
+def select_relations(engine, query, relation_ids, order='', n_columns=1, dtype=np.int64):
+    """
+    Select columns of relations into array (see select_array), with one query for each
+    chunk of relation ids (see where_relations).
+
+    @param engine: Database engine (SQLite connection).
+    @param query: Query string without where clause, e.g. 'select relation, node from way_nodes'.
+    @param relation_ids: Id of relation, list of ids, or None (all relations).
+    @param order: Order by clause, e.g. ' order by relation, seq'.
+    @param n_columns: Number of selected columns.
+    @param dtype: Data type of array.
+    @return: Array of shape (number of rows, n_columns).
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> nodes = select_relations(engine, 'select relation, node from way_nodes', relation_ids, n_columns=2)
+    """
+
+    arrays = [select_array(engine, query + where + order, parameters, n_columns, dtype)
+              for where, parameters in where_relations(relation_ids)]
+
+    if not arrays:
+        return np.empty((0, n_columns), dtype=dtype)
+
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+
+def select_versions(engine, way_ids):
+    """
+    Select stored versions of ways.
+
+    @param engine: Database engine (SQLite connection).
+    @param way_ids: List of way ids.
+    @return: Dictionary of versions for way ids.
+    """
+
+    way_ids = [int(way_id) for way_id in way_ids]
+
+    versions = {}
+    for i in range(0, len(way_ids), SQLITE_MAX_VARIABLES):
+        chunk = way_ids[i:i + SQLITE_MAX_VARIABLES]
+        versions.update(engine.execute(
+            'select way, version from way_versions where way in (' + ','.join('?' * len(chunk)) + ')', chunk
+        ).fetchall())
+
+    return versions
+
+
+def select_relation_versions(engine, relation_ids=None):
+    """
+    Select combined OSM versions of stored relations and their ways: version of relation
+    in high bits, and checksum of ids and versions of ways in low bits (so the combined
+    version changes if a way is saved with a new version, but the relation is not).
+
+    @param engine: Database engine (SQLite connection).
+    @param relation_ids: Id of relation, list of ids, or None (all relations).
+    @return: Dictionary of combined versions for relation ids.
+    """
+
+    versions = {}
+    for where, params in where_relations(relation_ids):
+        relations = engine.execute('select relation, coalesce(version, 0) from relations' + where, params).fetchall()
+
+        ways = select_array(
+            engine,
+            'select relation, way, version from (select w.relation as relation, w.seq as seq, w.way as way, '
+            'coalesce(v.version, 0) as version from ways w left join way_versions v on v.way = w.way)'
+            + where + ' order by relation, seq', params, n_columns=3
+        )
+        begin = np.searchsorted(ways[:, 0], [relation for relation, _ in relations], side='left')
+        end = np.searchsorted(ways[:, 0], [relation for relation, _ in relations], side='right')
+
+        for (relation, version), b, e in zip(relations, begin, end):
+            checksum = zlib.crc32(ways[b:e, 1:].tostring()) & 0xffffffff
+            versions[relation] = (int(version) << 32) | checksum
+
+    return versions
+
+
+def select_elevations(engine, relation_ids=None):
+    """
+    Select elevations of nodes of relations.
+
+    @param engine: Database engine (SQLite connection).
+    @param relation_ids: Id of relation, list of ids, or None (all relations).
+    @return: Arrays of node ids (int64) and elevations (NaN where elevation is missing).
+
+    >>> engine = sqlite3.connect("relations.sqlite")
+    >>> nodes, elevation = select_elevations(engine, [660162, 4570739])
+    """
+
+    nodes, elevations = [], []
+    for where, parameters in where_relations(relation_ids):
+        rows = engine.execute('select node, elevation from elevations' + where, parameters).fetchall()
+        nodes.extend(row[0] for row in rows)
+        elevations.extend(row[1] for row in rows)
+
+    return np.array(nodes, dtype=np.int64), np.array(elevations, dtype=np.float64)
+
+
+def split_by_key(key, values):
+    """
+    Split values into lists where key changes (key and values sorted accordingly).
+
+    @param key: Array of keys (or 2-d array with one key column for each key).
+    @param values: Array of values.
+    @return: List of lists of values.
+
+    >>> split_by_key(np.array([0, 0, 1, 1, 1, 3]), np.array([5, 6, 7, 8, 9, 10]))
+    [[5, 6], [7, 8, 9], [10]]
+    >>> split_by_key(np.array([[1, 0], [1, 0], [1, 1], [2, 0]]), np.array([5, 6, 7, 8]))
+    [[5, 6], [7], [8]]
+    """
+
+    if len(key) == 0:
+        return []
+
+    changes = np.diff(key, axis=0) != 0
+    if changes.ndim > 1:
+        changes = changes.any(axis=1)
+
+    return [chunk.tolist() for chunk in np.split(values, np.flatnonzero(changes) + 1)]
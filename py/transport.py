@@ -0,0 +1,368 @@
+#!/home/alpha/anaconda/bin/python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Carl Johan Rehn'
+__maintainer__ = "Carl Johan Rehn"
+__email__ = "care02@gmail.com"
+__credits__ = ["Sydney, The Red Merle"]
+__copyright__ = "Copyright (c) 2015, Carl Johan Rehn"
+__license__ = "The MIT License (MIT)"
+__version__ = "0.1.0"
+__status__ = "Development"
+
+import time
+import random
+import threading
+
+from email.utils import parsedate_tz, mktime_tz
+from functools import wraps
+
+import requests
+import osmapi
+import overpass
+
+from instrumentation import count_retry, instrument_session
+
+# Connections kept alive in the pool of each host
+TRANSPORT_POOL_SIZE = 8
+
+# Timeout (seconds) of connections, and of reads if not given by client
+TRANSPORT_CONNECT_TIMEOUT = 10
+TRANSPORT_READ_TIMEOUT = 120
+
+# Max number of retries of a request, and base and max delay (seconds) of exponential backoff
+TRANSPORT_MAX_RETRIES = 6
+TRANSPORT_BACKOFF = 1.0
+TRANSPORT_MAX_BACKOFF = 120.0
+
+# Responses that are retried (timeout, rate limited, server overloaded or unavailable)
+RETRY_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+# Methods that are retried (Overpass queries are sent with POST, but only read data)
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# Concurrency limit (requests in flight) of each service: initial, min, and max limit
+OSM_CONCURRENCY = (2, 1, 4)
+OVERPASS_CONCURRENCY = (1, 1, 2)
+
+# Limit is decreased when smoothed latency (recent requests) exceeds LATENCY_TOLERANCE times
+# baseline latency (smoothed over many requests, so requests of different sizes even out),
+# halved on errors, and increased by one per limit successful requests otherwise
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+LATENCY_BASELINE_SMOOTHING = 0.02
+LATENCY_DECREASE = 0.8
+ERROR_DECREASE = 0.5
+
+
+def retry_after(response):
+    """
+    Get delay of Retry-After header of response.
+
+    @param response: requests Response.
+    @return: Delay in seconds, or None if response has no (valid) Retry-After header.
+    """
+
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        date = parsedate_tz(value)
+        return max(mktime_tz(date) - time.time(), 0.0) if date else None
+
+
+def backoff_delay(retry, backoff=TRANSPORT_BACKOFF, max_backoff=TRANSPORT_MAX_BACKOFF):
+    """
+    Get delay of retry: exponential backoff with full jitter (random delay between zero
+    and backoff * 2 ** retry, at most max_backoff).
+
+    @param retry: Number of retry (0 for first retry).
+    @param backoff: Base delay in seconds.
+    @param max_backoff: Max delay in seconds.
+    @return: Delay in seconds.
+
+    >>> 0.0 <= backoff_delay(3, 1.0) <= 8.0
+    True
+    """
+
+    return random.uniform(0.0, min(max_backoff, backoff * 2 ** retry))
+
+
+def smooth(average, value, alpha):
+    """
+    Exponentially weighted moving average.
+
+    >>> smooth(1.0, 2.0, 0.25)
+    1.25
+    """
+
+    return value if average is None else (1 - alpha) * average + alpha * value
+
+
+def release_when_closed(response, release):
+    """
+    Call release once, when streamed response is closed, or its connection is returned to
+    the pool (body read to the end).
+
+    @param response: requests Response (stream=True).
+    @param release: Function called without arguments.
+    @return: Response.
+    """
+
+    lock = threading.Lock()
+    released = []
+
+    def release_once():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        release()
+
+    def releasing(method):
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            finally:
+                release_once()
+
+        return wrapper
+
+    response.close = releasing(response.close)
+    if getattr(response.raw, 'release_conn', None) is not None:
+        response.raw.release_conn = releasing(response.raw.release_conn)
+
+    return response
+
+
+class AdaptiveLimiter(object):
+    """
+    Adaptive concurrency limit of a service shared by threads (AIMD): the limit is
+    increased additively while requests succeed at normal latency, and decreased
+    multiplicatively on errors (at most once per smoothed latency, so a burst of
+    failures counts once) or when latency rises (queueing at server). Requests
+    wait while limit requests are in flight, or while service is paused (Retry-After).
+
+    >>> limiter = AdaptiveLimiter(2, 1, 4)
+    >>> limiter.acquire()
+    >>> limiter.release(0.1)
+    """
+
+    def __init__(self, limit, min_limit=1, max_limit=8):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+
+        self.latency = None
+        self.baseline = None
+        self.decreased = 0.0
+
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until a request is allowed.
+        """
+
+        with self.condition:
+            while True:
+                delay = self.paused_until - time.time()
+                if delay <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.condition.wait(delay if delay > 0 else None)
+
+            self.in_flight += 1
+
+    def release(self, latency=None, error=False):
+        """
+        Release request, and adapt limit to its outcome.
+
+        @param latency: Latency of request in seconds (None if no response).
+        @param error: True if request failed (error or retryable response).
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+
+            if latency is not None:
+                self.latency = smooth(self.latency, latency, LATENCY_SMOOTHING)
+                self.baseline = smooth(self.baseline, latency, LATENCY_BASELINE_SMOOTHING)
+
+            if error:
+                self.decrease(ERROR_DECREASE)
+            elif self.latency > LATENCY_TOLERANCE * self.baseline:
+                self.decrease(LATENCY_DECREASE)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            self.condition.notify_all()
+
+    def decrease(self, factor):
+        now = time.time()
+        if now - self.decreased > max(self.latency or 0.0, 1.0):
+            self.limit = max(self.min_limit, self.limit * factor)
+            self.decreased = now
+
+    def pause(self, seconds):
+        """
+        Pause all requests (e.g. Retry-After of response).
+
+        @param seconds: Pause in seconds.
+        """
+
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class RetryingSession(requests.Session):
+    """
+    HTTP session of a service: pooled keep-alive connections, timeouts, retries of
+    failed requests with exponential backoff and jitter (Retry-After is respected,
+    and pauses all requests to service), and an adaptive concurrency limit.
+
+    Responses that are still failing after max_retries retries are returned (and
+    connection errors raised), so clients handle them as before.
+
+    Streamed responses (stream=True) hold their slot of the concurrency limit until they
+    are closed or read to the end, so they must be closed (e.g. in a finally clause).
+
+    >>> session = RetryingSession('osm')
+    >>> response = session.get('https://www.openstreetmap.org/api/0.6/way/234171837')
+    """
+
+    def __init__(self, service, concurrency=OSM_CONCURRENCY, max_retries=TRANSPORT_MAX_RETRIES,
+                 backoff=TRANSPORT_BACKOFF, max_backoff=TRANSPORT_MAX_BACKOFF, retry_methods=RETRY_METHODS,
+                 timeout=TRANSPORT_READ_TIMEOUT, pool_size=TRANSPORT_POOL_SIZE):
+        requests.Session.__init__(self)
+
+        self.service = service
+        self.limiter = AdaptiveLimiter(*concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_methods = retry_methods
+        self.timeout = timeout
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        instrument_session(self, service)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (TRANSPORT_CONNECT_TIMEOUT, self.timeout))
+
+        retries = self.max_retries if method.upper() in self.retry_methods else 0
+
+        retry = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                response = requests.Session.request(self, method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.release(error=True)
+                if retry >= retries:
+                    raise
+                delay = None
+            else:
+                failed = response.status_code in RETRY_STATUS_CODES
+                latency = response.elapsed.total_seconds()
+                if not failed or retry >= retries:
+                    if kwargs.get('stream'):
+                        return release_when_closed(response, lambda: self.limiter.release(latency, failed))
+                    self.limiter.release(latency, failed)
+                    return response
+                self.limiter.release(latency, failed)
+                delay = retry_after(response)
+                response.close()
+
+            if delay is not None:
+                self.limiter.pause(delay)
+                delay += random.uniform(0.0, self.backoff)
+            else:
+                delay = backoff_delay(retry, self.backoff, self.max_backoff)
+
+            count_retry(self.service)
+            time.sleep(delay)
+            retry += 1
+
+    def statistics(self):
+        """
+        Get state of concurrency limit.
+
+        @return: Dictionary with limit, requests in flight, and smoothed and baseline latency.
+        """
+
+        limiter = self.limiter
+
+        return {'limit': limiter.limit, 'in_flight': limiter.in_flight,
+                'latency': limiter.latency, 'baseline': limiter.baseline}
+
+
+class OsmApiClient(osmapi.OsmApi):
+    """
+    OSM API client sending requests with a RetryingSession (retries of osmapi are
+    replaced by retries of session).
+
+    >>> osm_api = OsmApiClient(api='https://www.openstreetmap.org')
+    >>> way = osm_api.WayGet(234171837)
+    """
+
+    def __init__(self, session=None, **kwargs):
+        self.session = session or RetryingSession('osm', OSM_CONCURRENCY)
+
+        osmapi.OsmApi.__init__(self, **kwargs)
+
+    def _get_http_session(self):
+        self.session.headers['User-Agent'] = self._created_by
+
+        return self.session
+
+    def _http(self, cmd, path, auth, send, return_value=True):
+        return self._http_request(cmd, path, auth, send, return_value=return_value)
+
+
+class OverpassApiClient(overpass.API):
+    """
+    Overpass API client sending queries with a RetryingSession (POST is retried, since
+    queries only read data).
+
+    >>> overpass_api = OverpassApiClient()
+    >>> relation = overpass_api.Get('relation["name"~"Skåneleden"]')
+    """
+
+    def __init__(self, session=None, **kwargs):
+        self.session = session or RetryingSession('overpass', OVERPASS_CONCURRENCY,
+                                                  retry_methods=RETRY_METHODS | set(['POST']))
+
+        overpass.API.__init__(self, **kwargs)
+
+    def _get_from_overpass(self, query):
+        try:
+            response = self.session.post(self.endpoint, data={'data': query}, timeout=self.timeout,
+                                         proxies=self.proxies, headers=self.headers)
+        except requests.Timeout:
+            raise overpass.TimeoutError(self.timeout)
+
+        self._status = response.status_code
+
+        if self._status == 400:
+            raise overpass.OverpassSyntaxError(query)
+        elif self._status == 429:
+            raise overpass.MultipleRequestsError()
+        elif self._status == 504:
+            raise overpass.ServerLoadError(self.timeout)
+        elif self._status != 200:
+            raise overpass.UnknownOverpassError('The request returned status code %d' % self._status)
+
+        response.encoding = 'utf-8'
+
+        return response
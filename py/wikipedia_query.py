@@ -10,36 +10,361 @@ __license__ = "The MIT License (MIT)"
 __version__ = "0.1.0"
 __status__ = "Development"
 
-import os
+import json
+import time
+import hashlib
+import threading
 from urlparse import urlparse
 
+from concurrent.futures import ThreadPoolExecutor
 from functools32 import lru_cache
-from pattern.web import URL, plaintext
 
-import requests
-from PIL import Image
-from StringIO import StringIO
+import numpy as np
 
 from simplemediawiki import MediaWiki
 
+from geodesy import cumulative_distance, haversine
+from image_download import DOWNLOAD_MAX_WORKERS, download_files, create_thumbnails
+from instrumentation import instrumented, count_cache, count_request, watch_lru_cache
+from lazy_import import LazyObject, lazy_import
+from osm_cache import get_entity_cache
+from throttle import RateLimiter
+
+pattern_web = lazy_import('pattern.web')
+
 # WIKIPEDIA_LANGUGAGE = 'dk'
 # WIKIPEDIA_LANGUGAGE = 'en'
 WIKIPEDIA_LANGUGAGE = 'sv'
 
-get_wikipedia_url = lambda: 'http://' + WIKIPEDIA_LANGUGAGE + '.wikipedia.org/w/api.php'
+# Url of API if not Wikipedia of WIKIPEDIA_LANGUGAGE (see set_wikipedia_api)
+wikipedia_api_url = None
+
+get_wikipedia_url = lambda: wikipedia_api_url or 'http://' + WIKIPEDIA_LANGUGAGE + '.wikipedia.org/w/api.php'
+
+# Max number of titles or page ids in each request (MediaWiki API limit)
+WIKIPEDIA_REQUEST_MAX_PAGES = 50
+
+# Number of threads sending requests, and max number of requests per second
+WIKIPEDIA_MAX_WORKERS = 4
+WIKIPEDIA_REQUESTS_PER_SECOND = 5.0
+
+wikipedia_rate_limiter = RateLimiter(WIKIPEDIA_REQUESTS_PER_SECOND)
+
+# Cached responses are fresh for WIKIPEDIA_CACHE_TTL seconds, and are then revalidated
+# (using revisions of pages) or fetched again. Responses are kept in the entity cache (see
+# osm_cache) for at most WIKIPEDIA_CACHE_MAX_AGE seconds.
+WIKIPEDIA_CACHE_TTL = 24 * 3600
+WIKIPEDIA_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Hits, misses, and revalidations of cached responses (of all clients)
+wikipedia_cache_statistics = {'hits': 0, 'misses': 0, 'revalidated': 0, 'changed': 0}
+wikipedia_cache_lock = threading.Lock()
+
+
+def count_wikipedia_cache(name):
+    """
+    Count hit, miss, or revalidation of cached response. In instrumentation, revalidated
+    responses have their own counter (not in hit ratio), and changed responses (fetched
+    again) count as misses.
+
+    @param name: Name of counter.
+    """
+
+    with wikipedia_cache_lock:
+        wikipedia_cache_statistics[name] += 1
+
+    count_cache('wikipedia', {'hits': 'hit', 'misses': 'miss', 'changed': 'miss'}.get(name, name))
+
+
+def get_wikipedia_cache_statistics():
+    """
+    Get statistics of cached Wikipedia responses (of this process).
+
+    @return: Dictionary with hits, misses, hit rate, revalidated (responses still fresh
+             after revalidation), and changed (responses fetched again after revalidation).
+             The hit rate counts changed responses as misses, and leaves out revalidated
+             responses.
+    """
+
+    with wikipedia_cache_lock:
+        statistics = dict(wikipedia_cache_statistics)
+
+    n_calls = statistics['hits'] + statistics['misses'] + statistics['changed']
+    statistics['hit_rate'] = float(statistics['hits']) / n_calls if n_calls else 0.0
+
+    return statistics
+
+
+def get_revisions(response):
+    """
+    Get revisions of pages of query response.
+
+    @param response: Query response.
+    @return: Dictionary of revision ids for page ids, or None if the revisions of some
+             pages are unknown (e.g. missing pages, or responses without prop=info).
+    """
+
+    pages = response.get('query', {}).get('pages')
+    if not pages:
+        return None
+
+    revisions = {}
+    for page_id, page in pages.items():
+        if 'lastrevid' not in page:
+            return None
+        revisions[page_id] = page['lastrevid']
+
+    return revisions
+
+
+class CachedMediaWiki(MediaWiki):
+    """
+    MediaWiki client with a persistent cache of query responses, keyed by host name of
+    API (i.e. language) and normalized request parameters. Requests sent to the API are
+    rate limited (see set_wikipedia_rate_limit).
+
+    Responses are fresh for ttl seconds. After that, responses with pages are revalidated
+    by requesting the last revisions of the pages (one small request), and other responses
+    are fetched again. Entries are stored in the entity cache (expiry and LRU eviction, see
+    osm_cache), where a response counts as one entry whatever its size. Only queries are
+    cached (not tokens, logins, or edits).
+
+    >>> wiki = CachedMediaWiki('http://sv.wikipedia.org/w/api.php')
+    >>> result = wiki.call({'action': 'query', 'list': 'search', 'srsearch': 'Skåneleden'})
+    >>> get_wikipedia_cache_statistics()['misses']
+    1
+    """
+
+    def __init__(self, api_url, cache=None, ttl=WIKIPEDIA_CACHE_TTL, max_age=WIKIPEDIA_CACHE_MAX_AGE, **kwargs):
+        MediaWiki.__init__(self, api_url, **kwargs)
+
+        self.cache = cache
+        self.ttl = ttl
+        self.max_age = max_age
+
+        self.kind = 'wiki:' + urlparse(api_url).netloc
+
+    @staticmethod
+    def cache_key(params):
+        """
+        Get cache key of request (hash of parameters, excluding format).
+
+        @param params: Dictionary of query parameters.
+        @return: Cache key.
+        """
+
+        normalized = sorted((unicode(key), value if isinstance(value, unicode) else str(value).decode('utf-8'))
+                            for key, value in params.items() if key != 'format')
+
+        return hashlib.sha1(json.dumps(normalized)).hexdigest()
+
+    @staticmethod
+    def is_cached(params):
+        return params.get('action') == 'query' and 'meta' not in params
+
+    def _fetch_http(self, url, params):
+        data = MediaWiki._fetch_http(self, url, params)
+        count_request('wikipedia', len(data))
+
+        return data
+
+    def fetch(self, params, rate_limiter=None):
+        (rate_limiter or wikipedia_rate_limiter).wait()
+
+        return MediaWiki.call(self, dict(params))
+
+    def revalidate(self, revisions, rate_limiter=None):
+        """
+        Check if revisions of pages are the last revisions.
+
+        @param revisions: Dictionary of revision ids for page ids.
+        @param rate_limiter: RateLimiter.
+        @return: True if no page has a newer revision.
+        """
+
+        page_ids = sorted(revisions)
+        for i in range(0, len(page_ids), WIKIPEDIA_REQUEST_MAX_PAGES):
+            response = self.fetch({'action': 'query', 'prop': 'info',
+                                   'pageids': '|'.join(page_ids[i:i + WIKIPEDIA_REQUEST_MAX_PAGES])}, rate_limiter)
+            if get_revisions(response) != dict((page_id, revisions[page_id])
+                                               for page_id in page_ids[i:i + WIKIPEDIA_REQUEST_MAX_PAGES]):
+                return False
+
+        return True
+
+    @instrumented('wikipedia_query.wiki.call')
+    def call(self, params, rate_limiter=None):
+        """
+        Call API (query responses are cached).
+
+        @param params: Dictionary of query parameters.
+        @param rate_limiter: RateLimiter (wikipedia_rate_limiter if None).
+        @return: Dictionary containing API response.
+        """
+
+        if not self.is_cached(params):
+            return self.fetch(params, rate_limiter)
+
+        cache = self.cache or get_entity_cache()
+        key = self.cache_key(params)
+
+        entry = cache.get(self.kind, key)
+        if entry is not None:
+            if time.time() - entry['fetched'] < self.ttl:
+                count_wikipedia_cache('hits')
+                return entry['response']
+
+            revisions = get_revisions(entry['response'])
+            if revisions is not None and self.revalidate(revisions, rate_limiter):
+                count_wikipedia_cache('revalidated')
+                cache.put(self.kind, key, dict(entry, fetched=time.time()), self.max_age)
+                return entry['response']
+
+            count_wikipedia_cache('changed')
+        else:
+            count_wikipedia_cache('misses')
+
+        response = self.fetch(params, rate_limiter)
+        if 'error' not in response:
+            cache.put(self.kind, key, {'response': response, 'fetched': time.time()}, self.max_age)
+
+        return response
+
 
 # wiki = MediaWiki('http://sv.wikipedia.org/w/api.php')
-wiki = MediaWiki(get_wikipedia_url())
+# Client is created on first use
+wiki = LazyObject(lambda: CachedMediaWiki(get_wikipedia_url()))
+
+# MediaWiki clients of threads (clients are not shared by threads)
+wiki_clients = threading.local()
 
-# TODO Check limits on requests..
-# Volatile! Request MAX_LENGTH pages in each call to wikipedia
-WIKIPEDIA_REQUEST_MAX_PAGES = 1  # 5
+# Max radius (meters) and max number of results of geosearch (MediaWiki API limits)
+WIKIPEDIA_GEOSEARCH_MAX_RADIUS = 10000
+WIKIPEDIA_GEOSEARCH_MAX_LIMIT = 500
 
 get_titles = lambda list_of_titles: '|'.join(list_of_titles)
 
 get_page_ids = lambda list_of_page_ids: '|'.join(map(str, list_of_page_ids))
 
 
+def get_wiki():
+    """
+    Get MediaWiki client of current thread (wiki in main thread).
+
+    @return: MediaWiki client.
+    """
+
+    if isinstance(threading.current_thread(), threading._MainThread):
+        return wiki
+
+    client = getattr(wiki_clients, 'client', None)
+    if client is None or client._api_url != get_wikipedia_url():
+        client = wiki_clients.client = CachedMediaWiki(get_wikipedia_url())
+
+    return client
+
+
+def set_wikipedia_api(api_url=None):
+    """
+    Connect to MediaWiki API, e.g. a local (stub) server (Wikipedia of WIKIPEDIA_LANGUGAGE
+    if None).
+
+    Note that responses are cached on disk (see CachedMediaWiki), so use a separate entity
+    cache when connecting to a test server.
+
+    @param api_url: Url of MediaWiki API (api.php).
+    @return: MediaWiki client.
+
+    >>> wiki = set_wikipedia_api('http://localhost:8000/w/api.php')
+    """
+
+    global wikipedia_api_url, wiki
+
+    wikipedia_api_url = api_url
+    wiki = CachedMediaWiki(get_wikipedia_url())
+
+    return wiki
+
+
+def set_wikipedia_rate_limit(requests_per_second):
+    """
+    Set max number of requests per second to Wikipedia (shared by all threads).
+
+    @param requests_per_second: Max number of requests per second.
+    @return: RateLimiter.
+    """
+
+    global wikipedia_rate_limiter
+
+    wikipedia_rate_limiter = RateLimiter(requests_per_second)
+
+    return wikipedia_rate_limiter
+
+
+def merge_pages(pages, new_pages):
+    """
+    Merge pages of continued query into pages (lists, e.g. categories and images, are
+    extended, and other properties are added).
+
+    @param pages: Dictionary of pages for page ids (updated).
+    @param new_pages: Dictionary of pages for page ids.
+    @return: Dictionary of pages.
+
+    >>> pages = {'1': {'pageid': 1, 'images': [{'title': 'a'}]}}
+    >>> merge_pages(pages, {'1': {'pageid': 1, 'images': [{'title': 'b'}], 'extract': 'c'}})['1']['images']
+    [{'title': 'a'}, {'title': 'b'}]
+    """
+
+    for page_id, new_page in new_pages.items():
+        page = pages.setdefault(page_id, {})
+        for key, value in new_page.items():
+            if isinstance(value, list) and isinstance(page.get(key), list):
+                page[key].extend(value)
+            elif key not in page:
+                page[key] = value
+
+    return pages
+
+
+def wikipedia_query(params, rate_limiter=None):
+    """
+    Query Wikipedia and follow continue tokens until the query is complete (pages of all
+    responses are merged). Responses are cached (see CachedMediaWiki).
+
+    Reference: https://www.mediawiki.org/wiki/API:Query#Continuing_queries
+
+    @param params: Dictionary of query parameters.
+    @param rate_limiter: RateLimiter (wikipedia_rate_limiter if None).
+    @return: Query result (as from a single request).
+    """
+
+    params = dict(params, **{'continue': ''})
+
+    result = {}
+    while True:
+        response = get_wiki().call(params, rate_limiter)
+
+        if 'error' in response:
+            raise ValueError('Wikipedia query failed: %s' % response['error'].get('info'))
+
+        query = response.get('query', {})
+        if not result:
+            result = {'query': dict(query)}
+        else:
+            for key, value in query.items():
+                if key == 'pages':
+                    merge_pages(result['query'].setdefault('pages', {}), value)
+                elif isinstance(value, list):
+                    result['query'].setdefault(key, []).extend(value)
+                else:
+                    result['query'].setdefault(key, value)
+
+        if 'continue' not in response:
+            return result
+
+        params.update(response['continue'])
+
+
 @lru_cache(maxsize=128)
 def wikipedia_geosearch(latitude, longitude, radius, limit=100):
     """
@@ -59,7 +384,7 @@ def wikipedia_geosearch(latitude, longitude, radius, limit=100):
     u'Abrahamsberg'
     """
 
-    return wiki.call(
+    return wikipedia_query(
         {'action': 'query',
          'list': 'geosearch',
          'gscoord': str(latitude) + '|' + str(longitude),
@@ -69,10 +394,201 @@ def wikipedia_geosearch(latitude, longitude, radius, limit=100):
     )
 
 
+def cover_track(lat, lon, radius):
+    """
+    Cover track with circles (greedy): each circle is centered at a track point, and
+    covers the track points within radius of its center. Sections of the track that
+    revisit earlier circles (e.g. out-and-back tracks) are covered by those circles, and
+    new circles are only added where the track leaves all circles.
+
+    @param lat: Array of latitudes of track points.
+    @param lon: Array of longitudes of track points.
+    @param radius: Radius of circles in meters.
+    @return: List of (center, first, last) indexes of track points of each section of
+             track covered by a circle (all track points from first to last are within
+             radius of center). A circle covering several sections is listed once for
+             each section.
+
+    >>> lat, lon = np.linspace(59.0, 59.1, 101), np.full(101, 18.0)
+    >>> cover_track(lat, lon, 3000.0)
+    [(26, 0, 52), (79, 53, 100)]
+
+    Out-and-back track (2.9 km north, back, and 3 km south):
+
+    >>> lat = 59.0 + np.concatenate([np.linspace(0.0, 0.026, 27), np.linspace(0.026, 0.0, 27)[1:],
+    ...                              np.linspace(0.0, -0.027, 28)[1:]])
+    >>> lon = np.full(lat.size, 18.0)
+    >>> circles = cover_track(lat, lon, 3000.0)
+    >>> all(haversine(lat[center], lon[center], lat[first:last + 1], lon[first:last + 1]).max() <= 3000.0
+    ...     for center, first, last in circles)
+    True
+    >>> len(set(center for center, first, last in circles))
+    2
+    """
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    def first_outside(center, begin):
+        outside = np.flatnonzero(haversine(lat[center], lon[center], lat[begin:], lon[begin:]) > radius)
+        return begin + int(outside[0]) if outside.size else lat.size
+
+    centers, circles = [], []
+    first = 0
+    while first < lat.size:
+        # Earlier circle covering first, and the longest run of points from first
+        covering = np.array(centers, dtype=np.int64)
+        covering = covering[haversine(lat[first], lon[first], lat[covering], lon[covering]) <= radius].tolist()
+        if covering:
+            end, center = max((first_outside(center, first), center) for center in covering)
+            circles.append((center, first, end - 1))
+            first = end
+            continue
+
+        # Center is the last track point (within radius of first) such that all points from
+        # first to center are within radius of center. If points from first to center are
+        # within radius - 2 * slack of center, then so are points up to any later point
+        # within slack of center (and candidates are skipped)
+        end = first_outside(first, first)
+        center = first
+        while center + 1 < end:
+            distance = haversine(lat[center], lon[center], lat[first:end], lon[first:end])
+            slack = (radius - distance[:center - first + 1].max()) / 2.0
+
+            ahead = distance[center - first + 1:]
+            outside = np.flatnonzero(ahead > slack)
+            skip = int(outside[0]) if outside.size else ahead.size
+            if skip:
+                center += skip
+                continue
+
+            candidate = center + 1
+            if haversine(lat[candidate], lon[candidate], lat[first:candidate], lon[first:candidate]).max() > radius:
+                break
+            center = candidate
+
+        last = first_outside(center, first) - 1
+
+        centers.append(center)
+        circles.append((center, first, last))
+        first = last + 1
+
+    return circles
+
+
+def wikipedia_corridor_search(lat, lon, width=1000.0, radius=WIKIPEDIA_GEOSEARCH_MAX_RADIUS,
+                              max_workers=WIKIPEDIA_MAX_WORKERS):
+    """
+    Find Wikipedia articles within a corridor along a track.
+
+    The track is covered by geosearch circles (at most WIKIPEDIA_GEOSEARCH_MAX_RADIUS), so
+    that the corridor is inside the circles, and the circles are searched concurrently
+    (rate limited). Pages found by several circles are returned once.
+
+    Each circle returns at most WIKIPEDIA_GEOSEARCH_MAX_LIMIT pages, so the track points
+    of circles with that many pages are covered again with circles of half the radius.
+
+    @param lat: Array of latitudes of track points.
+    @param lon: Array of longitudes of track points.
+    @param width: Max distance (meters) of pages from track.
+    @param radius: Radius (meters) of geosearch circles.
+    @param max_workers: Number of threads sending requests.
+    @return: List of pages (pageid, title, lat, lon, and distance along track and offset
+             from track in meters), ordered by distance along track.
+
+    >>> pages = wikipedia_corridor_search(lat, lon, width=500.0)
+    >>> [(page['title'], int(page['distance'])) for page in pages]
+    """
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    if radius <= width:
+        raise ValueError('Radius of circles must be larger than width of corridor')
+
+    distance = cumulative_distance(lat, lon)
+
+    def covered_points(sections):
+        # Indexes of track points covered by each circle (sections of a circle joined)
+        points = {}
+        for center, first, last in sections:
+            points.setdefault(center, []).append(np.arange(first, last + 1))
+        return [(center, np.concatenate(points[center])) for center in sorted(points)]
+
+    def search(circle):
+        center, indexes, circle_radius = circle
+        found = wikipedia_geosearch(float(lat[center]), float(lon[center]), int(circle_radius),
+                                    WIKIPEDIA_GEOSEARCH_MAX_LIMIT)['query'].get('geosearch', [])
+
+        if len(found) < WIKIPEDIA_GEOSEARCH_MAX_LIMIT or circle_radius / 2.0 <= width:
+            return [(center, circle_radius, found)]
+
+        # Truncated result, split circle
+        results = []
+        for sub_center, sub_indexes in covered_points(cover_track(lat[indexes], lon[indexes],
+                                                                  circle_radius / 2.0 - width)):
+            results.extend(search((indexes[sub_center], indexes[sub_indexes], circle_radius / 2.0)))
+        return results
+
+    circles = [(center, indexes, float(radius))
+               for center, indexes in covered_points(cover_track(lat, lon, radius - width))]
+
+    if len(circles) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(min(max_workers, len(circles))) as executor:
+            results = list(executor.map(search, circles))
+    else:
+        results = map(search, circles)
+
+    pages = {}
+    for center, circle_radius, found in (circle for result in results for circle in result):
+        found = [page for page in found if page['pageid'] not in pages]
+        if not found:
+            continue
+
+        # Nearest track point, of track points within radius plus width of center (not only
+        # points covered by circle, since pages near a loop are near several parts of track)
+        near = np.flatnonzero(haversine(lat[center], lon[center], lat, lon) <= circle_radius + width)
+
+        page_lat = np.array([page['lat'] for page in found])
+        page_lon = np.array([page['lon'] for page in found])
+        offset = haversine(page_lat[:, np.newaxis], page_lon[:, np.newaxis], lat[near], lon[near])
+        nearest = offset.argmin(axis=1)
+
+        for page, i, page_offset in zip(found, near[nearest].tolist(),
+                                        offset[np.arange(len(found)), nearest].tolist()):
+            if page_offset <= width:
+                pages[page['pageid']] = dict(page, distance=float(distance[i]), offset=page_offset)
+
+    return sorted(pages.values(), key=lambda page: page['distance'])
+
+
+def wikipedia_track_search(track_points, width=1000.0, radius=WIKIPEDIA_GEOSEARCH_MAX_RADIUS):
+    """
+    Find Wikipedia articles within a corridor along a track of OSM nodes.
+
+    @param track_points: List of OSM node ids of track.
+    @param width: Max distance (meters) of pages from track.
+    @param radius: Radius (meters) of geosearch circles.
+    @return: List of pages, ordered by distance along track (see wikipedia_corridor_search).
+
+    >>> relation = get_relation_by_id(660162)
+    >>> track_points = create_track_points(relation, 360693242)
+    >>> pages = wikipedia_track_search(track_points)
+    """
+
+    from osm_query import get_node_coordinates
+
+    lat, lon = get_node_coordinates(track_points)
+    known = ~(np.isnan(lat) | np.isnan(lon))
+
+    return wikipedia_corridor_search(lat[known], lon[known], width, radius)
+
+
 @lru_cache(maxsize=128)
 def get_wikipedia_page(key, value):
     """
-    Get Wikipedia pages using titles or page ids.
+    Get Wikipedia pages using titles or page ids (at most WIKIPEDIA_REQUEST_MAX_PAGES),
+    following continue tokens.
 
     @param key: Key is a string with value 'titles' or 'pageids'.
     @param value: As string with titles or page ids separated by '|'.
@@ -88,11 +604,15 @@ def get_wikipedia_page(key, value):
     d_wiki = {'action': 'query',
               'prop': 'categories|coordinates|extracts|info|images',
               'inprop': 'url',
-              'continue': ''}
+              'cllimit': 'max',
+              'colimit': 'max',
+              'exlimit': 'max',
+              'exintro': '',
+              'imlimit': 'max'}
 
     d_wiki[key] = value
 
-    return wiki.call(d_wiki)
+    return wikipedia_query(d_wiki)
 
 
 @lru_cache(maxsize=128)
@@ -112,7 +632,7 @@ def wikipedia_image_urls(titles):
     u'http://upload.wikimedia.org/wikipedia/commons/9/9b/Aromatic_dec_2013b.jpg'
     """
 
-    image_info = wiki.call(
+    image_info = get_wiki().call(
         {'action': 'query',
          'titles': titles,
          'prop': 'imageinfo',
@@ -139,7 +659,7 @@ def get_wikipedia_category_members(title, limit=100):
     u'Anticimex kontorsbyggnad'
     """
 
-    return wiki.call(
+    return get_wiki().call(
         {'action': 'query',
          'list': 'categorymembers',
          'cmtitle': title,
@@ -148,11 +668,20 @@ def get_wikipedia_category_members(title, limit=100):
     )
 
 
-def get_wikipedia_pages_by_list(titles_or_page_ids):
+# Hits and misses of lru caches are included in instrumentation snapshots
+for function in [wikipedia_geosearch, get_wikipedia_page, wikipedia_image_urls, get_wikipedia_category_members]:
+    watch_lru_cache('wikipedia_query.' + function.__name__, function)
+
+
+def get_wikipedia_pages_by_list(titles_or_page_ids, max_workers=WIKIPEDIA_MAX_WORKERS):
     """
     Get Wikipedia pages using list of titles or page ids.
 
+    Titles or page ids are requested in batches of WIKIPEDIA_REQUEST_MAX_PAGES, and batches
+    are requested concurrently (rate limited, see set_wikipedia_rate_limit).
+
     @param titles_or_page_ids: List of titles or page ids.
+    @param max_workers: Number of threads sending requests.
     @return: List of pages.
 
 
@@ -177,29 +706,30 @@ def get_wikipedia_pages_by_list(titles_or_page_ids):
     3879445
     """
 
-    # Function for splitting a list into smaller lists, see
-    # http://stackoverflow.com/questions/752308/split-list-into-smaller-lists
-    split_list = lambda l, n=WIKIPEDIA_REQUEST_MAX_PAGES: [l[:]] if len(l) <= n else [l[i:i+n] for i in range(0, len(l), n)]
-
-    if isinstance(titles_or_page_ids, str):
+    if isinstance(titles_or_page_ids, basestring):
         titles_or_page_ids = [titles_or_page_ids]
 
-    titles_or_page_ids = split_list(titles_or_page_ids, WIKIPEDIA_REQUEST_MAX_PAGES)
+    n = WIKIPEDIA_REQUEST_MAX_PAGES
+    batches = [titles_or_page_ids[i:i + n] for i in range(0, len(titles_or_page_ids), n)]
 
-    pages = []
-    for values in titles_or_page_ids:
-
-        if all([isinstance(v, str) for v in values]):
-            results = get_wikipedia_page('titles', '|'.join(values))
+    def get_batch(values):
+        if all([isinstance(v, basestring) for v in values]):
+            return get_wikipedia_page('titles', '|'.join(values))
         else:
-            results = get_wikipedia_page('pageids', '|'.join(map(str, values)))
+            return get_wikipedia_page('pageids', '|'.join(map(str, values)))
+
+    if len(batches) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(min(max_workers, len(batches))) as executor:
+            results = list(executor.map(get_batch, batches))
+    else:
+        results = map(get_batch, batches)
 
-        pages.extend(results['query']['pages'].values())
+    pages = []
+    for result in results:
+        pages.extend(result['query'].get('pages', {}).values())
 
     return pages
 
-    # TODO: What about 'continue'...
-
 
 def get_wikipedia_pages_by_category(title, limit=100):
     """
@@ -274,7 +804,7 @@ def wikipedia_extracts(list_of_pages):
 
     extracts = []
     for page in list_of_pages:
-        extracts.append(plaintext(page['extract']) if 'extract' in page else None)
+        extracts.append(pattern_web.plaintext(page['extract']) if 'extract' in page else None)
 
     return extracts
 
@@ -357,34 +887,69 @@ def wikipedia_page_ids(list_of_pages):
     return [page['pageid'] for page in list_of_pages]
 
 
-def download_wikipedia_images(urls_or_titles, folder=''):
+def wikipedia_image_info(titles):
+    """
+    Get url, size, and SHA-1 hash of images (in batches of WIKIPEDIA_REQUEST_MAX_PAGES).
+
+    Reference: http://www.mediawiki.org/wiki/API:Imageinfo
+
+    @param titles: List of image file names.
+    @return: List of dictionaries with title, url, size, and sha1 (images without image
+             info, e.g. missing files, are left out).
+
+    >>> titles = ['Fil:Aromatic dec 2013b.jpg', 'Fil:Dragontorpet Abrahamsberg, 2013a.jpg']
+    >>> wikipedia_image_info(titles)[0]['size']
     """
-    Download Wikipedia images.
 
-    Reference: http://stackoverflow.com/questions/13137817/how-to-download-image-using-requests
+    n = WIKIPEDIA_REQUEST_MAX_PAGES
+
+    image_info = []
+    for i in range(0, len(titles), n):
+        result = wikipedia_query({'action': 'query',
+                                  'titles': '|'.join(titles[i:i + n]),
+                                  'prop': 'imageinfo',
+                                  'iiprop': 'url|size|sha1'})
+
+        for page in result['query'].get('pages', {}).values():
+            if page.get('imageinfo'):
+                d = page['imageinfo'][0]
+                image_info.append({'title': page['title'], 'url': d['url'],
+                                   'size': d.get('size'), 'sha1': d.get('sha1')})
+
+    return image_info
+
+
+def download_wikipedia_images(urls_or_titles, folder='', max_workers=DOWNLOAD_MAX_WORKERS, thumbnail_size=None):
+    """
+    Download Wikipedia images (original files, concurrently). Images already downloaded
+    (same size and hash as on Wikipedia) are skipped.
+
+    Reference: http://www.mediawiki.org/wiki/API:Imageinfo
 
     @param urls_or_titles: List of urls or titles.
     @param folder: Download folder.
+    @param max_workers: Number of threads downloading images.
+    @param thumbnail_size: Max width and height (pixels) of thumbnails created in folder
+                           thumbnails (process pool), or None.
+    @return: List of file names of downloaded images, and dictionary of errors for failed urls.
 
     >>> urls_or_titles = ['Fil:Aromatic dec 2013b.jpg', 'Fil:Dragontorpet Abrahamsberg, 2013a.jpg']
-    >>> urls_or_titles = wikipedia_image_urls('|'.join(urls_or_titles))
-    >>> download_wikipedia_images(urls_or_titles, 'images')
+    >>> file_names, failed = download_wikipedia_images(urls_or_titles, 'images', thumbnail_size=(320, 320))
     """
 
-    is_url = lambda urls_or_titles: all([True if urlparse(s).scheme == 'http' else False for s in urls_or_titles])
+    is_url = lambda urls_or_titles: all([urlparse(s).scheme in ('http', 'https') for s in urls_or_titles])
 
     if is_url(urls_or_titles):
-        urls = urls_or_titles
-        titles = [os.path.split(s)[-1] for s in urls]
+        files = [{'url': url} for url in urls_or_titles]
     else:
-        urls = wikipedia_image_urls('|'.join(urls_or_titles))
-        titles = urls_or_titles
+        files = wikipedia_image_info(list(urls_or_titles))
+
+    file_names, failed = download_files(files, folder, max_workers)
+
+    if thumbnail_size:
+        create_thumbnails(file_names, thumbnail_size)
 
-    for url, title in zip(urls, titles):
-        print url, title
-        r = requests.get(url)
-        image_io = Image.open(StringIO(r.content))
-        image_io.save(os.path.join(folder, title), format='JPEG')
+    return file_names, failed
 
 
 def wikipedia_search(srsearch, srwhat, srlimit=10):
@@ -404,7 +969,7 @@ def wikipedia_search(srsearch, srwhat, srlimit=10):
     Skåneleden
     """
 
-    search_result = wiki.call(
+    search_result = get_wiki().call(
         {'action': 'query',
          'list': 'search',
          'srsearch': srsearch,